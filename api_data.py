@@ -20,7 +20,11 @@ from reportlab.lib.units import mm
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
-import requests  # Telegram + Bitrix user.get
+import requests  # Telegram
+
+from pg_pool import pg_pool_conn
+from entity_counts import count_total, resolve_total_mode
+from bitrix_http import bitrix_post, bitrix_priority  # Bitrix: общая keep-alive сессия
 
 # WeasyPrint для генерации PDF из HTML/CSS (поддержка CSS Grid)
 try:
@@ -44,6 +48,7 @@ router = APIRouter(prefix="/api/data", tags=["data"])
 _user_name_cache: Dict[str, str] = {}
 
 
+@bitrix_priority("low")
 def _get_user_name(user_id: Optional[str], bitrix_webhook: Optional[str] = None) -> str:
     """
     Получает имя пользователя по ID через Bitrix API.
@@ -68,7 +73,7 @@ def _get_user_name(user_id: Optional[str], bitrix_webhook: Optional[str] = None)
         url = f"{bitrix_webhook.rstrip('/')}/user.get.json"
         params = {"ID": user_id_str}
 
-        response = requests.post(url, json=params, timeout=5)
+        response = bitrix_post(url, json=params, timeout=5)
         if response.status_code == 200:
             data = response.json()
             if "result" in data and len(data["result"]) > 0:
@@ -252,23 +257,49 @@ DEALS_FILTER_STAGE_IN_CHIRIE = os.getenv("DEALS_FILTER_STAGE_IN_CHIRIE", "în ch
 
 
 def pg_conn():
-    conn = psycopg2.connect(
-        host=PG_HOST,
-        port=PG_PORT,
-        dbname=PG_DB,
-        user=PG_USER,
-        password=PG_PASS,
-    )
-    try:
-        conn.set_client_encoding("UTF8")
-    except Exception as e:
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SET client_encoding TO 'UTF8'")
-            conn.commit()
-        except Exception:
-            print(f"WARNING: pg_conn: could not set UTF8 encoding: {e}", file=sys.stderr, flush=True)
-    return conn
+    """Соединение из общего пула (pg_pool.py); conn.close() возвращает его в пул."""
+    return pg_pool_conn()
+
+
+def keyset_page_sql(
+    after_id: Optional[int],
+    before_id: Optional[int],
+    id_expr: str = "id",
+) -> Tuple[Optional[str], List[Any], str, bool]:
+    """
+    Keyset-пагинация по id вместо OFFSET (глубокие страницы без чтения и отбрасывания предыдущих строк).
+    after_id — следующая страница (id < after_id, id DESC); before_id — предыдущая (id > before_id:
+    читаем по возрастанию и разворачиваем). Возвращает (условие WHERE или None, параметры, ORDER BY,
+    нужно ли развернуть строки).
+    """
+    if after_id is not None and before_id is not None:
+        raise HTTPException(status_code=400, detail="Use either after_id or before_id, not both")
+    if after_id is not None:
+        return f"{id_expr} < %s", [int(after_id)], f"{id_expr} DESC", False
+    if before_id is not None:
+        return f"{id_expr} > %s", [int(before_id)], f"{id_expr} ASC", True
+    return None, [], f"{id_expr} DESC", False
+
+
+def keyset_page_cursors(
+    ids: List[Any],
+    limit: int,
+    offset: int,
+    after_id: Optional[int],
+    before_id: Optional[int],
+) -> Dict[str, Optional[int]]:
+    """next_cursor / prev_cursor для ответа: id последней / первой строки страницы (None — дальше строк нет)."""
+    ids = [int(i) for i in ids if i is not None]
+    if not ids:
+        # пустая страница назад от before_id: следующая страница начинается сразу после него
+        return {"next_cursor": int(before_id) + 1 if before_id is not None else None, "prev_cursor": None}
+    full = len(ids) >= limit
+    next_cursor = ids[-1] if (full or before_id is not None) else None
+    if before_id is not None:
+        prev_cursor = ids[0] if full else None
+    else:
+        prev_cursor = ids[0] if (after_id is not None or offset > 0) else None
+    return {"next_cursor": next_cursor, "prev_cursor": prev_cursor}
 
 
 def stock_table_name(entity_type_id: int) -> str:
@@ -4797,6 +4828,7 @@ def _caption_html_to_bitrix_bb(caption: str) -> str:
     return s.strip()
 
 
+@bitrix_priority("low")
 def send_pdf_to_bitrix(pdf_bytes: bytes, filename: str, caption: str) -> Dict[str, Any]:
     """
     Отправляет PDF в чат Bitrix по webhook:
@@ -4823,7 +4855,7 @@ def send_pdf_to_bitrix(pdf_bytes: bytes, filename: str, caption: str) -> Dict[st
         # 1) Получаем папку диска чата
         folder_url = f"{webhook.rstrip('/')}/im.disk.folder.get.json"
         folder_params = {"DIALOG_ID": dialog_id}
-        folder_resp = requests.post(folder_url, json=folder_params, timeout=30)
+        folder_resp = bitrix_post(folder_url, json=folder_params, timeout=30)
         folder_resp.raise_for_status()
         folder_data = folder_resp.json()
         folder_result = folder_data.get("result") or {}
@@ -4841,7 +4873,7 @@ def send_pdf_to_bitrix(pdf_bytes: bytes, filename: str, caption: str) -> Dict[st
         upload_method_url = f"{webhook.rstrip('/')}/disk.folder.uploadfile.json"
         # Шаг 2a: только id папки и имя файла — Bitrix вернёт uploadUrl
         init_payload = {"id": folder_id, "NAME": filename}
-        init_resp = requests.post(upload_method_url, json=init_payload, timeout=30)
+        init_resp = bitrix_post(upload_method_url, json=init_payload, timeout=30)
         init_resp.raise_for_status()
         init_json = init_resp.json()
         init_result = init_json.get("result") or {}
@@ -4856,10 +4888,11 @@ def send_pdf_to_bitrix(pdf_bytes: bytes, filename: str, caption: str) -> Dict[st
             flush=True,
         )
         # Шаг 2b: отправляем файл на uploadUrl (multipart)
-        step2_resp = requests.post(
+        step2_resp = bitrix_post(
             upload_url_to_use,
             files={field_name: (filename, pdf_bytes, "application/pdf")},
             timeout=60,
+            rate_limited=False,
         )
         step2_resp.raise_for_status()
         step2_content_type = (step2_resp.headers.get("content-type") or "").split(";")[0].strip().lower()
@@ -4889,7 +4922,7 @@ def send_pdf_to_bitrix(pdf_bytes: bytes, filename: str, caption: str) -> Dict[st
         if caption:
             commit_params["COMMENT"] = caption
 
-        commit_resp = requests.post(commit_url, json=commit_params, timeout=30)
+        commit_resp = bitrix_post(commit_url, json=commit_params, timeout=30)
         commit_resp.raise_for_status()
         commit_json = commit_resp.json()
 
@@ -4907,7 +4940,7 @@ def send_pdf_to_bitrix(pdf_bytes: bytes, filename: str, caption: str) -> Dict[st
                 msg_url = f"{webhook.rstrip('/')}/im.message.add.json"
                 msg_params = {"DIALOG_ID": dialog_id, "MESSAGE": msg_text}
                 try:
-                    msg_resp = requests.post(msg_url, json=msg_params, timeout=15)
+                    msg_resp = bitrix_post(msg_url, json=msg_params, timeout=15)
                     msg_resp.raise_for_status()
                     print(
                         f"DEBUG: send_pdf_to_bitrix: Preview message sent (im.message.add)",
@@ -4997,11 +5030,19 @@ def get_deals(
     limit: int = Query(100, ge=1, le=10000),
     offset: int = Query(0, ge=0),
     category_id: Optional[int] = Query(None),
+    after_id: Optional[int] = Query(None, description="Keyset: следующая страница после этого id (next_cursor); offset игнорируется"),
+    before_id: Optional[int] = Query(None, description="Keyset: предыдущая страница перед этим id (prev_cursor); offset игнорируется"),
+    total_mode: Optional[str] = Query(None, description="Как считать total: exact, estimated или cached (см. entity_counts)"),
 ) -> Dict[str, Any]:
     """
     Возвращает список сделок для админки с 7 полями:
     ID, Title, Stage, Begin Date, Close Date, Amount, Automobile, Assigned By
+    Пагинация: offset или keyset (after_id/before_id = next_cursor/prev_cursor из предыдущего ответа).
     """
+    total_mode = resolve_total_mode(total_mode)
+    keyset_sql, keyset_params, order_sql, reverse_rows = keyset_page_sql(after_id, before_id)
+    if keyset_sql:
+        offset = 0
     conn = pg_conn()
     try:
         sql = f"""
@@ -5030,18 +5071,23 @@ def get_deals(
             cid = str(int(category_id))
             params.extend([cid, cid, cid, cid])
 
-        sql += " ORDER BY id DESC LIMIT %s OFFSET %s"
+        if keyset_sql:
+            sql += f" AND {keyset_sql}"
+            params.extend(keyset_params)
+        sql += f" ORDER BY {order_sql} LIMIT %s OFFSET %s"
         params.extend([limit, offset])
 
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             cur.execute(sql, params)
             rows = cur.fetchall()
+        if reverse_rows:
+            rows.reverse()
 
-        count_sql = f"SELECT COUNT(*) FROM {DEALS_TABLE} WHERE 1=1"
+        count_where = ""
         count_params: List[Any] = []
         if category_id is not None:
-            count_sql += """
-                AND (
+            count_where = """
+                WHERE (
                     category_id = %s
                     OR raw->>'CATEGORY_ID' = %s
                     OR raw->>'category_id' = %s
@@ -5051,9 +5097,9 @@ def get_deals(
             cid = str(int(category_id))
             count_params.extend([cid, cid, cid, cid])
 
-        with conn.cursor() as cur:
-            cur.execute(count_sql, count_params)
-            total = int(cur.fetchone()[0])
+        total, total_mode = count_total(
+            conn, DEALS_TABLE, count_where, count_params, mode=total_mode, category_col="category_id"
+        )
 
         deals = []
         for row in rows:
@@ -5088,10 +5134,12 @@ def get_deals(
         return {
             "ok": True,
             "total": total,
+            "total_mode": total_mode,
             "limit": limit,
             "offset": offset,
             "count": len(deals),
             "data": deals,
+            **keyset_page_cursors([r.get("id") for r in rows], limit, offset, after_id, before_id),
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
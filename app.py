@@ -1,20 +1,39 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import hashlib
 import os
+import random
 import re
+import select
+import socket
 import sys
 import traceback
 import threading
 import time
 import urllib.parse
+from collections import deque
 from fastapi import Request
 from zoneinfo import ZoneInfo
 from datetime import datetime, timezone, timedelta, time as dt_time
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from starlette.requests import Request
 from urllib.parse import parse_qs
 import json
 import unicodedata
 import requests
 import psycopg2
+from pg_pool import pg_connection, pg_pool_conn, pg_pool_warm_up
+from entity_counts import mark_counts_dirty
+from meta_cache import bump_schema_version, cached_meta, meta_cache_stats, on_meta_invalidate
+from bitrix_http import (
+    bitrix_circuit_remaining,
+    bitrix_circuit_trip,
+    bitrix_post,
+    bitrix_priority,
+    bitrix_rate_limiter_enabled,
+    bitrix_rate_penalize,
+)
 from psycopg2.extras import execute_values, Json
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.responses import JSONResponse
@@ -50,12 +69,26 @@ AUTO_SYNC_LEAD_LIMIT = int(os.getenv("AUTO_SYNC_LEAD_LIMIT", "30"))
 # Консервативное время работы синхронизации (10 секунд вместо 20)
 # Helps avoid Bitrix operation time limit and API blocking
 SYNC_TIME_BUDGET_SEC = int(os.getenv("SYNC_TIME_BUDGET_SEC", "10"))
+# sync_data: сколько сущностей синхронизировать одновременно и минимальный бюджет на сущность
+SYNC_PARALLELISM = max(1, int(os.getenv("SYNC_PARALLELISM", "4")))
+SYNC_MIN_ENTITY_BUDGET_SEC = max(1, int(os.getenv("SYNC_MIN_ENTITY_BUDGET_SEC", "2")))
+# Проход по изменённым: на сколько секунд назад от high-water mark начинать (часы Bitrix, поздние коммиты)
+SYNC_MODIFIED_OVERLAP_SEC = max(0, int(os.getenv("SYNC_MODIFIED_OVERLAP_SEC", "120")))
 
 # Консервативный интервал между запросами (1 секунда вместо 0.15)
 # Helps avoid Bitrix rate limiting and API blocking
+# Используется только при BITRIX_RATE_LIMIT_ENABLED=0; иначе работает общий лимитер из bitrix_http.py
 BITRIX_MIN_REQUEST_INTERVAL_SEC = float(os.getenv("BITRIX_MIN_REQUEST_INTERVAL_SEC", "1.0"))
 BITRIX_MAX_RETRIES = int(os.getenv("BITRIX_MAX_RETRIES", "8"))
 BITRIX_BACKOFF_BASE_SEC = float(os.getenv("BITRIX_BACKOFF_BASE_SEC", "0.7"))
+# Bitrix batch: максимум 50 подзапросов в одном вызове batch
+BITRIX_BATCH_MAX_COMMANDS = max(1, min(50, int(os.getenv("BITRIX_BATCH_MAX_COMMANDS", "50"))))
+# upsert_rows: от скольких строк писать через COPY + staging (0 — выключено)
+UPSERT_COPY_THRESHOLD = max(0, int(os.getenv("UPSERT_COPY_THRESHOLD", "2000")))
+# upsert_rows: не перезаписывать строки, у которых не изменился raw_hash
+UPSERT_SKIP_UNCHANGED = os.getenv("UPSERT_SKIP_UNCHANGED", "1").strip().lower() in ("1", "true", "yes", "on")
+# AsyncBitrixClient: сколько запросов держать "в полёте" одновременно (частоту ограничивает лимитер bitrix_http)
+BITRIX_ASYNC_CONCURRENCY = max(1, int(os.getenv("BITRIX_ASYNC_CONCURRENCY", "4")))
 
 # Ежедневная отправка 7 PDF-отчётов в 23:55 (Telegram + Bitrix)
 REPORT_CRON_BASE_URL = os.getenv("REPORT_CRON_BASE_URL", "http://127.0.0.1:7070").strip().rstrip("/")
@@ -295,13 +328,22 @@ class BitrixClient:
     def __init__(self, webhook_base: str):
         self.base = webhook_base.rstrip("/")
         self._last_call_ts = 0.0
+        self._throttle_lock = threading.Lock()
 
     def _throttle(self):
-        now = time.time()
-        dt = now - self._last_call_ts
-        if dt < BITRIX_MIN_REQUEST_INTERVAL_SEC:
-            time.sleep(BITRIX_MIN_REQUEST_INTERVAL_SEC - dt)
-        self._last_call_ts = time.time()
+        # Общее ведро токенов (bitrix_http) уже ограничивает все процессы — локальная пауза не нужна
+        if bitrix_rate_limiter_enabled():
+            return
+        with self._throttle_lock:
+            now = time.time()
+            dt = now - self._last_call_ts
+            if dt < BITRIX_MIN_REQUEST_INTERVAL_SEC:
+                time.sleep(BITRIX_MIN_REQUEST_INTERVAL_SEC - dt)
+            self._last_call_ts = time.time()
+
+    def _post(self, url: str, payload: Dict[str, Any]) -> requests.Response:
+        self._throttle()
+        return bitrix_post(url, json=payload, timeout=60)
 
     def call(self, method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         url = f"{self.base}/{method}.json"
@@ -310,86 +352,249 @@ class BitrixClient:
         last_err = None
         for attempt in range(BITRIX_MAX_RETRIES):
             try:
-                self._throttle()
-                r = requests.post(url, json=payload, timeout=60)
-
-                # Bitrix can return 429 with JSON or plain text
-                if r.status_code == 429:
-                    wait = BITRIX_BACKOFF_BASE_SEC * (2 ** attempt)
-                    time.sleep(wait)
-                    last_err = f"Bitrix HTTP 429: {r.text}"
+                r = self._post(url, payload)
+                kind, value = _b24_interpret_response(r)
+                if kind == "retry":
+                    time.sleep(BITRIX_BACKOFF_BASE_SEC * (2 ** attempt))
+                    last_err = value
                     continue
+                return value
+            except requests.RequestException as e:
+                wait = BITRIX_BACKOFF_BASE_SEC * (2 ** attempt)
+                time.sleep(wait)
+                last_err = repr(e)
 
-                # Проверяем HTTP 401 - может быть OVERLOAD_LIMIT в JSON
-                if r.status_code == 401:
-                    try:
-                        data = r.json()
-                        if "error" in data and str(data.get("error")) == "OVERLOAD_LIMIT":
-                            print(f"WARNING: b24.call: API blocked (OVERLOAD_LIMIT), returning empty result", file=sys.stderr, flush=True)
-                            return {"error": "OVERLOAD_LIMIT", "result": []}
-                    except:
-                        pass  # Если не JSON, продолжим как обычно
-                    # Если не OVERLOAD_LIMIT, падаем с ошибкой
-                    raise HTTPException(status_code=502, detail=f"Bitrix HTTP {r.status_code}: {r.text}")
-
-                if r.status_code != 200:
-                    raise HTTPException(status_code=502, detail=f"Bitrix HTTP {r.status_code}: {r.text}")
-
-                # Всегда декодируем ответ как UTF-8, чтобы не терять румынские диакритики (ț, ă, ș)
-                try:
-                    text = r.content.decode("utf-8", errors="replace")
-                except Exception:
-                    text = r.text or "{}"
-                data = json.loads(text)
-
-                # Bitrix error in body
-                if "error" in data:
-                    err = str(data.get("error"))
-                    # OVERLOAD_LIMIT - API заблокирован, возвращаем специальный ответ вместо исключения
-                    if err == "OVERLOAD_LIMIT":
-                        print(f"WARNING: b24.call: API blocked (OVERLOAD_LIMIT), returning empty result", file=sys.stderr, flush=True)
-                        return {"error": "OVERLOAD_LIMIT", "result": []}
-                    
-                    # Typical: OPERATION_TIME_LIMIT
-                    if err in ("OPERATION_TIME_LIMIT", "QUERY_LIMIT_EXCEEDED") or "LIMIT" in err:
-                        wait = BITRIX_BACKOFF_BASE_SEC * (2 ** attempt)
-                        time.sleep(wait)
-                        last_err = f"Bitrix error: {data.get('error')} {data.get('error_description')}"
-                        continue
+        raise HTTPException(status_code=502, detail=f"Bitrix retry limit exceeded. Last error: {last_err}")
 
-                    raise HTTPException(
-                        status_code=502,
-                        detail=f"Bitrix error: {data.get('error')} {data.get('error_description')}"
-                    )
+    def call_batch(self, commands: Any, halt: bool = False) -> Dict[str, Dict[str, Any]]:
+        """
+        Пакетный вызов через метод Bitrix `batch`: до BITRIX_BATCH_MAX_COMMANDS подзапросов за один HTTP-запрос
+        (и за один слот троттлинга). Больше команд — режем на несколько batch-вызовов.
+
+        commands: {key: (method, params)} или список (method, params) — тогда ключи "0", "1", ...
+        Возвращает {key: {"result": ..., "error": ..., "error_description": ..., "total": ..., "next": ...}}.
+        Ошибка одной команды не роняет остальные (halt=0).
+        """
+        items = _b24_batch_items(commands)
+        chunks = [items[i:i + BITRIX_BATCH_MAX_COMMANDS] for i in range(0, len(items), BITRIX_BATCH_MAX_COMMANDS)]
+        if len(chunks) > 1:
+            # Несколько batch-вызовов — отправляем параллельно (в пределах общего лимита запросов)
+            return b24_run_async(AsyncBitrixClient(self.base, sync_client=self).call_batch(commands, halt=halt))
+
+        out: Dict[str, Dict[str, Any]] = {}
+        for chunk in chunks:
+            data = self.call("batch", _b24_batch_payload(chunk, halt))
+            out.update(_b24_parse_batch_response(data, [key for key, _, _ in chunk]))
+        return out
+
+
+def _b24_batch_items(commands: Any) -> List[Tuple[str, str, Optional[Dict[str, Any]]]]:
+    """commands ({key: (method, params)} или список) -> [(key, method, params)]."""
+    if isinstance(commands, dict):
+        return [(str(k), v[0], (v[1] if len(v) > 1 else None)) for k, v in commands.items()]
+    return [(str(i), c[0], (c[1] if len(c) > 1 else None)) for i, c in enumerate(commands or [])]
+
+
+def _b24_batch_payload(chunk: List[Tuple[str, str, Optional[Dict[str, Any]]]], halt: bool) -> Dict[str, Any]:
+    return {"halt": 1 if halt else 0, "cmd": {key: _b24_batch_command(method, params) for key, method, params in chunk}}
+
+
+def _b24_interpret_response(r: requests.Response) -> Tuple[str, Any]:
+    """
+    Общая для BitrixClient и AsyncBitrixClient разборка HTTP-ответа Bitrix:
+      ("ok", data)    — успешный ответ;
+      ("ok", {"error": "OVERLOAD_LIMIT", "result": []}) — API заблокирован, отдаём пустой результат;
+      ("retry", err)  — 429 / OPERATION_TIME_LIMIT / QUERY_LIMIT_EXCEEDED: повторить с backoff.
+    Прочие ошибки — HTTPException(502).
+    """
+    # Bitrix can return 429 with JSON or plain text
+    if r.status_code == 429:
+        bitrix_rate_penalize()
+        return "retry", f"Bitrix HTTP 429: {r.text}"
+
+    # Проверяем HTTP 401 - может быть OVERLOAD_LIMIT в JSON
+    if r.status_code == 401:
+        try:
+            data = r.json()
+            if "error" in data and str(data.get("error")) == "OVERLOAD_LIMIT":
+                bitrix_rate_penalize()
+                bitrix_circuit_trip()
+                print(f"WARNING: b24.call: API blocked (OVERLOAD_LIMIT), returning empty result", file=sys.stderr, flush=True)
+                return "ok", {"error": "OVERLOAD_LIMIT", "result": []}
+        except:
+            pass  # Если не JSON, продолжим как обычно
+        # Если не OVERLOAD_LIMIT, падаем с ошибкой
+        raise HTTPException(status_code=502, detail=f"Bitrix HTTP {r.status_code}: {r.text}")
+
+    if r.status_code != 200:
+        raise HTTPException(status_code=502, detail=f"Bitrix HTTP {r.status_code}: {r.text}")
+
+    # Всегда декодируем ответ как UTF-8, чтобы не терять румынские диакритики (ț, ă, ș)
+    try:
+        text = r.content.decode("utf-8", errors="replace")
+    except Exception:
+        text = r.text or "{}"
+    data = json.loads(text)
+
+    # Bitrix error in body
+    if "error" in data:
+        err = str(data.get("error"))
+        # OVERLOAD_LIMIT - API заблокирован, возвращаем специальный ответ вместо исключения
+        if err == "OVERLOAD_LIMIT":
+            bitrix_rate_penalize()
+            bitrix_circuit_trip()
+            print(f"WARNING: b24.call: API blocked (OVERLOAD_LIMIT), returning empty result", file=sys.stderr, flush=True)
+            return "ok", {"error": "OVERLOAD_LIMIT", "result": []}
+
+        # Typical: OPERATION_TIME_LIMIT
+        if err in ("OPERATION_TIME_LIMIT", "QUERY_LIMIT_EXCEEDED") or "LIMIT" in err:
+            if err != "OPERATION_TIME_LIMIT":
+                bitrix_rate_penalize()
+            return "retry", f"Bitrix error: {data.get('error')} {data.get('error_description')}"
+
+        raise HTTPException(
+            status_code=502,
+            detail=f"Bitrix error: {data.get('error')} {data.get('error_description')}"
+        )
+
+    return "ok", data
 
-                return data
+
+class AsyncBitrixClient:
+    """
+    asyncio-клиент Bitrix: те же retry / 429 / OVERLOAD_LIMIT / OPERATION_TIME_LIMIT, что у BitrixClient,
+    но позволяет держать несколько запросов "в полёте". HTTP идёт через ту же общую сессию (bitrix_http)
+    в потоках (asyncio.to_thread), так что лимитер запросов общий — растёт параллелизм, а не частота.
+    Не больше BITRIX_ASYNC_CONCURRENCY одновременных запросов в рамках одного call_many/call_batch.
+    """
+
+    def __init__(self, webhook_base: str, sync_client: Optional[BitrixClient] = None, concurrency: Optional[int] = None):
+        self.base = webhook_base.rstrip("/")
+        self._sync = sync_client or BitrixClient(webhook_base)
+        self.concurrency = max(1, int(concurrency or BITRIX_ASYNC_CONCURRENCY))
+
+    async def call(self, method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        url = f"{self.base}/{method}.json"
+        payload = params or {}
+
+        last_err = None
+        for attempt in range(BITRIX_MAX_RETRIES):
+            try:
+                r = await asyncio.to_thread(self._sync._post, url, payload)
+                kind, value = _b24_interpret_response(r)
+                if kind == "retry":
+                    await asyncio.sleep(BITRIX_BACKOFF_BASE_SEC * (2 ** attempt))
+                    last_err = value
+                    continue
+                return value
             except requests.RequestException as e:
-                wait = BITRIX_BACKOFF_BASE_SEC * (2 ** attempt)
-                time.sleep(wait)
+                await asyncio.sleep(BITRIX_BACKOFF_BASE_SEC * (2 ** attempt))
                 last_err = repr(e)
 
         raise HTTPException(status_code=502, detail=f"Bitrix retry limit exceeded. Last error: {last_err}")
 
+    async def call_many(self, calls: List[Tuple[str, Optional[Dict[str, Any]]]], return_exceptions: bool = False) -> List[Any]:
+        """Параллельно выполняет [(method, params)], результаты в том же порядке."""
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _one(method: str, params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+            async with sem:
+                return await self.call(method, params)
+
+        return await asyncio.gather(*[_one(m, p) for m, p in calls], return_exceptions=return_exceptions)
+
+    async def call_batch(self, commands: Any, halt: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Как BitrixClient.call_batch, но batch-вызовы по BITRIX_BATCH_MAX_COMMANDS команд идут параллельно."""
+        items = _b24_batch_items(commands)
+        chunks = [items[i:i + BITRIX_BATCH_MAX_COMMANDS] for i in range(0, len(items), BITRIX_BATCH_MAX_COMMANDS)]
+        responses = await self.call_many([("batch", _b24_batch_payload(chunk, halt)) for chunk in chunks])
+        out: Dict[str, Dict[str, Any]] = {}
+        for chunk, data in zip(chunks, responses):
+            out.update(_b24_parse_batch_response(data, [key for key, _, _ in chunk]))
+        return out
+
+
+def b24_run_async(coro: Any) -> Any:
+    """Выполняет корутину Bitrix-клиента из синхронного кода (потоки синка, sync-эндпоинты)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # Уже внутри event loop (async-эндпоинт): выполняем в отдельном потоке со своим loop
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
+        return ex.submit(contextvars.copy_context().run, asyncio.run, coro).result()
+
+
+def _b24_flatten_params(value: Any, prefix: str, out: List[Tuple[str, str]]) -> None:
+    """Разворачивает params в пары PHP-стиля: filter[>ID]=5, select[0]=*, order[ID]=ASC."""
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _b24_flatten_params(v, f"{prefix}[{k}]" if prefix else str(k), out)
+    elif isinstance(value, (list, tuple)):
+        for idx, v in enumerate(value):
+            _b24_flatten_params(v, f"{prefix}[{idx}]", out)
+    elif value is None:
+        out.append((prefix, ""))
+    elif isinstance(value, bool):
+        out.append((prefix, "1" if value else "0"))
+    else:
+        out.append((prefix, str(value)))
+
+
+def _b24_batch_command(method: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """Строка команды для batch: "crm.deal.get?id=5"."""
+    pairs: List[Tuple[str, str]] = []
+    _b24_flatten_params(params or {}, "", pairs)
+    if not pairs:
+        return method
+    return f"{method}?{urllib.parse.urlencode(pairs)}"
+
+
+def _b24_parse_batch_response(data: Dict[str, Any], keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Раскладывает ответ batch по ключам команд. PHP отдаёт пустые секции как [] вместо {}."""
+    def _as_dict(v: Any) -> Dict[str, Any]:
+        return v if isinstance(v, dict) else {}
+
+    out: Dict[str, Dict[str, Any]] = {}
+    if not isinstance(data, dict) or data.get("error"):
+        err = str((data or {}).get("error") or "BATCH_FAILED") if isinstance(data, dict) else "BATCH_FAILED"
+        for key in keys:
+            out[key] = {"result": None, "error": err, "error_description": None, "total": None, "next": None}
+        return out
+
+    res = _as_dict(data.get("result"))
+    results = _as_dict(res.get("result"))
+    errors = _as_dict(res.get("result_error"))
+    totals = _as_dict(res.get("result_total"))
+    nexts = _as_dict(res.get("result_next"))
+    for key in keys:
+        err = errors.get(key)
+        err_code = None
+        err_desc = None
+        if isinstance(err, dict):
+            err_code = str(err.get("error") or "ERROR")
+            err_desc = err.get("error_description")
+        elif err:
+            err_code = str(err)
+        out[key] = {
+            "result": results.get(key),
+            "error": err_code,
+            "error_description": err_desc,
+            "total": totals.get(key),
+            "next": nexts.get(key),
+        }
+    return out
+
 
 b24 = BitrixClient(BITRIX_WEBHOOK)
+b24_async = AsyncBitrixClient(BITRIX_WEBHOOK, sync_client=b24)
 
 # -----------------------------
 # Postgres helpers
 # -----------------------------
 def pg_conn():
-    conn = psycopg2.connect(
-        host=PG_HOST, port=PG_PORT, dbname=PG_DB, user=PG_USER, password=PG_PASS
-    )
-    try:
-        conn.set_client_encoding("UTF8")
-    except Exception as e:
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SET client_encoding TO 'UTF8'")
-            conn.commit()
-        except Exception:
-            print(f"WARNING: pg_conn: could not set UTF8 encoding: {e}", file=sys.stderr, flush=True)
-    return conn
+    """Соединение из общего пула (pg_pool.py); conn.close() возвращает его в пул."""
+    return pg_pool_conn()
 
 def ensure_meta_tables(conn):
     with conn.cursor() as cur:
@@ -430,6 +635,15 @@ def ensure_meta_tables(conn):
             updated_at TIMESTAMPTZ DEFAULT now()
         );
         """)
+        # High-water mark прохода по изменённым: (DATE_MODIFY | updatedTime, ID) последнего прочитанного элемента
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS b24_meta_sync_cursor (
+            entity_key TEXT PRIMARY KEY,
+            modified_at TIMESTAMPTZ NOT NULL,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ DEFAULT now()
+        );
+        """)
         
         # Классификатор источников (sursa) для сделок
         cur.execute("""
@@ -587,6 +801,28 @@ def set_sync_cursor(conn, entity_key: str, cursor: int):
     conn.commit()
 
 
+def get_modified_cursor(conn, entity_key: str) -> Tuple[datetime, int]:
+    """(modified_at, last_id) из b24_meta_sync_cursor; если курсора ещё нет — начало текущего дня (как today-pass)."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT modified_at, last_id FROM b24_meta_sync_cursor WHERE entity_key=%s", (entity_key,))
+        row = cur.fetchone()
+    if not row or row[0] is None:
+        return day_start_utc(os.getenv("B24_TZ", "Europe/Chisinau")), 0
+    return row[0], int(row[1] or 0)
+
+def set_modified_cursor(conn, entity_key: str, modified_at: datetime, last_id: int):
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO b24_meta_sync_cursor(entity_key, modified_at, last_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (entity_key) DO UPDATE
+            SET modified_at = EXCLUDED.modified_at,
+                last_id = EXCLUDED.last_id,
+                updated_at = now()
+        """, (entity_key, modified_at, int(last_id)))
+    conn.commit()
+
+
 def _upsert_b24_user(conn, user_id: int, name: Optional[str]) -> None:
     """Сохранить/обновить имя пользователя в b24_users (для API без вызова Bitrix)."""
     if name is None or not str(name).strip():
@@ -671,10 +907,12 @@ def ensure_table_base(conn, table: str):
         CREATE TABLE IF NOT EXISTS {table} (
             id BIGINT,
             raw JSONB,
+            raw_hash TEXT,
             created_at TIMESTAMPTZ DEFAULT now(),
             updated_at TIMESTAMPTZ DEFAULT now()
         );
         """)
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "raw_hash" TEXT;')
         cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{sanitize_ident(table, 40)}_id ON {table}(id);")
     conn.commit()
 
@@ -774,6 +1012,7 @@ def upsert_meta_fields(conn, entity_key: str, fields: Dict[str, Any], colmap: Di
             rows
         )
     conn.commit()
+    invalidate_row_builders(entity_key)
 
 def sync_sources_classifier(conn):
     """
@@ -919,7 +1158,7 @@ def sync_sources_classifier(conn):
                 rows,
                 page_size=100
             )
-            
+            bump_schema_version(conn)
             conn.commit()
             print(f"INFO: sync_sources_classifier: Successfully synced {len(rows)} sources to classifier", file=sys.stderr, flush=True)
     except Exception as e:
@@ -1323,7 +1562,78 @@ def _userfield_items_to_enum_rows(entity_key: str, field_name: str, items: List[
     return rows
 
 
-def sync_field_enums(conn, entity_key: str) -> Tuple[int, List[str]]:
+def _userfield_inline_items(uf: Dict[str, Any]) -> List[Any]:
+    """Варианты enum, которые Bitrix отдаёт прямо в описании поля (items/values/settings.items и т.п.)."""
+    raw_items = (
+        uf.get("items") or uf.get("values") or uf.get("options") or uf.get("option")
+        or uf.get("ENUM") or uf.get("LIST") or uf.get("list") or []
+    )
+    if not raw_items and isinstance(uf.get("settings"), dict):
+        raw_items = uf["settings"].get("items") or uf["settings"].get("options") or uf["settings"].get("list") or []
+    if isinstance(raw_items, dict):
+        inner = raw_items.get("items") or raw_items.get("values")
+        if inner is not None and isinstance(inner, list):
+            return inner
+        # Bitrix crm.item.fields часто возвращает items как { "id": "title", ... } или { "id": { "VALUE": "..." }, ... }
+        def _title_from(v: Any) -> str:
+            if isinstance(v, str):
+                return v
+            if isinstance(v, dict):
+                return str(v.get("VALUE") or v.get("NAME") or v.get("title") or v.get("TITLE") or v)
+            return str(v)
+        return [{"ID": k, "VALUE": _title_from(v)} for k, v in raw_items.items() if str(k).strip() != ""]
+    return raw_items if isinstance(raw_items, list) else []
+
+
+def _status_result_to_enum_items(st_res: Any) -> List[Dict[str, str]]:
+    """result crm.status.entity.items -> [{"ID", "VALUE"}]."""
+    if isinstance(st_res, list):
+        st_list = st_res
+    elif isinstance(st_res, dict):
+        st_list = st_res.get("items") or st_res.get("result") or []
+    else:
+        st_list = []
+    items: List[Dict[str, str]] = []
+    if isinstance(st_list, list):
+        for st in st_list:
+            if isinstance(st, dict):
+                sid = st.get("ID") or st.get("id") or st.get("STATUS_ID") or st.get("statusId")
+                name = st.get("VALUE") or st.get("value") or st.get("NAME") or st.get("name") or st.get("TITLE")
+                if sid is not None:
+                    items.append({"ID": str(sid), "VALUE": str(name or sid).strip()})
+            elif st is not None:
+                items.append({"ID": str(st), "VALUE": str(st)})
+    return items
+
+
+def _iblock_result_to_enum_items(el_res: Any) -> List[Dict[str, str]]:
+    """result lists.element.get -> [{"ID", "VALUE"}]."""
+    if isinstance(el_res, dict):
+        el_list = el_res.get("elements") or el_res.get("items") or el_res.get("result") or []
+    else:
+        el_list = el_res
+    items: List[Dict[str, str]] = []
+    if isinstance(el_list, list):
+        for el in el_list:
+            if isinstance(el, dict):
+                eid = el.get("ID") or el.get("id") or el.get("ELEMENT_ID")
+                name = el.get("NAME") or el.get("name") or el.get("VALUE") or el.get("title")
+                if eid is not None:
+                    items.append({"ID": str(eid), "VALUE": str(name or eid).strip()})
+            elif el is not None:
+                items.append({"ID": str(el), "VALUE": str(el)})
+    return items
+
+
+def _field_enum_batch_lookup(commands: Dict[str, Tuple[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """batch-вызов справочных методов для sync_field_enums; при сбое batch — ошибка на каждую команду."""
+    try:
+        return b24.call_batch(commands)
+    except Exception as e:
+        return {k: {"result": None, "error": f"{type(e).__name__}: {e}"} for k in commands}
+
+
+def sync_field_enums(conn, entity_key: str, prefetched: Any = None) -> Tuple[int, List[str]]:
     """Синхронизирует enum/списочные значения полей в b24_field_enum. Возвращает (n_inserted, debug_notes)."""
     debug_notes: List[str] = []
     if entity_key == "deal":
@@ -1350,13 +1660,19 @@ def sync_field_enums(conn, entity_key: str) -> Tuple[int, List[str]]:
     try:
         field_list: List[Tuple[str, Dict[str, Any]]] = []
         if use_smart_api:
-            fields = fetch_smart_fields(etid)
+            if prefetched is not None:
+                fields = (prefetched.get("fields") if "fields" in prefetched else prefetched) if isinstance(prefetched, dict) else {}
+            else:
+                fields = fetch_smart_fields(etid)
             if isinstance(fields, dict):
                 field_list = [(str(fn), uf) for fn, uf in fields.items() if fn and isinstance(uf, dict)]
             debug_notes.append(f"{entity_key}: crm.item.fields, {len(field_list)} fields")
         else:
-            data = b24.call(method, {})
-            result = data.get("result")
+            if prefetched is not None:
+                result = prefetched
+            else:
+                data = b24.call(method, {})
+                result = data.get("result")
             if not result:
                 debug_notes.append(f"{entity_key} userfield.list: result empty")
                 return 0, debug_notes
@@ -1389,118 +1705,88 @@ def sync_field_enums(conn, entity_key: str) -> Tuple[int, List[str]]:
                         if isinstance(uf, dict) and fn and not fn.startswith("_"):
                             field_list.append((str(fn), uf))
                 debug_notes.append(f"{entity_key}: result is dict, {len(field_list)} fields")
-        all_rows = []
-        fields_with_items = 0
+        # 1) Варианты прямо из описания поля
+        field_items: Dict[str, List[Any]] = {}
         for field_name, uf in field_list:
-            raw_items = (
-                uf.get("items") or uf.get("values") or uf.get("options") or uf.get("option")
-                or uf.get("ENUM") or uf.get("LIST") or uf.get("list") or []
+            field_items[field_name] = _userfield_inline_items(uf)
+
+        # 2) Списочные поля с entityId в settings — варианты через crm.status.entity.items.
+        # Пробуем для любого поля (Transmisie, Tractiune, Filiala и т.д. могут не иметь type=list в ответе).
+        # Все запросы по полям сущности уходят одним batch-вызовом.
+        status_lookups: Dict[str, Any] = {}
+        for field_name, uf in field_list:
+            if field_items.get(field_name):
+                continue
+            settings = uf.get("settings") or uf.get("SETTINGS") or {}
+            if isinstance(settings, dict):
+                eid = (
+                    settings.get("entityId") or settings.get("ENTITY_ID")
+                    or settings.get("listEntityId") or settings.get("LIST_ENTITY_ID")
+                    or uf.get("entityId") or uf.get("listEntityId")
+                )
+                if eid:
+                    status_lookups[field_name] = eid
+        if status_lookups:
+            batch_res = _field_enum_batch_lookup(
+                {fn: ("crm.status.entity.items", {"entityId": str(eid).strip()}) for fn, eid in status_lookups.items()}
             )
-            if not raw_items and isinstance(uf.get("settings"), dict):
-                raw_items = uf["settings"].get("items") or uf["settings"].get("options") or uf["settings"].get("list") or []
-            if isinstance(raw_items, dict):
-                inner = raw_items.get("items") or raw_items.get("values")
-                if inner is not None and isinstance(inner, list):
-                    items = inner
+            for field_name, eid in status_lookups.items():
+                r = batch_res.get(field_name) or {}
+                if r.get("error"):
+                    debug_notes.append(f"{entity_key}: {field_name} status.entity.items: {r.get('error')}")
+                    print(f"WARNING: sync_field_enums({entity_key}): {field_name} entityId={eid} -> {r.get('error')}", file=sys.stderr, flush=True)
+                    continue
+                items = _status_result_to_enum_items(r.get("result"))
+                if items:
+                    field_items[field_name] = items
+                    debug_notes.append(f"{entity_key}: {field_name} from status.entity.items entityId={eid} ({len(items)} items)")
+                    print(f"INFO: sync_field_enums({entity_key}): {field_name} <- crm.status.entity.items entityId={eid} ({len(items)} values)", file=sys.stderr, flush=True)
                 else:
-                    # Bitrix crm.item.fields часто возвращает items как { "id": "title", ... } или { "id": { "VALUE": "..." }, ... }
-                    def _title_from(v: Any) -> str:
-                        if isinstance(v, str):
-                            return v
-                        if isinstance(v, dict):
-                            return str(v.get("VALUE") or v.get("NAME") or v.get("title") or v.get("TITLE") or v)
-                        return str(v)
-                    items = [{"ID": k, "VALUE": _title_from(v)} for k, v in raw_items.items() if str(k).strip() != ""]
-            else:
-                items = raw_items if isinstance(raw_items, list) else []
-            if not items:
-                # Списочные поля смарт-процесса часто хранят entityId в settings — варианты через crm.status.entity.items.
-                # Пробуем для любого поля (Transmisie, Tractiune, Filiala и т.д. могут не иметь type=list в ответе).
-                settings = uf.get("settings") or uf.get("SETTINGS") or {}
-                if isinstance(settings, dict):
-                    eid = (
-                        settings.get("entityId") or settings.get("ENTITY_ID")
-                        or settings.get("listEntityId") or settings.get("LIST_ENTITY_ID")
-                        or uf.get("entityId") or uf.get("listEntityId")
-                    )
-                    if eid:
-                        try:
-                            st_data = b24.call("crm.status.entity.items", {"entityId": str(eid).strip()})
-                            st_res = st_data.get("result")
-                            if isinstance(st_res, list):
-                                st_list = st_res
-                            elif isinstance(st_res, dict):
-                                st_list = st_res.get("items") or st_res.get("result") or []
-                            else:
-                                st_list = []
-                            if isinstance(st_list, list) and st_list:
-                                items = []
-                                for st in st_list:
-                                    if isinstance(st, dict):
-                                        sid = st.get("ID") or st.get("id") or st.get("STATUS_ID") or st.get("statusId")
-                                        name = st.get("VALUE") or st.get("value") or st.get("NAME") or st.get("name") or st.get("TITLE")
-                                        if sid is not None:
-                                            items.append({"ID": str(sid), "VALUE": str(name or sid).strip()})
-                                    elif st is not None:
-                                        items.append({"ID": str(st), "VALUE": str(st)})
-                                if items:
-                                    debug_notes.append(f"{entity_key}: {field_name} from status.entity.items entityId={eid} ({len(items)} items)")
-                                    print(f"INFO: sync_field_enums({entity_key}): {field_name} <- crm.status.entity.items entityId={eid} ({len(items)} values)", file=sys.stderr, flush=True)
-                            else:
-                                print(f"INFO: sync_field_enums({entity_key}): {field_name} entityId={eid} -> empty result", file=sys.stderr, flush=True)
-                        except Exception as e:
-                            debug_notes.append(f"{entity_key}: {field_name} status.entity.items: {e}")
-                            print(f"WARNING: sync_field_enums({entity_key}): {field_name} entityId={eid} -> {e}", file=sys.stderr, flush=True)
-            if not items:
-                # Поля типа iblock_element (Transmisie, Tracțiune, Filiala и т.д.) — варианты в инфоблоке, в settings есть IBLOCK_ID
-                settings = uf.get("settings") or uf.get("SETTINGS") or {}
-                if isinstance(settings, dict):
-                    _iblock_id = settings.get("IBLOCK_ID")
-                    field_type = (
-                        uf.get("type")
-                        or uf.get("USER_TYPE_ID")
-                        or uf.get("userTypeId")
-                        or ""
-                    )
-                    if _iblock_id is not None and str(field_type).strip().lower() == "iblock_element":
-                        try:
-                            iblock_id = int(_iblock_id)
-                            # Пробуем lists.element.get (REST Bitrix24 — элементы списка по IBLOCK_ID)
-                            el_data = b24.call("lists.element.get", {"IBLOCK_TYPE_ID": "lists", "IBLOCK_ID": iblock_id})
-                            el_res = el_data.get("result")
-                            if isinstance(el_res, list) and el_res:
-                                items = []
-                                for el in el_res:
-                                    if isinstance(el, dict):
-                                        eid = el.get("ID") or el.get("id") or el.get("ELEMENT_ID")
-                                        name = el.get("NAME") or el.get("name") or el.get("VALUE") or el.get("title")
-                                        if eid is not None:
-                                            items.append({"ID": str(eid), "VALUE": str(name or eid).strip()})
-                                    elif el is not None:
-                                        items.append({"ID": str(el), "VALUE": str(el)})
-                                if items:
-                                    debug_notes.append(f"{entity_key}: {field_name} from lists.element.get IBLOCK_ID={iblock_id} ({len(items)} items)")
-                                    print(f"INFO: sync_field_enums({entity_key}): {field_name} <- lists.element.get IBLOCK_ID={iblock_id} ({len(items)} values)", file=sys.stderr, flush=True)
-                            elif isinstance(el_res, dict):
-                                el_list = el_res.get("elements") or el_res.get("items") or el_res.get("result") or []
-                                if isinstance(el_list, list) and el_list:
-                                    items = []
-                                    for el in el_list:
-                                        if isinstance(el, dict):
-                                            eid = el.get("ID") or el.get("id") or el.get("ELEMENT_ID")
-                                            name = el.get("NAME") or el.get("name") or el.get("VALUE") or el.get("title")
-                                            if eid is not None:
-                                                items.append({"ID": str(eid), "VALUE": str(name or eid).strip()})
-                                        elif el is not None:
-                                            items.append({"ID": str(el), "VALUE": str(el)})
-                                    if items:
-                                        debug_notes.append(f"{entity_key}: {field_name} from lists.element.get IBLOCK_ID={iblock_id} ({len(items)} items)")
-                                        print(f"INFO: sync_field_enums({entity_key}): {field_name} <- lists.element.get IBLOCK_ID={iblock_id} ({len(items)} values)", file=sys.stderr, flush=True)
-                            if not items:
-                                print(f"INFO: sync_field_enums({entity_key}): {field_name} IBLOCK_ID={_iblock_id} -> empty or unsupported format", file=sys.stderr, flush=True)
-                        except Exception as e:
-                            debug_notes.append(f"{entity_key}: {field_name} lists.element.get: {e}")
-                            print(f"WARNING: sync_field_enums({entity_key}): {field_name} IBLOCK_ID={_iblock_id} -> {e}", file=sys.stderr, flush=True)
+                    print(f"INFO: sync_field_enums({entity_key}): {field_name} entityId={eid} -> empty result", file=sys.stderr, flush=True)
+
+        # 3) Поля типа iblock_element (Transmisie, Tracțiune, Filiala и т.д.) — варианты в инфоблоке, в settings есть IBLOCK_ID
+        iblock_lookups: Dict[str, int] = {}
+        for field_name, uf in field_list:
+            if field_items.get(field_name):
+                continue
+            settings = uf.get("settings") or uf.get("SETTINGS") or {}
+            if isinstance(settings, dict):
+                _iblock_id = settings.get("IBLOCK_ID")
+                field_type = (
+                    uf.get("type")
+                    or uf.get("USER_TYPE_ID")
+                    or uf.get("userTypeId")
+                    or ""
+                )
+                if _iblock_id is not None and str(field_type).strip().lower() == "iblock_element":
+                    try:
+                        iblock_lookups[field_name] = int(_iblock_id)
+                    except (TypeError, ValueError) as e:
+                        debug_notes.append(f"{entity_key}: {field_name} lists.element.get: {e}")
+                        print(f"WARNING: sync_field_enums({entity_key}): {field_name} IBLOCK_ID={_iblock_id} -> {e}", file=sys.stderr, flush=True)
+        if iblock_lookups:
+            # Пробуем lists.element.get (REST Bitrix24 — элементы списка по IBLOCK_ID)
+            batch_res = _field_enum_batch_lookup(
+                {fn: ("lists.element.get", {"IBLOCK_TYPE_ID": "lists", "IBLOCK_ID": iblock_id}) for fn, iblock_id in iblock_lookups.items()}
+            )
+            for field_name, iblock_id in iblock_lookups.items():
+                r = batch_res.get(field_name) or {}
+                if r.get("error"):
+                    debug_notes.append(f"{entity_key}: {field_name} lists.element.get: {r.get('error')}")
+                    print(f"WARNING: sync_field_enums({entity_key}): {field_name} IBLOCK_ID={iblock_id} -> {r.get('error')}", file=sys.stderr, flush=True)
+                    continue
+                items = _iblock_result_to_enum_items(r.get("result"))
+                if items:
+                    field_items[field_name] = items
+                    debug_notes.append(f"{entity_key}: {field_name} from lists.element.get IBLOCK_ID={iblock_id} ({len(items)} items)")
+                    print(f"INFO: sync_field_enums({entity_key}): {field_name} <- lists.element.get IBLOCK_ID={iblock_id} ({len(items)} values)", file=sys.stderr, flush=True)
+                else:
+                    print(f"INFO: sync_field_enums({entity_key}): {field_name} IBLOCK_ID={iblock_id} -> empty or unsupported format", file=sys.stderr, flush=True)
+
+        all_rows = []
+        fields_with_items = 0
+        for field_name, _ in field_list:
+            items = field_items.get(field_name)
             if not items:
                 continue
             fields_with_items += 1
@@ -1528,6 +1814,45 @@ def sync_field_enums(conn, entity_key: str) -> Tuple[int, List[str]]:
         return 0, debug_notes
 
 
+def _field_enum_source_command(entity_key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """Метод Bitrix со списком полей сущности для sync_field_enums."""
+    if entity_key in ("deal", "contact", "lead", "company"):
+        return (f"crm.{entity_key}.userfield.list", {})
+    if entity_key and entity_key.startswith("sp:"):
+        try:
+            return ("crm.item.fields", {"entityTypeId": int(entity_key.split(":", 1)[1])})
+        except (IndexError, ValueError):
+            return None
+    return None
+
+
+def sync_field_enums_many(conn, entity_keys: List[str]) -> Dict[str, Tuple[int, List[str]]]:
+    """
+    sync_field_enums для нескольких сущностей: списки полей всех сущностей забираем одним batch-вызовом
+    (вместо отдельного userfield.list / crm.item.fields на каждую сущность).
+    Если batch по сущности не удался — sync_field_enums сходит в Bitrix сам.
+    """
+    commands: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    for ek in dict.fromkeys(entity_keys or []):
+        command = _field_enum_source_command(ek)
+        if command is not None:
+            commands[ek] = command
+    prefetched: Dict[str, Dict[str, Any]] = {}
+    if commands:
+        try:
+            prefetched = b24.call_batch(commands)
+        except Exception as e:
+            print(f"WARNING: sync_field_enums_many: batch failed, falling back to per-entity calls: {e}", file=sys.stderr, flush=True)
+    out: Dict[str, Tuple[int, List[str]]] = {}
+    for ek in dict.fromkeys(entity_keys or []):
+        r = prefetched.get(ek) or {}
+        if r and not r.get("error"):
+            out[ek] = sync_field_enums(conn, ek, prefetched=r.get("result") or {})
+        else:
+            out[ek] = sync_field_enums(conn, ek)
+    return out
+
+
 def _label_to_string(val: Any) -> Optional[str]:
     """Извлекает строку из label: строка как есть, dict — берём ru/en/first."""
     if val is None:
@@ -1764,14 +2089,127 @@ def normalize_value(v: Any, b24_type: Optional[str] = None, is_multiple: bool =
 
     return v
 
-def upsert_rows(conn, table: str, columns: List[str], rows: List[List[Any]]):
+def _copy_text_value(v: Any) -> str:
+    """Значение -> поле COPY (text format). Те же текстовые представления, что даёт адаптация psycopg2 в INSERT."""
+    if v is None:
+        return "\\N"
+    if isinstance(v, Json):
+        v = v.dumps(v.adapted)
+    elif isinstance(v, bool):
+        v = "true" if v else "false"
+    elif isinstance(v, (dict, list)):
+        v = json.dumps(v, ensure_ascii=False)
+    elif isinstance(v, datetime):
+        v = v.isoformat()
+    else:
+        v = str(v)
+    return v.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class _CopyRowStream:
+    """file-like для cursor.copy_expert: строки COPY формируются по мере чтения, без сборки всего буфера в памяти."""
+
+    def __init__(self, rows: List[List[Any]]):
+        self._it = iter(rows)
+        self._buf = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buf) < size:
+            row = next(self._it, None)
+            if row is None:
+                break
+            self._buf += "\t".join(_copy_text_value(v) for v in row) + "\n"
+        if size < 0:
+            out, self._buf = self._buf, ""
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+    readline = read
+
+
+def _upsert_rows_copy(conn, table: str, col_order: List[str], rows: List[List[Any]], set_sql: str, where_sql: str = "") -> int:
+    """
+    Bulk-путь upsert_rows: COPY во временную staging-таблицу (без WAL) и один INSERT ... SELECT ... ON CONFLICT.
+    Дубликаты id внутри пачки схлопываем заранее (последняя версия строки побеждает) —
+    иначе ON CONFLICT DO UPDATE упадёт на "cannot affect row a second time".
+    """
+    id_idx = col_order.index("id")
+    by_id: Dict[Any, List[Any]] = {}
+    for r in rows:
+        by_id[r[id_idx]] = r
+
+    cols_sql = ", ".join([f'"{c}"' for c in col_order])
+    stage = "_upsert_rows_stage"
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS pg_temp.{stage}")
+        cur.execute(f"CREATE TEMP TABLE {stage} AS SELECT {cols_sql} FROM {table} WITH NO DATA")
+        cur.copy_expert(f"COPY {stage} ({cols_sql}) FROM STDIN", _CopyRowStream(list(by_id.values())))
+        cur.execute(f"""
+            INSERT INTO {table} AS t ({cols_sql})
+            SELECT {cols_sql} FROM {stage}
+            ON CONFLICT ("id") DO UPDATE
+            SET {set_sql}
+            {where_sql}
+        """)
+        written = cur.rowcount
+        cur.execute(f"DROP TABLE IF EXISTS pg_temp.{stage}")
+    return max(0, written)
+
+
+def _row_content_hash(col_order: List[str], row: List[Any]) -> str:
+    """
+    md5 содержимого строки (имена колонок + нормализованные значения; raw — JSON с сортировкой ключей).
+    created_at / updated_at не учитываются — это служебные отметки, а не содержимое.
+    """
+    parts: List[str] = []
+    names: List[str] = []
+    for c, v in zip(col_order, row):
+        if c in ("created_at", "updated_at"):
+            continue
+        names.append(c)
+        if isinstance(v, Json):
+            parts.append(json.dumps(v.adapted, sort_keys=True, ensure_ascii=False, default=str))
+        else:
+            parts.append(_copy_text_value(v))
+    payload = "\x1f".join(names) + "\x1e" + "\x1f".join(parts)
+    return hashlib.md5(payload.encode("utf-8")).hexdigest()
+
+
+_raw_hash_tables: set = set()
+
+
+def _ensure_raw_hash_column(conn, table: str) -> None:
+    """
+    Колонка raw_hash для пропуска неизменённых строк. ALTER идёт в транзакции вызывающего (отдельное соединение
+    ждало бы его же блокировку на таблице) и откатится вместе с ней, поэтому в _raw_hash_tables таблица
+    попадает только когда колонка уже видна в information_schema — т.е. закоммичена раньше.
+    """
+    if table in _raw_hash_tables:
+        return
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'raw_hash'
+        """, (table,))
+        if cur.fetchone() is not None:
+            _raw_hash_tables.add(table)
+            return
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "raw_hash" TEXT;')
+
+
+def upsert_rows(conn, table: str, columns: List[str], rows: List[List[Any]]) -> int:
     """
     Upsert rows into table by 'id'. Uses execute_values for speed.
+    От UPSERT_COPY_THRESHOLD строк — bulk-путь через COPY в staging-таблицу (_upsert_rows_copy).
+    Если есть колонка raw — считаем raw_hash строки и не перезаписываем строки, у которых он не изменился
+    (UPSERT_SKIP_UNCHANGED). Возвращает число реально записанных строк.
     FIX: updated_at исключаем из set_cols, иначе получается 2 раза:
          updated_at = EXCLUDED.updated_at, updated_at = now()
     """
     if not rows:
-        return
+        return 0
 
     # на всякий случай — убираем дубликаты колонок, сохраняя порядок
     seen = set()
@@ -1781,6 +2219,13 @@ def upsert_rows(conn, table: str, columns: List[str], rows: List[List[Any]]):
             seen.add(c)
             col_order.append(c)
 
+    where_sql = ""
+    if UPSERT_SKIP_UNCHANGED and "raw" in col_order and "raw_hash" not in col_order:
+        _ensure_raw_hash_column(conn, table)
+        rows = [list(r) + [_row_content_hash(col_order, r)] for r in rows]
+        col_order = col_order + ["raw_hash"]
+        where_sql = 'WHERE t."raw_hash" IS DISTINCT FROM EXCLUDED."raw_hash"'
+
     cols_sql = ", ".join([f'"{c}"' for c in col_order])
     tmpl = "(" + ",".join(["%s"] * len(col_order)) + ")"
 
@@ -1794,16 +2239,73 @@ def upsert_rows(conn, table: str, columns: List[str], rows: List[List[Any]]):
     else:
         set_sql = '"updated_at" = now()'
 
+    if UPSERT_COPY_THRESHOLD > 0 and len(rows) >= UPSERT_COPY_THRESHOLD:
+        written = _upsert_rows_copy(conn, table, col_order, rows, set_sql, where_sql)
+        if written:
+            mark_counts_dirty(conn, table)
+        conn.commit()
+        return written
+
     sql = f"""
-    INSERT INTO {table} ({cols_sql})
+    INSERT INTO {table} AS t ({cols_sql})
     VALUES %s
     ON CONFLICT ("id") DO UPDATE
     SET {set_sql}
+    {where_sql}
+    RETURNING 1
     """
 
     with conn.cursor() as cur:
-        execute_values(cur, sql, rows, template=tmpl, page_size=500)
+        written_rows = execute_values(cur, sql, rows, template=tmpl, page_size=500, fetch=True)
+    if written_rows:
+        mark_counts_dirty(conn, table)
     conn.commit()
+    return len(written_rows or [])
+
+
+class _SyncWriter:
+    """
+    Запись страниц sync_entity_data_*: upsert_rows + set_sync_cursor.
+    buffered=True (полная синхронизация без лимита): страницы копятся до UPSERT_COPY_THRESHOLD строк
+    и уходят одним upsert_rows (COPY-путь); курсор сдвигается только после записи строк,
+    так что при сбое страницы из буфера просто перечитаются в следующий раз.
+    """
+
+    def __init__(self, conn, entity_key: str, table: str, col_order: List[str], buffered: bool):
+        self.conn = conn
+        self.entity_key = entity_key
+        self.table = table
+        self.col_order = col_order
+        self.buffered = buffered and UPSERT_COPY_THRESHOLD > 0
+        self._rows: List[List[Any]] = []
+        self._cursor: Optional[int] = None
+        self.written = 0
+
+    def write(self, rows: List[List[Any]], cursor: Optional[int] = None) -> None:
+        if not self.buffered:
+            self.written += upsert_rows(self.conn, self.table, self.col_order, rows)
+            if cursor is not None:
+                set_sync_cursor(self.conn, self.entity_key, cursor)
+            return
+        self._rows.extend(rows)
+        if cursor is not None:
+            self._cursor = cursor
+        if len(self._rows) >= UPSERT_COPY_THRESHOLD:
+            self.flush()
+
+    def set_cursor(self, cursor: int) -> None:
+        if self.buffered and self._rows:
+            self._cursor = cursor
+        else:
+            set_sync_cursor(self.conn, self.entity_key, cursor)
+
+    def flush(self) -> None:
+        if self._rows:
+            self.written += upsert_rows(self.conn, self.table, self.col_order, self._rows)
+            self._rows = []
+        if self._cursor is not None:
+            set_sync_cursor(self.conn, self.entity_key, self._cursor)
+            self._cursor = None
 
 def day_start_utc(tz_name: str = "Europe/Chisinau") -> datetime:
     tz = ZoneInfo(tz_name)
@@ -1840,6 +2342,121 @@ def normalize_value(v: Any, b24_type: Optional[str] = None, is_multiple: bool =
     
     return v
 
+# -----------------------------
+# Compiled row builders (Bitrix item -> строка таблицы сущности)
+# -----------------------------
+# Раньше каждая синхронизация на каждый элемент и каждое поле перебирала варианты ключа
+# (b24_field / upper / lower / fields[...]) и вызывала normalize_value с разбором типа.
+# Теперь план (индекс колонки, ключи, нормализатор) строится один раз на colmap и кешируется
+# до изменения схемы (upsert_meta_fields -> invalidate_row_builders) или ROW_BUILDER_TTL_SEC.
+ROW_BUILDER_TTL_SEC = int(os.getenv("ROW_BUILDER_TTL_SEC", "300"))
+
+
+def _compile_normalizer(b24_type: Optional[str], is_multiple: bool):
+    """Нормализатор значения под (b24_type, is_multiple) — та же логика, что у normalize_value."""
+    if is_multiple:
+        def _norm_multiple(v: Any) -> Any:
+            if isinstance(v, (dict, list)):
+                return Json(v)
+            return Json([v])
+        return _norm_multiple
+
+    keep_empty_str = bool(b24_type) and b24_type.lower() in ("string", "text", "char")
+
+    def _norm(v: Any) -> Any:
+        if isinstance(v, (dict, list)):
+            return Json(v)
+        if not keep_empty_str and isinstance(v, str) and not v.strip():
+            return None
+        return v
+    return _norm
+
+
+class _RowBuilder:
+    """
+    Собирает строку для upsert_rows из элемента Bitrix по colmap.
+    col_order = ["id", "raw"] + колонки colmap (sorted) + extra_cols (если их ещё нет);
+    extra_cols заполняет вызывающий (например, assigned_by_name у сделок).
+    """
+
+    def __init__(self, colmap: Dict[str, Dict[str, Any]], extra_cols: Tuple[str, ...] = ()):
+        col_order = ["id", "raw"] + sorted({m["column_name"] for m in colmap.values()})
+        for c in extra_cols:
+            if c not in col_order:
+                col_order.append(c)
+        self.col_order: List[str] = col_order
+        self.index: Dict[str, int] = {c: i for i, c in enumerate(col_order)}
+        self._plan: List[Tuple[int, Tuple[str, ...], Any]] = []
+        for b24_field, meta in colmap.items():
+            keys = tuple(dict.fromkeys((b24_field, b24_field.upper(), b24_field.lower())))
+            self._plan.append((
+                self.index[meta["column_name"]],
+                keys,
+                _compile_normalizer(meta.get("b24_type"), bool(meta.get("is_multiple", False))),
+            ))
+
+    @property
+    def has_fields(self) -> bool:
+        return bool(self._plan)
+
+    def build(self, item: Dict[str, Any]) -> Optional[List[Any]]:
+        entity_id = _extract_int(item.get("ID") or item.get("id"))
+        if not entity_id:
+            return None
+        row: List[Any] = [None] * len(self.col_order)
+        row[0] = int(entity_id)
+        row[1] = Json(item)
+        nested = item.get("fields")
+        if not isinstance(nested, dict):
+            nested = None
+        for idx, keys, norm in self._plan:
+            value = None
+            for k in keys:
+                if k in item:
+                    value = item[k]
+                    break
+            else:
+                if nested is not None:
+                    for k in keys:
+                        if k in nested:
+                            value = nested[k]
+                            break
+            if value is not None:
+                row[idx] = norm(value)
+        return row
+
+
+_row_builder_cache: Dict[Tuple[str, Tuple[str, ...]], Tuple[float, _RowBuilder]] = {}
+_row_builder_lock = threading.Lock()
+
+
+def get_row_builder(conn, entity_key: str, extra_cols: Tuple[str, ...] = ()) -> _RowBuilder:
+    """Скомпилированный построитель строк для сущности (кеш до изменения схемы / TTL)."""
+    key = (entity_key, tuple(extra_cols))
+    now = time.time()
+    with _row_builder_lock:
+        cached = _row_builder_cache.get(key)
+    if cached and now - cached[0] < ROW_BUILDER_TTL_SEC:
+        return cached[1]
+    builder = _RowBuilder(load_entity_colmap(conn, entity_key), tuple(extra_cols))
+    with _row_builder_lock:
+        _row_builder_cache[key] = (now, builder)
+    return builder
+
+
+def invalidate_row_builders(entity_key: Optional[str] = None) -> None:
+    """Сбросить кеш построителей строк (после изменения b24_meta_fields)."""
+    with _row_builder_lock:
+        if entity_key is None:
+            _row_builder_cache.clear()
+        else:
+            for key in [k for k in _row_builder_cache if k[0] == entity_key]:
+                _row_builder_cache.pop(key, None)
+
+
+# смена версии схемы (sync_schema в другом процессе) сбрасывает и построители строк
+on_meta_invalidate(invalidate_row_builders)
+
 # -----------------------------
 # Normalize Bitrix list response
 # -----------------------------
@@ -1932,19 +2549,14 @@ def fetch_smart_fields(entity_type_id: int) -> Dict[str, Any]:
 # -----------------------------
 # Bitrix list data (for insert)
 # -----------------------------
-def b24_list_deals(
+def _b24_deal_list_params(
     start_id: int = 0,
     start_offset: int = 0,
     filter_params: Optional[Dict[str, Any]] = None,
     uf_fields: Optional[List[str]] = None,
     order: Optional[Dict[str, str]] = None
 ) -> Dict[str, Any]:
-    """
-    Два режима:
-      1) Инкремент по ID: start_id>0, start_offset=0, order={"ID":"ASC"}, filter {">ID":start_id}
-      2) Today-pass по DATE_MODIFY: start_id=0, start_offset=next, order={"DATE_MODIFY":"ASC","ID":"ASC"}, filter {">=DATE_MODIFY": "..."}
-    """
-
+    """params для crm.deal.list (см. b24_list_deals)."""
     select_list = ["*"]
 
     # Пытаемся получить имя ответственного (если Bitrix вернет)
@@ -1971,7 +2583,22 @@ def b24_list_deals(
         filter_dict.update(filter_params)
     if filter_dict:
         params["filter"] = filter_dict
+    return params
 
+
+def b24_list_deals(
+    start_id: int = 0,
+    start_offset: int = 0,
+    filter_params: Optional[Dict[str, Any]] = None,
+    uf_fields: Optional[List[str]] = None,
+    order: Optional[Dict[str, str]] = None
+) -> Dict[str, Any]:
+    """
+    Два режима:
+      1) Инкремент по ID: start_id>0, start_offset=0, order={"ID":"ASC"}, filter {">ID":start_id}
+      2) Today-pass по DATE_MODIFY: start_id=0, start_offset=next, order={"DATE_MODIFY":"ASC","ID":"ASC"}, filter {">=DATE_MODIFY": "..."}
+    """
+    params = _b24_deal_list_params(start_id, start_offset, filter_params, uf_fields, order)
     resp = b24.call("crm.deal.list", params)
 
     if resp and "error" in resp and resp.get("error") == "OVERLOAD_LIMIT":
@@ -2287,6 +2914,8 @@ def sync_schema() -> Dict[str, Any]:
         }
         if company_fields:
             out["company"] = {"fields_count": len(company_fields)}
+        bump_schema_version(conn)
+        conn.commit()
         return out
     finally:
         conn.close()
@@ -2300,13 +2929,137 @@ def _is_unlimited(limit: int) -> bool:
 # Кэш для имен пользователей (чтобы не делать повторные запросы к Bitrix)
 _user_name_cache: Dict[str, str] = {}
 
-def sync_entity_data_deal(conn, limit: int, time_budget_sec: int) -> Dict[str, Any]:
-    entity_key = "deal"
+def _deal_assigned_by_name(it: Dict[str, Any]) -> Optional[str]:
+    """Имя ответственного из элемента сделки, если Bitrix его прислал (без user.get)."""
+    v = None
+    if "ASSIGNED_BY_NAME" in it:
+        v = it.get("ASSIGNED_BY_NAME")
+    elif "assigned_by_name" in it:
+        v = it.get("assigned_by_name")
+    # иногда ASSIGNED_BY объект
+    elif isinstance(it.get("ASSIGNED_BY"), dict):
+        u = it["ASSIGNED_BY"]
+        n = (u.get("NAME") or "").strip()
+        ln = (u.get("LAST_NAME") or "").strip()
+        v = (f"{n} {ln}".strip() or u.get("FULL_NAME") or None)
+    return str(v).strip() if v else None
+
+
+def _modified_fields(entity_key: str) -> Tuple[str, str]:
+    """Поле времени изменения и ID для прохода по изменённым: у смарт-процессов camelCase."""
+    if entity_key.startswith("sp:"):
+        return "updatedTime", "id"
+    return "DATE_MODIFY", "ID"
+
+
+def _parse_b24_datetime(v: Any) -> Optional[datetime]:
+    """Дата Bitrix ("2024-05-01T12:30:00+03:00") -> aware datetime; без зоны — считаем UTC."""
+    if not v:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(v).strip())
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _modified_list_command(
+    entity_key: str,
+    filter_params: Dict[str, Any],
+    order: Dict[str, str],
+    uf_fields: List[str],
+) -> Tuple[str, Dict[str, Any]]:
+    """Страница прохода по изменённым: тот же select, что у прохода по ID, start=-1 (без подсчёта total)."""
+    if entity_key.startswith("sp:"):
+        params: Dict[str, Any] = {
+            "entityTypeId": int(entity_key.split(":", 1)[1]),
+            "select": ["*"],
+            "filter": filter_params,
+            "order": order,
+        }
+        method = "crm.item.list"
+    elif entity_key == "deal":
+        params = _b24_deal_list_params(filter_params=filter_params, uf_fields=uf_fields, order=order)
+        method = "crm.deal.list"
+    else:
+        params = {"select": ["*"] + list(uf_fields or []), "filter": filter_params, "order": order}
+        method = f"crm.{entity_key}.list"
+    params["start"] = -1
+    return method, params
+
+
+def sync_modified_pass(
+    conn,
+    entity_key: str,
+    table: str,
+    col_order: List[str],
+    build_row,
+    uf_fields: List[str],
+    deadline: float,
+) -> Tuple[int, int]:
+    """
+    Элементы, изменённые после high-water mark из b24_meta_sync_cursor (вместо ежедневного today-pass).
+    Keyset по (DATE_MODIFY | updatedTime, ID): первая страница — с HWM минус SYNC_MODIFIED_OVERLAP_SEC,
+    дальше ">время" последнего элемента; после полной страницы элементы с тем же временем добираются
+    по ">ID", так что граница страницы ничего не теряет. Лимита страниц нет — только deadline;
+    HWM сохраняется после записи каждой страницы. Возвращает (прочитано строк, записано строк).
+    """
+    ts_field, id_field = _modified_fields(entity_key)
+    hwm_ts, hwm_id = get_modified_cursor(conn, entity_key)
+    cur_ts = hwm_ts - timedelta(seconds=SYNC_MODIFIED_OVERLAP_SEC)
+    cur_id = 0
+    op = ">="
+    tie = False  # добираем элементы с временем == cur_ts и ID > cur_id
+    total = written = 0
+
+    while time.time() < deadline:
+        ts_str = cur_ts.isoformat()
+        if tie:
+            filter_params = {">=" + ts_field: ts_str, "<=" + ts_field: ts_str, ">" + id_field: cur_id}
+            order = {id_field: "ASC"}
+        else:
+            filter_params = {op + ts_field: ts_str}
+            order = {ts_field: "ASC", id_field: "ASC"}
+        method, params = _modified_list_command(entity_key, filter_params, order, uf_fields)
+        resp = b24.call(method, params)
+        if isinstance(resp, dict) and resp.get("error"):
+            print(f"WARNING: sync_modified_pass({entity_key}): {resp.get('error')}, stop until next run", file=sys.stderr, flush=True)
+            break
+        items, _ = normalize_list_result(resp)
+
+        rows = [r for r in (build_row(it) for it in items) if r]
+        if rows:
+            written += upsert_rows(conn, table, col_order, rows)
+            total += len(rows)
+
+        if items:
+            last = items[-1]
+            last_ts = _parse_b24_datetime(last.get(ts_field))
+            last_id = _extract_int(last.get(id_field)) or 0
+            if last_ts is not None:
+                cur_ts = last_ts
+            cur_id = last_id
+            if (cur_ts, cur_id) > (hwm_ts, hwm_id):
+                hwm_ts, hwm_id = cur_ts, cur_id
+                set_modified_cursor(conn, entity_key, hwm_ts, hwm_id)
+
+        if len(items) < 50:
+            if not tie:
+                break
+            # элементы с этим временем закончились — дальше строго после него
+            tie = False
+        else:
+            tie = True
+        op = ">"
+
+    return total, written
+
+
+def sync_entity_data_deal(conn, limit: int, time_budget_sec: int) -> Dict[str, Any]:
+    entity_key = "deal"
     table = table_name_for_entity(entity_key)
 
     ensure_pk_index(conn, table)
-    colmap = load_entity_colmap(conn, entity_key)
-    col_order = ["id", "raw"] + sorted({m["column_name"] for m in colmap.values()})
 
     # Проверяем, есть ли колонка assigned_by_name в таблице (опционально)
     with conn.cursor() as cur:
@@ -2316,8 +3069,9 @@ def sync_entity_data_deal(conn, limit: int, time_budget_sec: int) -> Dict[str, A
             WHERE table_name = %s AND column_name = 'assigned_by_name'
         """, (table,))
         has_assigned_by_name_col = cur.fetchone() is not None
-    if has_assigned_by_name_col and "assigned_by_name" not in col_order:
-        col_order.append("assigned_by_name")
+    builder = get_row_builder(conn, entity_key, ("assigned_by_name",) if has_assigned_by_name_col else ())
+    col_order = builder.col_order
+    assigned_by_name_idx = builder.index.get("assigned_by_name") if has_assigned_by_name_col else None
 
     # Загружаем UF поля из меты (лучше чем UF_*)
     uf_fields: List[str] = []
@@ -2336,58 +3090,20 @@ def sync_entity_data_deal(conn, limit: int, time_budget_sec: int) -> Dict[str, A
 
     # -------- helpers: собрать row (общая логика) --------
     def build_row_from_item(it: Dict[str, Any]) -> Optional[List[Any]]:
-        deal_id = it.get("ID") or it.get("id")
-        if not deal_id:
+        row = builder.build(it)
+        if row is None:
             return None
 
-        row = {c: None for c in col_order}
-        row["id"] = int(deal_id)
-        row["raw"] = Json(it)
-
-        # обычные поля по colmap
-        for b24_field, meta in colmap.items():
-            col = meta["column_name"]
-            b24_type = meta.get("b24_type")
-            is_multiple = meta.get("is_multiple", False)
-
-            value = None
-            if b24_field in it:
-                value = it[b24_field]
-            elif isinstance(it.get("fields"), dict) and b24_field in it["fields"]:
-                value = it["fields"][b24_field]
-            elif b24_field.upper() in it:
-                value = it[b24_field.upper()]
-            elif b24_field.lower() in it:
-                value = it[b24_field.lower()]
-            elif isinstance(it.get("fields"), dict) and b24_field.upper() in it["fields"]:
-                value = it["fields"][b24_field.upper()]
-            elif isinstance(it.get("fields"), dict) and b24_field.lower() in it["fields"]:
-                value = it["fields"][b24_field.lower()]
-
-            if value is not None:
-                row[col] = normalize_value(value, b24_type, is_multiple)
-
         # assigned_by_name — берём только если Bitrix прислал (не долбим user.get лишний раз)
-        if has_assigned_by_name_col and "assigned_by_name" in col_order:
-            v = None
-            if "ASSIGNED_BY_NAME" in it:
-                v = it.get("ASSIGNED_BY_NAME")
-            elif "assigned_by_name" in it:
-                v = it.get("assigned_by_name")
-            # иногда ASSIGNED_BY объект
-            elif isinstance(it.get("ASSIGNED_BY"), dict):
-                u = it["ASSIGNED_BY"]
-                n = (u.get("NAME") or "").strip()
-                ln = (u.get("LAST_NAME") or "").strip()
-                v = (f"{n} {ln}".strip() or u.get("FULL_NAME") or None)
-
-            row["assigned_by_name"] = (str(v).strip() if v else None)
-
-        return [row.get(c) for c in col_order]
+        if assigned_by_name_idx is not None:
+            row[assigned_by_name_idx] = _deal_assigned_by_name(it)
+
+        return row
 
     # -------- 1) Инкремент: новые сделки по >ID (100% новых) --------
     total = 0
     last_id = validate_sync_cursor(conn, entity_key, table)
+    writer = _SyncWriter(conn, entity_key, table, col_order, buffered=_is_unlimited(limit))
     started = time.time()
 
     while True:
@@ -2404,7 +3120,7 @@ def sync_entity_data_deal(conn, limit: int, time_budget_sec: int) -> Dict[str, A
         items, _ = normalize_list_result(resp)
 
         if not items:
-            set_sync_cursor(conn, entity_key, last_id if last_id > 0 else 0)
+            writer.set_cursor(last_id if last_id > 0 else 0)
             break
 
         batch_rows: List[List[Any]] = []
@@ -2419,12 +3135,9 @@ def sync_entity_data_deal(conn, limit: int, time_budget_sec: int) -> Dict[str, A
             if deal_id_val and int(deal_id_val) > int(max_seen):
                 max_seen = int(deal_id_val)
 
-        if batch_rows:
-            upsert_rows(conn, table, col_order, batch_rows)
-            total += len(batch_rows)
-
         last_id = int(max_seen) if max_seen else last_id
-        set_sync_cursor(conn, entity_key, last_id)
+        writer.write(batch_rows, cursor=last_id)
+        total += len(batch_rows)
 
         if (not _is_unlimited(limit)) and total >= limit:
             break
@@ -2433,51 +3146,21 @@ def sync_entity_data_deal(conn, limit: int, time_budget_sec: int) -> Dict[str, A
         if len(items) < 50:
             break
 
-    # -------- 2) Today-pass: все сделки изменённые сегодня (100% актуальность дня) --------
-    # Экономим запросы: ограничиваем число страниц за один запуск (если сегодня изменили очень много)
-    tz_name = os.getenv("B24_TZ", "Europe/Chisinau")
-    dt_from_utc = day_start_utc(tz_name)
-    dt_from_str = dt_from_utc.isoformat()
+    writer.flush()
 
-    max_pages = int(os.getenv("DEAL_TODAY_MAX_PAGES", "10"))  # безопасный лимит
-    page = 0
-    offset = 0
-
-    while True:
-        if time.time() - started >= time_budget_sec:
-            break
-        if page >= max_pages:
-            print(f"INFO: sync_entity_data_deal: today-pass reached max_pages={max_pages}, stop early to protect API", file=sys.stderr, flush=True)
-            break
-
-        resp2 = b24_list_deals(
-            start_id=0,
-            start_offset=offset,
-            filter_params={">=DATE_MODIFY": dt_from_str},
-            uf_fields=uf_fields,
-            order={"DATE_MODIFY": "ASC", "ID": "ASC"},
-        )
-        items2, nxt2 = normalize_list_result(resp2)
-
-        if not items2:
-            break
-
-        batch_rows2: List[List[Any]] = []
-        for it in items2:
-            r = build_row_from_item(it)
-            if r:
-                batch_rows2.append(r)
-
-        if batch_rows2:
-            upsert_rows(conn, table, col_order, batch_rows2)
-            total += len(batch_rows2)
-
-        page += 1
-        if nxt2 is None:
-            break
-        offset = int(nxt2)
+    # -------- 2) Изменённые с прошлого запуска: keyset по (DATE_MODIFY, ID) от high-water mark --------
+    modified, written_modified = sync_modified_pass(
+        conn, entity_key, table, col_order, build_row_from_item, uf_fields, started + time_budget_sec,
+    )
+    total += modified
 
-    return {"entity": "deal", "table": table, "rows_upserted": total, "cursor_now": get_sync_cursor(conn, entity_key)}
+    written = writer.written + written_modified
+    return {
+        "entity": "deal", "table": table, "rows_upserted": total,
+        "rows_written": written, "rows_skipped": total - written,
+        "rows_modified": modified,
+        "cursor_now": get_sync_cursor(conn, entity_key),
+    }
 
 def sync_entity_data_contact(conn, limit: int, time_budget_sec: int) -> Dict[str, Any]:
     """Синхронизация данных контактов из Bitrix"""
@@ -2485,8 +3168,8 @@ def sync_entity_data_contact(conn, limit: int, time_budget_sec: int) -> Dict[str
     table = table_name_for_entity(entity_key)
     
     ensure_pk_index(conn, table)
-    colmap = load_entity_colmap(conn, entity_key)
-    col_order = ["id", "raw"] + sorted({m["column_name"] for m in colmap.values()})
+    builder = get_row_builder(conn, entity_key)
+    col_order = builder.col_order
     
     # Получаем список UF полей
     uf_fields = []
@@ -2509,6 +3192,7 @@ def sync_entity_data_contact(conn, limit: int, time_budget_sec: int) -> Dict[str
     total = 0
     # Валидируем курсор (offset пагинация через start/next)
     last_offset = validate_sync_cursor(conn, entity_key, table)
+    writer = _SyncWriter(conn, entity_key, table, col_order, buffered=_is_unlimited(limit))
     
     started = time.time()
     while True:
@@ -2519,54 +3203,43 @@ def sync_entity_data_contact(conn, limit: int, time_budget_sec: int) -> Dict[str
         items, nxt = normalize_list_result(resp)
         
         if not items:
-            set_sync_cursor(conn, entity_key, last_offset if last_offset > 0 else 0)
+            writer.set_cursor(last_offset if last_offset > 0 else 0)
             break
         
         rows = []
         for it in items:
-            contact_id = it.get("ID") or it.get("id")
-            if not contact_id:
-                continue
-            
-            row = {c: None for c in col_order}
-            row["id"] = int(contact_id)
-            row["raw"] = Json(it)
-            
-            for b24_field, meta in colmap.items():
-                col = meta["column_name"]
-                b24_type = meta.get("b24_type")
-                is_multiple = meta.get("is_multiple", False)
-                
-                value = None
-                if b24_field in it:
-                    value = it[b24_field]
-                elif b24_field.upper() in it:
-                    value = it[b24_field.upper()]
-                elif b24_field.lower() in it:
-                    value = it[b24_field.lower()]
-                
-                if value is not None:
-                    row[col] = normalize_value(value, b24_type, is_multiple)
-            
-            row_values = [row.get(c) for c in col_order]
-            rows.append(row_values)
+            r = builder.build(it)
+            if r:
+                rows.append(r)
         
-        upsert_rows(conn, table, col_order, rows)
         total += len(rows)
         
-        # Пагинация через start/next
+        # Пагинация через start/next (курсор сдвигается вместе с записью строк)
         if nxt is not None:
             last_offset = nxt
-            set_sync_cursor(conn, entity_key, last_offset)
+            writer.write(rows, cursor=last_offset)
         else:
             last_seen_id = rows[-1][col_order.index("id")] if rows else last_offset
-            set_sync_cursor(conn, entity_key, last_seen_id if last_seen_id else last_offset)
+            writer.write(rows, cursor=last_seen_id if last_seen_id else last_offset)
             break
         
         if (not _is_unlimited(limit)) and total >= limit:
             break
     
-    return {"entity": "contact", "table": table, "rows_upserted": total, "cursor_now": get_sync_cursor(conn, entity_key)}
+    writer.flush()
+
+    # Изменённые с прошлого запуска (keyset по DATE_MODIFY, ID от high-water mark)
+    modified, written_modified = sync_modified_pass(
+        conn, entity_key, table, col_order, builder.build, uf_fields, started + time_budget_sec,
+    )
+    total += modified
+    written = writer.written + written_modified
+    return {
+        "entity": "contact", "table": table, "rows_upserted": total,
+        "rows_written": written, "rows_skipped": total - written,
+        "rows_modified": modified,
+        "cursor_now": get_sync_cursor(conn, entity_key),
+    }
 
 def sync_entity_data_lead(conn, limit: int, time_budget_sec: int) -> Dict[str, Any]:
     """Синхронизация данных лидов из Bitrix"""
@@ -2574,8 +3247,8 @@ def sync_entity_data_lead(conn, limit: int, time_budget_sec: int) -> Dict[str, A
     table = table_name_for_entity(entity_key)
     
     ensure_pk_index(conn, table)
-    colmap = load_entity_colmap(conn, entity_key)
-    col_order = ["id", "raw"] + sorted({m["column_name"] for m in colmap.values()})
+    builder = get_row_builder(conn, entity_key)
+    col_order = builder.col_order
     
     # Получаем список UF полей
     uf_fields = []
@@ -2598,6 +3271,7 @@ def sync_entity_data_lead(conn, limit: int, time_budget_sec: int) -> Dict[str, A
     total = 0
     # Валидируем курсор (offset пагинация через start/next)
     last_offset = validate_sync_cursor(conn, entity_key, table)
+    writer = _SyncWriter(conn, entity_key, table, col_order, buffered=_is_unlimited(limit))
     
     started = time.time()
     while True:
@@ -2608,66 +3282,56 @@ def sync_entity_data_lead(conn, limit: int, time_budget_sec: int) -> Dict[str, A
         items, nxt = normalize_list_result(resp)
         
         if not items:
-            set_sync_cursor(conn, entity_key, last_offset if last_offset > 0 else 0)
+            writer.set_cursor(last_offset if last_offset > 0 else 0)
             break
         
         rows = []
         for it in items:
-            lead_id = it.get("ID") or it.get("id")
-            if not lead_id:
-                continue
-            
-            row = {c: None for c in col_order}
-            row["id"] = int(lead_id)
-            row["raw"] = Json(it)
-            
-            for b24_field, meta in colmap.items():
-                col = meta["column_name"]
-                b24_type = meta.get("b24_type")
-                is_multiple = meta.get("is_multiple", False)
-                
-                value = None
-                if b24_field in it:
-                    value = it[b24_field]
-                elif b24_field.upper() in it:
-                    value = it[b24_field.upper()]
-                elif b24_field.lower() in it:
-                    value = it[b24_field.lower()]
-                
-                if value is not None:
-                    row[col] = normalize_value(value, b24_type, is_multiple)
-            
-            row_values = [row.get(c) for c in col_order]
-            rows.append(row_values)
+            r = builder.build(it)
+            if r:
+                rows.append(r)
         
-        upsert_rows(conn, table, col_order, rows)
         total += len(rows)
         
-        # Пагинация через start/next
+        # Пагинация через start/next (курсор сдвигается вместе с записью строк)
         if nxt is not None:
             last_offset = nxt
-            set_sync_cursor(conn, entity_key, last_offset)
+            writer.write(rows, cursor=last_offset)
         else:
             last_seen_id = rows[-1][col_order.index("id")] if rows else last_offset
-            set_sync_cursor(conn, entity_key, last_seen_id if last_seen_id else last_offset)
+            writer.write(rows, cursor=last_seen_id if last_seen_id else last_offset)
             break
         
         if (not _is_unlimited(limit)) and total >= limit:
             break
     
-    return {"entity": "lead", "table": table, "rows_upserted": total, "cursor_now": get_sync_cursor(conn, entity_key)}
+    writer.flush()
+
+    # Изменённые с прошлого запуска (keyset по DATE_MODIFY, ID от high-water mark)
+    modified, written_modified = sync_modified_pass(
+        conn, entity_key, table, col_order, builder.build, uf_fields, started + time_budget_sec,
+    )
+    total += modified
+    written = writer.written + written_modified
+    return {
+        "entity": "lead", "table": table, "rows_upserted": total,
+        "rows_written": written, "rows_skipped": total - written,
+        "rows_modified": modified,
+        "cursor_now": get_sync_cursor(conn, entity_key),
+    }
 
 def sync_entity_data_smart(conn, entity_type_id: int, limit: int, time_budget_sec: int) -> Dict[str, Any]:
     entity_key = f"sp:{entity_type_id}"
     table = table_name_for_entity(entity_key)
 
     ensure_pk_index(conn, table)
-    colmap = load_entity_colmap(conn, entity_key)
-    col_order = ["id", "raw"] + sorted({m["column_name"] for m in colmap.values()})
+    builder = get_row_builder(conn, entity_key)
+    col_order = builder.col_order
 
     total = 0
     # Валидируем курсор (offset пагинация через start/next)
     last_offset = validate_sync_cursor(conn, entity_key, table)
+    writer = _SyncWriter(conn, entity_key, table, col_order, buffered=_is_unlimited(limit))
 
     started = time.time()
     while True:
@@ -2678,63 +3342,147 @@ def sync_entity_data_smart(conn, entity_type_id: int, limit: int, time_budget_se
         items, nxt = normalize_list_result(resp)
 
         if not items:
-            set_sync_cursor(conn, entity_key, last_offset if last_offset > 0 else 0)
+            writer.set_cursor(last_offset if last_offset > 0 else 0)
             break
 
         rows = []
         for it in items:
-            item_id = it.get("id") or it.get("ID")
-            if not item_id:
-                continue
-            
-            row = {c: None for c in col_order}
-            row["id"] = int(item_id)
-            row["raw"] = Json(it)
-
-            for b24_field, meta in colmap.items():
-                col = meta["column_name"]
-                b24_type = meta.get("b24_type")
-                is_multiple = meta.get("is_multiple", False)
-                
-                # Просто берем значение из Bitrix и сохраняем в базу
-                value = None
-                
-                # Проверяем в разных местах и регистрах
-                if b24_field in it:
-                    value = it[b24_field]
-                elif isinstance(it.get("fields"), dict) and b24_field in it["fields"]:
-                    value = it["fields"][b24_field]
-                elif b24_field.upper() in it:
-                    value = it[b24_field.upper()]
-                elif b24_field.lower() in it:
-                    value = it[b24_field.lower()]
-                elif isinstance(it.get("fields"), dict) and b24_field.upper() in it["fields"]:
-                    value = it["fields"][b24_field.upper()]
-                elif isinstance(it.get("fields"), dict) and b24_field.lower() in it["fields"]:
-                    value = it["fields"][b24_field.lower()]
-                
-                if value is not None:
-                    row[col] = normalize_value(value, b24_type, is_multiple)
-
-            rows.append([row[c] for c in col_order])
-
-        upsert_rows(conn, table, col_order, rows)
+            r = builder.build(it)
+            if r:
+                rows.append(r)
+
         total += len(rows)
 
-        # Пагинация через start/next
+        # Пагинация через start/next (курсор сдвигается вместе с записью строк)
         if nxt is not None:
             last_offset = nxt
-            set_sync_cursor(conn, entity_key, last_offset)
+            writer.write(rows, cursor=last_offset)
         else:
             last_seen_id = rows[-1][col_order.index("id")] if rows else last_offset
-            set_sync_cursor(conn, entity_key, last_seen_id if last_seen_id else last_offset)
+            writer.write(rows, cursor=last_seen_id if last_seen_id else last_offset)
             break
         
         if (not _is_unlimited(limit)) and total >= limit:
             break
     
-    return {"entity": entity_key, "table": table, "rows_upserted": total, "cursor_now": get_sync_cursor(conn, entity_key)}
+    writer.flush()
+
+    # Изменённые с прошлого запуска (keyset по updatedTime, id от high-water mark)
+    modified, written_modified = sync_modified_pass(
+        conn, entity_key, table, col_order, builder.build, [], started + time_budget_sec,
+    )
+    total += modified
+    written = writer.written + written_modified
+    return {
+        "entity": entity_key, "table": table, "rows_upserted": total,
+        "rows_written": written, "rows_skipped": total - written,
+        "rows_modified": modified,
+        "cursor_now": get_sync_cursor(conn, entity_key),
+    }
+
+
+
+def _estimate_sync_backlog(conn, smart_ids: List[int]) -> Dict[str, int]:
+    """
+    Отставание каждой сущности в страницах по 50: сколько элементов в Bitrix с ID больше курсора
+    плюс изменённых после high-water mark (sync_modified_pass). Один batch-запрос на все сущности;
+    при сбое — пустой dict.
+    """
+    commands: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    entity_keys = ["deal", "contact", "lead"] + [f"sp:{etid}" for etid in smart_ids]
+    for ek in entity_keys:
+        ts_field, id_field = _modified_fields(ek)
+        hwm_ts, _ = get_modified_cursor(conn, ek)
+        since = (hwm_ts - timedelta(seconds=SYNC_MODIFIED_OVERLAP_SEC)).isoformat()
+        if ek.startswith("sp:"):
+            etid = int(ek.split(":", 1)[1])
+            commands[ek] = ("crm.item.list", {
+                "entityTypeId": etid, "filter": {">id": get_sync_cursor(conn, ek)}, "select": ["id"], "order": {"id": "ASC"},
+            })
+            commands[f"{ek}_modified"] = ("crm.item.list", {
+                "entityTypeId": etid, "filter": {">=" + ts_field: since}, "select": ["id"],
+            })
+        else:
+            method = f"crm.{ek}.list"
+            commands[ek] = (method, {"filter": {">ID": get_sync_cursor(conn, ek)}, "select": ["ID"], "order": {"ID": "ASC"}})
+            commands[f"{ek}_modified"] = (method, {"filter": {">=" + ts_field: since}, "select": [id_field]})
+    try:
+        results = b24.call_batch(commands)
+    except Exception as e:
+        print(f"WARNING: sync_data: backlog estimate failed: {e}", file=sys.stderr, flush=True)
+        return {}
+
+    def _pages(key: str) -> Optional[int]:
+        r = results.get(key) or {}
+        if r.get("error") or r.get("total") is None:
+            return None
+        return (int(r["total"]) + 49) // 50
+
+    out: Dict[str, int] = {}
+    for ek in entity_keys:
+        pages = _pages(ek)
+        modified_pages = _pages(f"{ek}_modified")
+        if pages is None and modified_pages is None:
+            continue
+        out[ek] = (pages or 0) + (modified_pages or 0)
+    return out
+
 
+def _run_sync_schedule(
+    tasks: List[Tuple[str, Any, Dict[str, Any]]],
+    backlog: Dict[str, int],
+    time_budget_sec: int,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Запускает sync_entity_data_* параллельно (SYNC_PARALLELISM потоков, у каждого своё соединение из пула).
+    Общий ресурс — SYNC_PARALLELISM * time_budget_sec "поток-секунд"; каждой сущности достаётся доля по весу
+    (страницы отставания + 1), но не больше time_budget_sec и не меньше SYNC_MIN_ENTITY_BUDGET_SEC.
+    Сущности с большим бюджетом стартуют первыми. В результат каждой сущности добавляется
+    backlog_pages, budget_sec, elapsed_sec, rows_per_sec.
+    """
+    weights = {ek: 1 + max(0, int(backlog.get(ek, 0))) for ek, _, _ in tasks}
+    total_weight = sum(weights.values()) or 1
+    pool_sec = SYNC_PARALLELISM * max(1, time_budget_sec)
+    budgets = {
+        ek: int(min(max(1, time_budget_sec), max(SYNC_MIN_ENTITY_BUDGET_SEC, pool_sec * weights[ek] / total_weight)))
+        for ek in weights
+    }
+    ordered = sorted(tasks, key=lambda t: budgets[t[0]], reverse=True)
+
+    def _run_one(entity_key: str, fn: Any, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.time()
+        conn_e = pg_conn()
+        try:
+            res = fn(conn_e, time_budget_sec=budgets[entity_key], **kwargs)
+        except Exception as e:
+            print(f"ERROR: sync_data: {entity_key} failed: {e}", file=sys.stderr, flush=True)
+            traceback.print_exc()
+            res = {"entity": entity_key, "error": repr(e), "rows_upserted": 0}
+        finally:
+            conn_e.close()
+        elapsed = time.time() - started
+        res["backlog_pages"] = backlog.get(entity_key)
+        res["budget_sec"] = budgets[entity_key]
+        res["elapsed_sec"] = round(elapsed, 2)
+        res["rows_per_sec"] = round(int(res.get("rows_upserted") or 0) / elapsed, 1) if elapsed > 0 else None
+        return res
+
+    results: Dict[str, Dict[str, Any]] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_PARALLELISM, thread_name_prefix="sync") as ex:
+        # copy_context: потоки пула наследуют класс приоритета Bitrix (bitrix_priority) вызывающего
+        futures = {
+            ex.submit(contextvars.copy_context().run, _run_one, ek, fn, kwargs): ek
+            for ek, fn, kwargs in ordered
+        }
+        for fut in concurrent.futures.as_completed(futures):
+            res = fut.result()
+            results[futures[fut]] = res
+            print(
+                f"INFO: sync_data: {futures[fut]}: {res.get('rows_upserted', 0)} rows in {res['elapsed_sec']}s "
+                f"(budget {res['budget_sec']}s, backlog {res['backlog_pages']} pages, {res['rows_per_sec']} rows/s)",
+                file=sys.stderr, flush=True,
+            )
+    return results
 
 
 def sync_data(deal_limit: int, smart_limit: int, time_budget_sec: int, contact_limit: int = 0, lead_limit: int = 0) -> Dict[str, Any]:
@@ -2771,25 +3519,24 @@ def sync_data(deal_limit: int, smart_limit: int, time_budget_sec: int, contact_l
             """)
             smart_ids = [r[0] for r in cur.fetchall() if r[0] is not None]
 
-        # split time budget: deals get 30%, contacts and leads get 20% each, smart share the rest (30%)
-        t0 = max(1, int(time_budget_sec * 0.3))  # deals
-        t1 = max(1, int(time_budget_sec * 0.2))  # contacts
-        t2 = max(1, int(time_budget_sec * 0.2))  # leads
-        t_rest = max(1, time_budget_sec - t0 - t1 - t2)  # smart processes
-        per_smart = max(1, t_rest // max(1, len(smart_ids)))
+        # Планировщик: сущности синхронизируются параллельно (общий лимитер Bitrix),
+        # бюджет времени делится по отставанию каждой сущности, а не фиксированными 30/20/20/30
+        tasks: List[Tuple[str, Any, Dict[str, Any]]] = [
+            ("deal", sync_entity_data_deal, {"limit": deal_limit}),
+            ("contact", sync_entity_data_contact, {"limit": contact_limit}),
+            ("lead", sync_entity_data_lead, {"limit": lead_limit}),
+        ] + [
+            (f"sp:{int(etid)}", sync_entity_data_smart, {"entity_type_id": int(etid), "limit": smart_limit})
+            for etid in smart_ids
+        ]
+        backlog = _estimate_sync_backlog(conn, [int(x) for x in smart_ids])
+        results = _run_sync_schedule(tasks, backlog, time_budget_sec)
+
+        deal_res = results["deal"]
+        contact_res = results["contact"]
+        lead_res = results["lead"]
+        smart_res = [results[f"sp:{int(etid)}"] for etid in smart_ids]
 
-        # Синхронизируем ВСЕ сделки (без фильтрации по статусу)
-        deal_res = sync_entity_data_deal(conn, limit=deal_limit, time_budget_sec=t0)
-        
-        # Синхронизируем контакты
-        contact_res = sync_entity_data_contact(conn, limit=contact_limit, time_budget_sec=t1)
-        
-        # Синхронизируем лиды
-        lead_res = sync_entity_data_lead(conn, limit=lead_limit, time_budget_sec=t2)
-        
-        # Синхронизируем смарт-процессы
-        smart_res = [sync_entity_data_smart(conn, int(etid), limit=smart_limit, time_budget_sec=per_smart) for etid in smart_ids]
-        
         # Автоматически обновляем классификатор источников после синхронизации сделок
         # Это дополняет классификатор новыми источниками из сделок
         try:
@@ -2799,12 +3546,16 @@ def sync_data(deal_limit: int, smart_limit: int, time_budget_sec: int, contact_l
             print(f"WARNING: sync_data: Failed to update sources classifier: {e}", file=sys.stderr, flush=True)
             traceback.print_exc()
 
+        all_res = [deal_res, contact_res, lead_res] + smart_res
         return {
             "ok": True, 
             "deal": deal_res, 
             "contact": contact_res,
             "lead": lead_res,
-            "smart_processes": smart_res
+            "smart_processes": smart_res,
+            "rows_written": sum(int(r.get("rows_written") or 0) for r in all_res),
+            "rows_skipped": sum(int(r.get("rows_skipped") or 0) for r in all_res),
+            "parallelism": SYNC_PARALLELISM,
         }
     finally:
         conn.close()
@@ -2816,6 +3567,7 @@ _sync_lock = threading.Lock()
 _last_full_update_time = 0
 FULL_UPDATE_INTERVAL_SEC = int(os.getenv("FULL_UPDATE_INTERVAL_SEC", "3600"))  # 1 час по умолчанию
 
+@bitrix_priority("low")
 def background_loop():
     global _last_full_update_time
     while True:
@@ -2879,39 +3631,13 @@ def background_loop():
                                 
                                 if deals_to_update:
                                     updated = 0
+                                    _user_name_cache.update(_fetch_user_names(
+                                        [str(a).strip() for _, a in deals_to_update if str(a).strip() not in _user_name_cache]
+                                    ))
                                     for deal_id, assigned_by_id in deals_to_update:
                                         user_id_str = str(assigned_by_id).strip()
-                                        
-                                        if user_id_str in _user_name_cache:
-                                            assigned_by_name = _user_name_cache[user_id_str]
-                                        else:
-                                            try:
-                                                user_resp = b24.call("user.get", {"ID": user_id_str})
-                                                if user_resp and "result" in user_resp and len(user_resp["result"]) > 0:
-                                                    user = user_resp["result"][0]
-                                                    name = user.get("NAME", "").strip()
-                                                    last_name = user.get("LAST_NAME", "").strip()
-                                                    if name and last_name:
-                                                        assigned_by_name = f"{name} {last_name}"
-                                                    elif name:
-                                                        assigned_by_name = name
-                                                    elif last_name:
-                                                        assigned_by_name = last_name
-                                                    elif user.get("FULL_NAME"):
-                                                        assigned_by_name = str(user.get("FULL_NAME")).strip()
-                                                    elif user.get("LOGIN"):
-                                                        assigned_by_name = str(user.get("LOGIN")).strip()
-                                                    else:
-                                                        assigned_by_name = None
-                                                    _user_name_cache[user_id_str] = assigned_by_name or user_id_str
-                                                else:
-                                                    assigned_by_name = None
-                                                    _user_name_cache[user_id_str] = user_id_str
-                                            except Exception as e:
-                                                print(f"WARNING: Failed to get user name for deal {deal_id}: {e}", file=sys.stderr, flush=True)
-                                                assigned_by_name = None
-                                                _user_name_cache[user_id_str] = user_id_str
-                                        
+                                        assigned_by_name = _user_name_cache.get(user_id_str)
+
                                         if assigned_by_name and assigned_by_name != user_id_str:
                                             with conn.cursor() as cur:
                                                 cur.execute(f"""
@@ -2942,6 +3668,41 @@ def background_loop():
                     _sync_lock.release()
         time.sleep(AUTO_SYNC_INTERVAL_SEC)
 
+def _ensure_initial_sync_job() -> Dict[str, Any]:
+    """Ставит задачу полной загрузки, если full_resync ещё ни разу не ставилась (одна на все процессы — advisory lock)."""
+    conn = pg_conn()
+    try:
+        ensure_sync_jobs_schema(conn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(hashtext('b24_sync_jobs_initial'))")
+            locked = bool(cur.fetchone()[0])
+        conn.commit()
+        if not locked:
+            return {"initial_job": None, "reason": "another process is scheduling the initial load"}
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, status FROM b24_sync_jobs
+                    WHERE kind = 'full_resync'
+                    ORDER BY id DESC
+                    LIMIT 1
+                """)
+                row = cur.fetchone()
+            conn.commit()
+            if row:
+                # незавершённую продолжит _resume_sync_jobs_thread, paused/failed — POST /sync/jobs/{id}/resume
+                return {"initial_job": int(row[0]), "status": row[1], "created": False}
+            job = create_sync_job()
+            return {"initial_job": job.get("id") if job else None, "created": True}
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(hashtext('b24_sync_jobs_initial'))")
+            conn.commit()
+    finally:
+        conn.close()
+
+
+@bitrix_priority("low")
 def _initial_sync_thread():
     """Запускает начальную синхронизацию в отдельном потоке, чтобы не блокировать старт сервиса."""
     # Небольшая задержка, чтобы сервис успел запуститься
@@ -2965,24 +3726,741 @@ def _initial_sync_thread():
         except Exception as e:
             print(f"WARNING: _initial_sync_thread: reference data sync failed (will continue): {e}", file=sys.stderr, flush=True)
         
-        # Затем синхронизируем данные с увеличенным time_budget для начальной загрузки
-        initial_sync_result = sync_data(
-            deal_limit=0,  # Без ограничений для начальной синхронизации
-            smart_limit=0,
-            time_budget_sec=300,  # 5 минут для начальной синхронизации
-            contact_limit=0,  # Без ограничений для начальной синхронизации
-            lead_limit=0  # Без ограничений для начальной синхронизации
-        )
-        print(f"INFO: _initial_sync_thread: Initial sync completed: {initial_sync_result}", file=sys.stderr, flush=True)
+        # Начальная загрузка данных — задачей b24_sync_jobs: чекпоинты по сущностям, прогресс в GET /sync/jobs,
+        # после рестарта продолжается с места остановки (_resume_sync_jobs_thread), а не начинается заново.
+        # Задача ставится один раз — пока нет ни одной full_resync; дальше догоняет background_loop.
+        initial_sync_result = _ensure_initial_sync_job()
+        print(f"INFO: _initial_sync_thread: Initial load job: {initial_sync_result}", file=sys.stderr, flush=True)
     except Exception as e:
         print(f"WARNING: _initial_sync_thread: Initial sync failed: {e}", file=sys.stderr, flush=True)
         traceback.print_exc()
 
 
+# -----------------------------
+# Full resync jobs (b24_sync_jobs)
+# -----------------------------
+# Полная пересинхронизация (с ID 0) как персистентная задача: у каждой сущности свой чекпоинт
+# (last_id прохода по ID, затем HWM прохода по изменённым), прогресс и ETA. Задачу можно поставить
+# на паузу и продолжить; после рестарта сервиса она продолжается с последнего чекпоинта.
+# kind='reconcile' — сверка удалений: тот же механизм, но из Bitrix читаются только ID
+# (раз в RECONCILE_INTERVAL_SEC задача ставится автоматически, 0 — выключено).
+SYNC_JOB_CHECKPOINT_PAGES = max(1, int(os.getenv("SYNC_JOB_CHECKPOINT_PAGES", "20")))
+SYNC_JOB_STALE_SEC = max(30, int(os.getenv("SYNC_JOB_STALE_SEC", "180")))
+SYNC_JOB_OVERLOAD_PAUSE_SEC = max(1, int(os.getenv("SYNC_JOB_OVERLOAD_PAUSE_SEC", "60")))
+RECONCILE_INTERVAL_SEC = max(0, int(os.getenv("RECONCILE_INTERVAL_SEC", "86400")))
+_SYNC_JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+_sync_jobs_active: set = set()
+# resume пришёл, пока потоки задачи ещё работали в этом процессе — перезапустить runner, когда они закончат
+_sync_jobs_resume_requested: set = set()
+_sync_jobs_active_lock = threading.Lock()
+
+
+def ensure_sync_jobs_schema(conn) -> None:
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS b24_sync_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                kind TEXT NOT NULL DEFAULT 'full_resync',
+                status TEXT NOT NULL DEFAULT 'pending',  -- pending | running | paused | done | failed
+                entities JSONB NOT NULL DEFAULT '{}'::jsonb,
+                owner TEXT,
+                last_error TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                started_at TIMESTAMPTZ,
+                heartbeat_at TIMESTAMPTZ,
+                finished_at TIMESTAMPTZ,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_b24_sync_jobs_status ON b24_sync_jobs(status);")
+    conn.commit()
+
+
+def _sync_job_entity_keys(conn) -> List[str]:
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT entity_type_id
+            FROM b24_meta_entities
+            WHERE entity_kind = 'smart_process' AND entity_type_id IS NOT NULL
+            ORDER BY entity_type_id
+        """)
+        smart_ids = [int(r[0]) for r in cur.fetchall()]
+    return ["deal", "contact", "lead"] + [f"sp:{etid}" for etid in smart_ids]
+
+
+def _load_uf_fields(conn, entity_key: str) -> List[str]:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT b24_field
+                FROM b24_meta_fields
+                WHERE entity_key = %s
+                  AND b24_field ILIKE 'uf_%%'
+            """, (entity_key,))
+            return [str(r[0]) for r in cur.fetchall() if r and r[0]]
+    except Exception as e:
+        conn.rollback()
+        print(f"WARNING: _load_uf_fields({entity_key}): {e}", file=sys.stderr, flush=True)
+        return []
+
+
+def _sync_job_list_command(entity_key: str, last_id: int, uf_fields: List[str], count_only: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """
+    Страница полного прохода по ID: filter >ID, order ID ASC, start=-1 (Bitrix не считает total — быстрее
+    на больших порталах). count_only — тот же запрос с select ID без start=-1, ради total.
+    """
+    if entity_key.startswith("sp:"):
+        params: Dict[str, Any] = {
+            "entityTypeId": int(entity_key.split(":", 1)[1]),
+            "select": ["id"] if count_only else ["*"],
+            "order": {"id": "ASC"},
+            "filter": {">id": int(last_id)},
+        }
+        method = "crm.item.list"
+    elif entity_key == "deal":
+        params = _b24_deal_list_params(start_id=int(last_id), uf_fields=uf_fields, order={"ID": "ASC"})
+        if count_only:
+            params["select"] = ["ID"]
+        method = "crm.deal.list"
+    else:
+        params = {
+            "select": ["ID"] if count_only else ["*"] + list(uf_fields or []),
+            "order": {"ID": "ASC"},
+            "filter": {">ID": int(last_id)},
+        }
+        method = f"crm.{entity_key}.list"
+    if not count_only:
+        params["start"] = -1
+    else:
+        params.pop("start", None)
+    return method, params
+
+
+def _sync_job_count_totals(entity_keys: List[str]) -> Dict[str, int]:
+    """Сколько элементов у каждой сущности в Bitrix (один batch-запрос); для прогресса и ETA."""
+    try:
+        results = b24.call_batch({ek: _sync_job_list_command(ek, 0, [], count_only=True) for ek in entity_keys})
+    except Exception as e:
+        print(f"WARNING: sync job: total count failed: {e}", file=sys.stderr, flush=True)
+        return {}
+    out: Dict[str, int] = {}
+    for ek in entity_keys:
+        r = results.get(ek) or {}
+        if not r.get("error") and r.get("total") is not None:
+            out[ek] = int(r["total"])
+    return out
+
+
+def _sync_job_view(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Строка b24_sync_jobs -> ответ API: прогресс (%) и ETA по каждой сущности и по задаче."""
+    entities = row.get("entities") if isinstance(row.get("entities"), dict) else {}
+    status = row.get("status")
+    ent_out: Dict[str, Any] = {}
+    total_all = 0
+    done_all = 0
+    etas: List[float] = []
+    eta_unknown = False
+    for ek, st in entities.items():
+        total_e = int(st.get("total") or 0)
+        done_e = int(st.get("rows_done") or 0)
+        active = float(st.get("active_sec") or 0)
+        finished = st.get("phase") == "done"
+        rate = (done_e / active) if active > 0 else None
+        eta_e: Optional[float] = 0.0 if finished else None
+        if not finished and rate and total_e:
+            eta_e = max(0.0, (total_e - done_e) / rate)
+        if not finished:
+            if eta_e is None:
+                eta_unknown = True
+            else:
+                etas.append(eta_e)
+        total_all += total_e
+        done_all += min(done_e, total_e) if total_e else done_e
+        ent_out[ek] = {
+            **st,
+            "progress_pct": 100.0 if finished else (min(99.9, round(done_e * 100.0 / total_e, 1)) if total_e else None),
+            "rows_per_sec": round(rate, 1) if rate else None,
+            "eta_sec": int(eta_e) if eta_e is not None else None,
+        }
+    if status == "done":
+        progress = 100.0
+    else:
+        progress = min(99.9, round(done_all * 100.0 / total_all, 1)) if total_all else None
+    # сущности идут параллельно — ETA задачи = самая долгая из оставшихся
+    eta = None if (eta_unknown or status not in ("running", "pending")) else int(max(etas or [0.0]))
+
+    def _ts(v: Any) -> Any:
+        return v.isoformat() if isinstance(v, datetime) else v
+
+    return {
+        "id": row.get("id"),
+        "kind": row.get("kind"),
+        "status": status,
+        "progress_pct": progress,
+        "eta_sec": eta,
+        "rows_done": done_all,
+        "rows_total_estimate": total_all,
+        "owner": row.get("owner"),
+        "last_error": row.get("last_error"),
+        "created_at": _ts(row.get("created_at")),
+        "started_at": _ts(row.get("started_at")),
+        "heartbeat_at": _ts(row.get("heartbeat_at")),
+        "finished_at": _ts(row.get("finished_at")),
+        "entities": ent_out,
+    }
+
+
+def _sync_job_fetch(conn, job_id: int) -> Optional[Dict[str, Any]]:
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("SELECT * FROM b24_sync_jobs WHERE id = %s", (int(job_id),))
+        row = cur.fetchone()
+    conn.commit()
+    return dict(row) if row else None
+
+
+def create_sync_job(entity_keys: Optional[List[str]] = None, kind: str = "full_resync") -> Dict[str, Any]:
+    """Создаёт задачу полной пересинхронизации (или сверки удалений, kind='reconcile') и запускает её в фоне."""
+    conn = pg_conn()
+    try:
+        ensure_meta_tables(conn)
+        ensure_sync_jobs_schema(conn)
+        keys = list(dict.fromkeys(entity_keys or _sync_job_entity_keys(conn)))
+        totals = _sync_job_count_totals(keys)
+        entities = {
+            ek: {
+                "phase": "ids",
+                "last_id": 0,
+                "total": totals.get(ek),
+                "rows_done": 0,
+                "active_sec": 0.0,
+                "error": None,
+            }
+            for ek in keys
+        }
+        if kind == "reconcile":
+            for st in entities.values():
+                st["rows_deleted"] = 0
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO b24_sync_jobs (kind, status, entities) VALUES (%s, 'pending', %s) RETURNING id",
+                (kind, Json(entities)),
+            )
+            job_id = int(cur.fetchone()[0])
+        conn.commit()
+    finally:
+        conn.close()
+    start_sync_job_runner(job_id)
+    return get_sync_job(job_id)
+
+
+def get_sync_job(job_id: int) -> Optional[Dict[str, Any]]:
+    conn = pg_conn()
+    try:
+        ensure_sync_jobs_schema(conn)
+        row = _sync_job_fetch(conn, job_id)
+        return _sync_job_view(row) if row else None
+    finally:
+        conn.close()
+
+
+def _sync_job_claim(conn, job_id: int) -> bool:
+    """Забрать задачу в работу: pending или running с протухшим heartbeat (процесс-владелец умер)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE b24_sync_jobs
+            SET status = 'running', owner = %s, heartbeat_at = now(), updated_at = now(),
+                started_at = COALESCE(started_at, now()), last_error = NULL
+            WHERE id = %s
+              AND (status = 'pending'
+                   OR (status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < now() - (%s || ' seconds')::interval)))
+            RETURNING id
+        """, (_SYNC_JOB_OWNER, int(job_id), SYNC_JOB_STALE_SEC))
+        ok = cur.fetchone() is not None
+    conn.commit()
+    return ok
+
+
+def _sync_job_checkpoint(conn, job_id: int, entity_key: str, state: Dict[str, Any]) -> str:
+    """
+    Сохраняет чекпоинт сущности (+heartbeat) и возвращает текущий статус задачи (для паузы).
+    Только пока задача числится за этим процессом: если её забрал другой (_sync_job_claim по протухшему
+    heartbeat) — ничего не пишем и возвращаем "lost", поток сущности останавливается.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE b24_sync_jobs
+            SET entities = jsonb_set(entities, ARRAY[%s]::text[], %s::jsonb),
+                heartbeat_at = now(), updated_at = now()
+            WHERE id = %s AND owner = %s
+            RETURNING status
+        """, (entity_key, Json(state), int(job_id), _SYNC_JOB_OWNER))
+        row = cur.fetchone()
+    conn.commit()
+    return str(row[0]) if row else "lost"
+
+
+def _sync_job_should_stop(status: str) -> bool:
+    # paused / failed / done / lost — поток сущности выходит на чекпоинте
+    return status not in ("pending", "running")
+
+
+def _sync_job_heartbeat_loop(job_id: int, stop_event: threading.Event) -> None:
+    """
+    heartbeat задачи, пока работают потоки сущностей: ожидание токена low-priority, OVERLOAD-паузы и
+    длинный sync_modified_pass идут без чекпоинтов, но не должны выглядеть как умерший процесс.
+    """
+    while not stop_event.wait(SYNC_JOB_STALE_SEC / 3.0):
+        try:
+            conn = pg_conn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE b24_sync_jobs SET heartbeat_at = now()
+                        WHERE id = %s AND owner = %s
+                    """, (int(job_id), _SYNC_JOB_OWNER))
+                    owned = (cur.rowcount or 0) > 0
+                conn.commit()
+            finally:
+                conn.close()
+            if not owned:
+                return
+        except Exception as e:
+            logi(f"WARNING: sync job {job_id}: heartbeat failed: {e}")
+
+
+def _run_sync_job_entity(job_id: int, entity_key: str, state: Dict[str, Any]) -> None:
+    """Проход одной сущности: по ID от чекпоинта до конца, затем изменённые после high-water mark (sync_modified_pass)."""
+    conn = pg_conn()
+    try:
+        table = table_name_for_entity(entity_key)
+        ensure_pk_index(conn, table)
+        has_abn = False
+        if entity_key == "deal":
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT 1
+                    FROM information_schema.columns
+                    WHERE table_name = %s AND column_name = 'assigned_by_name'
+                """, (table,))
+                has_abn = cur.fetchone() is not None
+        builder = get_row_builder(conn, entity_key, ("assigned_by_name",) if has_abn else ())
+        abn_idx = builder.index.get("assigned_by_name") if has_abn else None
+        uf_fields = _load_uf_fields(conn, entity_key) if not entity_key.startswith("sp:") else []
+
+        buf_rows: List[List[Any]] = []
+        pages = 0
+        seg_started = time.time()
+        overloads = 0
+
+        def _checkpoint() -> str:
+            nonlocal buf_rows, pages, seg_started
+            if buf_rows:
+                upsert_rows(conn, table, builder.col_order, buf_rows)
+                state["rows_done"] = int(state.get("rows_done") or 0) + len(buf_rows)
+            now = time.time()
+            state["active_sec"] = round(float(state.get("active_sec") or 0) + (now - seg_started), 1)
+            seg_started = now
+            buf_rows = []
+            pages = 0
+            if state["phase"] != "ids" and int(state.get("last_id") or 0) > get_sync_cursor(conn, entity_key):
+                # проход по ID закончен — инкрементальному синку не нужно заново идти по тем же ID
+                set_sync_cursor(conn, entity_key, int(state["last_id"]))
+            return _sync_job_checkpoint(conn, job_id, entity_key, state)
+
+        def _fetch(method: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            nonlocal overloads
+            resp = b24.call(method, params)
+            if isinstance(resp, dict) and resp.get("error") == "OVERLOAD_LIMIT":
+                overloads += 1
+                if overloads > 5:
+                    raise RuntimeError("Bitrix OVERLOAD_LIMIT (job paused on this entity, resume later)")
+                time.sleep(SYNC_JOB_OVERLOAD_PAUSE_SEC)
+                return None
+            overloads = 0
+            return resp
+
+        def _add(items: List[Dict[str, Any]]) -> None:
+            for it in items:
+                r = builder.build(it)
+                if not r:
+                    continue
+                if abn_idx is not None:
+                    r[abn_idx] = _deal_assigned_by_name(it)
+                buf_rows.append(r)
+
+        while state["phase"] == "ids":
+            method, params = _sync_job_list_command(entity_key, int(state["last_id"]), uf_fields)
+            resp = _fetch(method, params)
+            if resp is None:
+                if _sync_job_should_stop(_checkpoint()):
+                    return
+                continue
+            items, _ = normalize_list_result(resp)
+            _add(items)
+            ids = [_extract_int(it.get("ID") or it.get("id")) for it in items]
+            max_id = max([i for i in ids if i] or [0])
+            if max_id > int(state["last_id"]):
+                state["last_id"] = max_id
+            pages += 1
+            if len(items) < 50:
+                state["phase"] = "modified"
+            if pages >= SYNC_JOB_CHECKPOINT_PAGES or state["phase"] != "ids":
+                if _sync_job_should_stop(_checkpoint()):
+                    return
+
+        if state["phase"] == "today":
+            # задачи, созданные до перехода на high-water mark
+            state["phase"] = "modified"
+            for k in ("today_from", "today_offset", "today_total"):
+                state.pop(k, None)
+        if state["phase"] == "modified":
+            # изменённые во время прохода по ID — keyset от HWM (b24_meta_sync_cursor), без offset по
+            # сдвигающейся выборке. Не успели до deadline — остаток дочитает инкрементальный синк с того же HWM
+            def _build(it: Dict[str, Any]) -> Optional[List[Any]]:
+                r = builder.build(it)
+                if r and abn_idx is not None:
+                    r[abn_idx] = _deal_assigned_by_name(it)
+                return r
+
+            if _sync_job_should_stop(_checkpoint()):
+                return
+            modified, _ = sync_modified_pass(
+                conn, entity_key, table, builder.col_order, _build, uf_fields, time.time() + SYNC_JOB_STALE_SEC / 2,
+            )
+            state["rows_done"] = int(state.get("rows_done") or 0) + modified
+            state["phase"] = "done"
+            _checkpoint()
+    except Exception as e:
+        state["error"] = repr(e)
+        try:
+            conn.rollback()
+            _sync_job_checkpoint(conn, job_id, entity_key, state)
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+
+def _run_reconcile_entity(job_id: int, entity_key: str, state: Dict[str, Any]) -> None:
+    """
+    Сверка удалений одной сущности: страницы только с ID из Bitrix (>ID, start=-1) и на каждую —
+    один DELETE по диапазону (предыдущий ID, последний ID страницы] тех локальных строк, которых нет
+    в странице. Строки новее последнего ID в Bitrix не трогаем: это может быть элемент, созданный
+    уже после чтения списка (удалится следующей сверкой, если его действительно нет).
+    """
+    conn = pg_conn()
+    try:
+        table = table_name_for_entity(entity_key)
+        ensure_pk_index(conn, table)
+        pages = 0
+        seg_started = time.time()
+        overloads = 0
+
+        def _checkpoint() -> str:
+            nonlocal pages, seg_started
+            now = time.time()
+            state["active_sec"] = round(float(state.get("active_sec") or 0) + (now - seg_started), 1)
+            seg_started = now
+            pages = 0
+            return _sync_job_checkpoint(conn, job_id, entity_key, state)
+
+        while state["phase"] == "ids":
+            remaining = bitrix_circuit_remaining()
+            if remaining > 0:
+                time.sleep(min(remaining, SYNC_JOB_OVERLOAD_PAUSE_SEC))
+                if _sync_job_should_stop(_checkpoint()):
+                    return
+                continue
+            method, params = _sync_job_list_command(entity_key, int(state["last_id"]), [], count_only=True)
+            params["start"] = -1
+            resp = b24.call(method, params)
+            if isinstance(resp, dict) and resp.get("error"):
+                if resp.get("error") != "OVERLOAD_LIMIT":
+                    raise RuntimeError(f"Bitrix {method}: {resp.get('error')}: {resp.get('error_description')}")
+                overloads += 1
+                if overloads > 5:
+                    raise RuntimeError("Bitrix OVERLOAD_LIMIT (job paused on this entity, resume later)")
+                time.sleep(SYNC_JOB_OVERLOAD_PAUSE_SEC)
+                continue
+            overloads = 0
+            items, _ = normalize_list_result(resp)
+            ids = sorted(i for i in (_extract_int(it.get("ID") or it.get("id")) for it in items) if i)
+            lo = int(state["last_id"])
+            if ids:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f'DELETE FROM "{table}" WHERE id > %s AND id <= %s AND id <> ALL(%s)',
+                        (lo, ids[-1], ids),
+                    )
+                    deleted = int(cur.rowcount or 0)
+                if deleted:
+                    mark_counts_dirty(conn, table)
+                conn.commit()
+                if deleted:
+                    logi(f"INFO: reconcile {entity_key}: deleted {deleted} rows missing in Bitrix (id {lo}..{ids[-1]})")
+                state["last_id"] = ids[-1]
+                state["rows_done"] = int(state.get("rows_done") or 0) + len(ids)
+                state["rows_deleted"] = int(state.get("rows_deleted") or 0) + deleted
+            pages += 1
+            if len(items) < 50:
+                state["phase"] = "done"
+            if pages >= SYNC_JOB_CHECKPOINT_PAGES or state["phase"] != "ids":
+                if _sync_job_should_stop(_checkpoint()):
+                    return
+    except Exception as e:
+        state["error"] = repr(e)
+        try:
+            conn.rollback()
+            _sync_job_checkpoint(conn, job_id, entity_key, state)
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+
+@bitrix_priority("low")
+def _run_sync_job(job_id: int) -> None:
+    """Выполняет задачу: незавершённые сущности параллельно (SYNC_PARALLELISM), каждая со своего чекпоинта."""
+    with _sync_jobs_active_lock:
+        if job_id in _sync_jobs_active:
+            return
+        _sync_jobs_active.add(job_id)
+    try:
+        conn = pg_conn()
+        try:
+            ensure_sync_jobs_schema(conn)
+            if not _sync_job_claim(conn, job_id):
+                return
+            row = _sync_job_fetch(conn, job_id) or {}
+        finally:
+            conn.close()
+
+        entities = row.get("entities") if isinstance(row.get("entities"), dict) else {}
+        run_entity = _run_reconcile_entity if row.get("kind") == "reconcile" else _run_sync_job_entity
+        pending = [ek for ek, st in entities.items() if st.get("phase") != "done"]
+        for ek in pending:
+            entities[ek]["error"] = None
+        logi(f"INFO: sync job {job_id}: running {len(pending)} entities: {pending}")
+
+        errors: Dict[str, str] = {}
+        hb_stop = threading.Event()
+        threading.Thread(
+            target=_sync_job_heartbeat_loop, args=(job_id, hb_stop), daemon=True, name=f"syncjob{job_id}-hb",
+        ).start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_PARALLELISM, thread_name_prefix=f"syncjob{job_id}") as ex:
+                futures = {
+                    ex.submit(contextvars.copy_context().run, run_entity, job_id, ek, entities[ek]): ek
+                    for ek in pending
+                }
+                for fut in concurrent.futures.as_completed(futures):
+                    ek = futures[fut]
+                    try:
+                        fut.result()
+                    except Exception as e:
+                        errors[ek] = repr(e)
+                        logi(f"ERROR: sync job {job_id}: {ek} failed: {e}")
+                        traceback.print_exc()
+        finally:
+            hb_stop.set()
+
+        conn = pg_conn()
+        try:
+            row = _sync_job_fetch(conn, job_id) or {}
+            if row.get("status") == "running" and row.get("owner") == _SYNC_JOB_OWNER:
+                ents = row.get("entities") if isinstance(row.get("entities"), dict) else {}
+                if errors:
+                    status, last_error = "failed", "; ".join(f"{k}: {v}" for k, v in errors.items())
+                elif all(st.get("phase") == "done" for st in ents.values()):
+                    status, last_error = "done", None
+                else:
+                    status, last_error = "pending", None
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE b24_sync_jobs
+                        SET status = %s, last_error = %s, updated_at = now(),
+                            finished_at = CASE WHEN %s = 'done' THEN now() ELSE finished_at END
+                        WHERE id = %s AND owner = %s AND status = 'running'
+                    """, (status, last_error, status, int(job_id), _SYNC_JOB_OWNER))
+                conn.commit()
+                logi(f"INFO: sync job {job_id}: {status}")
+        finally:
+            conn.close()
+    finally:
+        with _sync_jobs_active_lock:
+            _sync_jobs_active.discard(job_id)
+            restart = job_id in _sync_jobs_resume_requested
+            _sync_jobs_resume_requested.discard(job_id)
+        if restart:
+            start_sync_job_runner(job_id)
+
+
+def start_sync_job_runner(job_id: int) -> None:
+    threading.Thread(target=_run_sync_job, args=(int(job_id),), daemon=True).start()
+
+
+def pause_sync_job(job_id: int) -> Optional[Dict[str, Any]]:
+    """Пауза: потоки задачи останавливаются на ближайшем чекпоинте."""
+    conn = pg_conn()
+    try:
+        ensure_sync_jobs_schema(conn)
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE b24_sync_jobs SET status = 'paused', updated_at = now()
+                WHERE id = %s AND status IN ('pending', 'running')
+            """, (int(job_id),))
+        conn.commit()
+        row = _sync_job_fetch(conn, job_id)
+        return _sync_job_view(row) if row else None
+    finally:
+        conn.close()
+
+
+def resume_sync_job(job_id: int) -> Optional[Dict[str, Any]]:
+    """Продолжить задачу (paused / failed / pending) с сохранённых чекпоинтов."""
+    conn = pg_conn()
+    try:
+        ensure_sync_jobs_schema(conn)
+        # под _sync_jobs_active_lock: runner этой задачи не может закончиться между проверкой и флагом
+        with _sync_jobs_active_lock:
+            still_running_here = int(job_id) in _sync_jobs_active
+            with conn.cursor() as cur:
+                # потоки, ещё не дошедшие до чекпоинта, на pending продолжают работу; остановившиеся на паузе
+                # подхватит новый runner — его запустит текущий, когда закончит (_sync_jobs_resume_requested)
+                cur.execute("""
+                    UPDATE b24_sync_jobs
+                    SET status = 'pending', last_error = NULL, updated_at = now()
+                    WHERE id = %s AND status IN ('paused', 'failed', 'pending')
+                    RETURNING id
+                """, (int(job_id),))
+                resumed = cur.fetchone() is not None
+            conn.commit()
+            if resumed and still_running_here:
+                _sync_jobs_resume_requested.add(int(job_id))
+        row = _sync_job_fetch(conn, job_id)
+    finally:
+        conn.close()
+    if row and not still_running_here and row.get("status") == "pending":
+        start_sync_job_runner(job_id)
+    return _sync_job_view(row) if row else None
+
+
+@bitrix_priority("low")
+def _resume_sync_jobs_thread() -> None:
+    """После рестарта: продолжить незавершённые задачи (running — когда heartbeat старого процесса протухнет)."""
+    time.sleep(5)
+    try:
+        conn = pg_conn()
+        try:
+            ensure_sync_jobs_schema(conn)
+            with conn.cursor() as cur:
+                cur.execute("SELECT id FROM b24_sync_jobs WHERE status IN ('pending', 'running') ORDER BY id")
+                job_ids = [int(r[0]) for r in cur.fetchall()]
+            conn.commit()
+        finally:
+            conn.close()
+        for job_id in job_ids:
+            while True:
+                _run_sync_job(job_id)
+                job = get_sync_job(job_id) or {}
+                if job.get("status") != "running" or job_id in _sync_jobs_active:
+                    break
+                # задача числится за другим (возможно, уже мёртвым) процессом — ждём, пока протухнет heartbeat
+                time.sleep(30)
+    except Exception as e:
+        logi(f"WARNING: _resume_sync_jobs_thread: {e}")
+        traceback.print_exc()
+
+@bitrix_priority("low")
+def _reconcile_scheduler_thread() -> None:
+    """Раз в RECONCILE_INTERVAL_SEC ставит задачу сверки удалений (одну на все процессы — advisory lock)."""
+    time.sleep(60)
+    while True:
+        try:
+            conn = pg_conn()
+            try:
+                ensure_sync_jobs_schema(conn)
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_try_advisory_lock(hashtext('b24_sync_jobs_reconcile'))")
+                    locked = bool(cur.fetchone()[0])
+                conn.commit()
+                if locked:
+                    try:
+                        with conn.cursor() as cur:
+                            cur.execute("""
+                                SELECT 1 FROM b24_sync_jobs
+                                WHERE kind = 'reconcile'
+                                  AND (status IN ('pending', 'running', 'paused')
+                                       OR created_at > now() - (%s || ' seconds')::interval)
+                                LIMIT 1
+                            """, (RECONCILE_INTERVAL_SEC,))
+                            due = cur.fetchone() is None
+                        conn.commit()
+                        if due:
+                            job = create_sync_job(kind="reconcile")
+                            logi(f"INFO: reconcile job {job.get('id') if job else None} scheduled")
+                    finally:
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT pg_advisory_unlock(hashtext('b24_sync_jobs_reconcile'))")
+                        conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logi(f"WARNING: _reconcile_scheduler_thread: {e}")
+            traceback.print_exc()
+        time.sleep(min(RECONCILE_INTERVAL_SEC, 3600))
+
 # -----------------------------
 # WEBHOOK-ONLY MODE (outbound Bitrix events)
 # -----------------------------
 WEBHOOK_ONLY = os.getenv("WEBHOOK_ONLY", "0") == "1"
+# Queue consumers per process (each uvicorn worker runs its own; claims never overlap)
+WEBHOOK_WORKER_CONCURRENCY = max(1, int(os.getenv("WEBHOOK_WORKER_CONCURRENCY", "2")))
+WEBHOOK_CLAIM_BATCH = max(1, int(os.getenv("WEBHOOK_CLAIM_BATCH", "50")))
+# Lease on a claimed job; after it expires a 'processing' job is considered abandoned and requeued
+WEBHOOK_LEASE_SEC = max(10, int(os.getenv("WEBHOOK_LEASE_SEC", "120")))
+# Update events are delayed by this window; repeats for the same entity inside it are dropped at enqueue
+WEBHOOK_DEBOUNCE_SEC = max(0.0, float(os.getenv("WEBHOOK_DEBOUNCE_SEC", "2")))
+# Enqueue sends NOTIFY; workers wake up on it instead of polling. The poll stays as a fallback
+# (lost connection, rows inserted by something that does not notify).
+WEBHOOK_LISTEN_ENABLED = os.getenv("WEBHOOK_LISTEN_ENABLED", "1") == "1"
+WEBHOOK_NOTIFY_CHANNEL = "b24_webhook_queue"
+WEBHOOK_FALLBACK_POLL_SEC = max(0.5, float(os.getenv("WEBHOOK_FALLBACK_POLL_SEC", "5")))
+# Receiver buffers parsed events in memory; a background flusher writes them with one multi-row INSERT
+# when WEBHOOK_BUFFER_FLUSH_SIZE events are waiting or WEBHOOK_BUFFER_FLUSH_SEC passed since the first one.
+# A full buffer (DB down / too slow) makes the receiver answer 503.
+WEBHOOK_BUFFER_MAX = max(1, int(os.getenv("WEBHOOK_BUFFER_MAX", "10000")))
+WEBHOOK_BUFFER_FLUSH_SIZE = max(1, int(os.getenv("WEBHOOK_BUFFER_FLUSH_SIZE", "500")))
+WEBHOOK_BUFFER_FLUSH_SEC = max(0.0, float(os.getenv("WEBHOOK_BUFFER_FLUSH_SEC", "0.2")))
+# Retention: 'done' rows older than WEBHOOK_RETENTION_DAYS are removed in chunks (hourly, by worker 0);
+# WEBHOOK_QUEUE_ARCHIVE=1 moves them to b24_webhook_queue_archive instead of dropping
+WEBHOOK_RETENTION_DAYS = max(1, int(os.getenv("WEBHOOK_RETENTION_DAYS", "7")))
+WEBHOOK_RETENTION_INTERVAL_SEC = max(60, int(os.getenv("WEBHOOK_RETENTION_INTERVAL_SEC", "3600")))
+WEBHOOK_RETENTION_CHUNK = max(100, int(os.getenv("WEBHOOK_RETENTION_CHUNK", "5000")))
+WEBHOOK_QUEUE_ARCHIVE = os.getenv("WEBHOOK_QUEUE_ARCHIVE", "0") == "1"
+# After WEBHOOK_MAX_ATTEMPTS failures a job becomes 'dead' (dead-letter) and waits for a manual replay;
+# retries back off exponentially with jitter up to WEBHOOK_BACKOFF_MAX_SEC
+WEBHOOK_MAX_ATTEMPTS = max(1, int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10")))
+WEBHOOK_BACKOFF_MAX_SEC = max(5, int(os.getenv("WEBHOOK_BACKOFF_MAX_SEC", "600")))
+
+# In-process counters (per uvicorn worker), exposed in /health
+_webhook_metrics: Dict[str, int] = {"enqueued": 0, "debounced": 0, "rejected": 0, "jobs_processed": 0, "entity_fetches": 0}
+_webhook_metrics_lock = threading.Lock()
+
+def _webhook_metric_add(**deltas: int) -> None:
+    with _webhook_metrics_lock:
+        for k, v in deltas.items():
+            _webhook_metrics[k] = _webhook_metrics.get(k, 0) + int(v)
+
+def webhook_queue_metrics() -> Dict[str, Any]:
+    with _webhook_metrics_lock:
+        m = dict(_webhook_metrics)
+    # coalesce ratio: queue rows closed per distinct entity actually fetched/deleted
+    m["coalesce_ratio"] = round(m["jobs_processed"] / m["entity_fetches"], 2) if m["entity_fetches"] else None
+    m["buffered"] = len(_webhook_buffer)
+    return m
 
 def logi(msg: str):
     print(msg, file=sys.stderr, flush=True)
@@ -3019,6 +4497,40 @@ def ensure_webhook_queue_schema() -> None:
         cur.execute("ALTER TABLE public.b24_webhook_queue ADD COLUMN IF NOT EXISTS event_name text;")
         cur.execute("ALTER TABLE public.b24_webhook_queue ADD COLUMN IF NOT EXISTS payload jsonb;")
         cur.execute("ALTER TABLE public.b24_webhook_queue ADD COLUMN IF NOT EXISTS next_run_at timestamptz;")
+        cur.execute("ALTER TABLE public.b24_webhook_queue ADD COLUMN IF NOT EXISTS locked_until timestamptz;")
+        cur.execute("ALTER TABLE public.b24_webhook_queue ADD COLUMN IF NOT EXISTS locked_by text;")
+        # worker claim / next due time: only the small pending part of the table is indexed
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_b24_webhook_queue_pending_due
+            ON public.b24_webhook_queue (next_run_at, id)
+            WHERE status IN ('new','retry','pending')
+        """)
+        # retention and throughput stats
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_b24_webhook_queue_done_processed
+            ON public.b24_webhook_queue (processed_at)
+            WHERE status = 'done'
+        """)
+        if WEBHOOK_QUEUE_ARCHIVE:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS public.b24_webhook_queue_archive (
+                    id bigint PRIMARY KEY,
+                    entity_key text NOT NULL,
+                    entity_id bigint NOT NULL,
+                    event_name text,
+                    payload jsonb,
+                    attempts int,
+                    received_at timestamptz,
+                    processed_at timestamptz,
+                    archived_at timestamptz NOT NULL DEFAULT now()
+                );
+            """)
+        # debounce / coalescing look up pending rows by entity
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_b24_webhook_queue_pending_entity
+            ON public.b24_webhook_queue (entity_key, entity_id)
+            WHERE status IN ('new','retry','pending')
+        """)
         # defaults (safe)
         cur.execute("ALTER TABLE public.b24_webhook_queue ALTER COLUMN received_at SET DEFAULT now();")
         cur.execute("ALTER TABLE public.b24_webhook_queue ALTER COLUMN created_at SET DEFAULT now();")
@@ -3110,69 +4622,292 @@ def _guess_entity_from_event(event_name: str, payload: Dict[str, Any]) -> Tuple[
 
     return (None, entity_id, en)
 
+def _enqueue_webhook_events(events: List[Tuple[str, int, str, Dict[str, Any], datetime]]) -> int:
+    """
+    Write (entity_key, entity_id, event_name, payload, received_at) events with one multi-row INSERT and one NOTIFY.
+    Debounce: an update is scheduled WEBHOOK_DEBOUNCE_SEC ahead and skipped entirely if the same entity
+    already has a 'new' row still waiting in its window (the worker fetches the latest state anyway);
+    repeated updates inside the batch collapse to one row. Deletes are never debounced.
+    Returns the number of inserted rows; DB errors propagate to the caller.
+    """
+    rows: List[Tuple[Any, ...]] = []
+    seen: set = set()
+    for entity_key, entity_id, event_name, payload, received_at in events:
+        is_delete = _event_is_delete(event_name, payload)
+        if not is_delete:
+            if (entity_key, int(entity_id)) in seen:
+                continue
+            seen.add((entity_key, int(entity_id)))
+        rows.append((
+            entity_key, int(entity_id), event_name, json.dumps(payload, ensure_ascii=False),
+            0.0 if is_delete else WEBHOOK_DEBOUNCE_SEC, is_delete, received_at,
+        ))
+    inserted = 0
+    if rows:
+        with pg_connection(autocommit=True) as conn:
+            with conn.cursor() as cur:
+                result = execute_values(cur, """
+                    INSERT INTO public.b24_webhook_queue (entity_key, entity_id, event_name, event, payload, status, attempts, next_run_at, received_at, created_at)
+                    SELECT v.entity_key, v.entity_id, v.event_name, v.event_name, v.payload::jsonb, 'new', 0,
+                           now() + (v.delay_sec || ' seconds')::interval, v.received_at, now()
+                    FROM (VALUES %s) AS v(entity_key, entity_id, event_name, payload, delay_sec, is_delete, received_at)
+                    WHERE v.is_delete OR NOT EXISTS (
+                        SELECT 1 FROM public.b24_webhook_queue q
+                        WHERE q.entity_key = v.entity_key AND q.entity_id = v.entity_id
+                          AND q.status = 'new' AND q.next_run_at > now()
+                    )
+                    RETURNING 1
+                """, rows, template="(%s::text, %s::bigint, %s::text, %s::text, %s::float8, %s::boolean, %s::timestamptz)",
+                    page_size=len(rows), fetch=True)
+                inserted = len(result or [])
+                if inserted and WEBHOOK_LISTEN_ENABLED:
+                    cur.execute("SELECT pg_notify(%s, %s)", (WEBHOOK_NOTIFY_CHANNEL, ""))
+    _webhook_metric_add(enqueued=inserted, debounced=len(events) - inserted)
+    return inserted
+
 def _enqueue_webhook_event(entity_key: str, entity_id: int, event_name: str, payload: Dict[str, Any]) -> None:
-    conn = None
     try:
-        conn = pg_conn()
-        conn.autocommit = True
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO public.b24_webhook_queue (entity_key, entity_id, event_name, event, payload, status, attempts, next_run_at, received_at, created_at)
-                VALUES (%s, %s, %s, %s, %s::jsonb, 'new', 0, now(), now(), now())
-            """, (entity_key, entity_id, event_name, event_name, json.dumps(payload, ensure_ascii=False)))
+        _enqueue_webhook_events([(entity_key, entity_id, event_name, payload, datetime.now(timezone.utc))])
     except Exception as e:
         logi(f"ERROR: _enqueue_webhook_event: {e}")
         traceback.print_exc()
-    finally:
-        if conn:
-            conn.close()
 
-def _bitrix_get_one(entity_key: str, entity_id: int) -> Optional[Dict[str, Any]]:
-    try:
-        if entity_key == "user":
-            resp = b24.call("user.get", {"ID": str(int(entity_id))})
-            if isinstance(resp, dict) and resp.get("error") == "OVERLOAD_LIMIT":
-                return None
-            result = resp.get("result") if isinstance(resp, dict) else None
-            if isinstance(result, list) and result:
-                first = result[0]
-                return first if isinstance(first, dict) else None
-            return None
+_webhook_buffer: deque = deque()
+_webhook_buffer_cond = threading.Condition()
+_webhook_flusher_thread: Optional[threading.Thread] = None
+
+def _buffer_webhook_event(entity_key: str, entity_id: int, event_name: str, payload: Dict[str, Any]) -> bool:
+    """Non-blocking enqueue for the receiver. False = buffer is full (backpressure, answer 503)."""
+    with _webhook_buffer_cond:
+        full = len(_webhook_buffer) >= WEBHOOK_BUFFER_MAX
+        if not full:
+            _webhook_buffer.append((entity_key, int(entity_id), event_name, payload, datetime.now(timezone.utc)))
+            if len(_webhook_buffer) == 1 or len(_webhook_buffer) >= WEBHOOK_BUFFER_FLUSH_SIZE:
+                _webhook_buffer_cond.notify_all()
+    if full:
+        _webhook_metric_add(rejected=1)
+        return False
+    _ensure_webhook_flusher()
+    return True
 
-        if entity_key == "deal":
-            resp = b24.call("crm.deal.get", {"id": entity_id})
-            if isinstance(resp, dict) and resp.get("error") == "OVERLOAD_LIMIT":
-                return None
-            return (resp.get("result") if isinstance(resp, dict) else None)
+def _ensure_webhook_flusher() -> None:
+    global _webhook_flusher_thread
+    if _webhook_flusher_thread is not None and _webhook_flusher_thread.is_alive():
+        return
+    with _webhook_buffer_cond:
+        if _webhook_flusher_thread is None or not _webhook_flusher_thread.is_alive():
+            _webhook_flusher_thread = threading.Thread(target=webhook_buffer_flusher, daemon=True, name="webhook-flusher")
+            _webhook_flusher_thread.start()
+
+def _take_webhook_buffer_batch(wait: bool) -> List[Tuple[str, int, str, Dict[str, Any], datetime]]:
+    with _webhook_buffer_cond:
+        if wait:
+            if not _webhook_buffer:
+                _webhook_buffer_cond.wait(timeout=1.0)
+            # size- or time-based flush: give the burst WEBHOOK_BUFFER_FLUSH_SEC to fill the batch
+            deadline = time.time() + WEBHOOK_BUFFER_FLUSH_SEC
+            while _webhook_buffer and len(_webhook_buffer) < WEBHOOK_BUFFER_FLUSH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                _webhook_buffer_cond.wait(timeout=remaining)
+        n = min(len(_webhook_buffer), WEBHOOK_BUFFER_FLUSH_SIZE)
+        return [_webhook_buffer.popleft() for _ in range(n)]
 
-        if entity_key == "contact":
-            resp = b24.call("crm.contact.get", {"id": entity_id})
-            if isinstance(resp, dict) and resp.get("error") == "OVERLOAD_LIMIT":
-                return None
-            return (resp.get("result") if isinstance(resp, dict) else None)
+def webhook_buffer_flusher() -> None:
+    while True:
+        batch = _take_webhook_buffer_batch(wait=True)
+        if not batch:
+            continue
+        try:
+            _enqueue_webhook_events(batch)
+        except Exception as e:
+            logi(f"ERROR: webhook_buffer_flusher: {len(batch)} events not written, will retry: {e}")
+            traceback.print_exc()
+            # back to the head of the buffer in the original order
+            with _webhook_buffer_cond:
+                _webhook_buffer.extendleft(reversed(batch))
+            time.sleep(1.0)
 
-        if entity_key == "lead":
-            resp = b24.call("crm.lead.get", {"id": entity_id})
-            if isinstance(resp, dict) and resp.get("error") == "OVERLOAD_LIMIT":
-                return None
-            return (resp.get("result") if isinstance(resp, dict) else None)
+def flush_webhook_buffer() -> None:
+    """Synchronously write everything still buffered (service shutdown)."""
+    while True:
+        batch = _take_webhook_buffer_batch(wait=False)
+        if not batch:
+            return
+        try:
+            _enqueue_webhook_events(batch)
+        except Exception as e:
+            logi(f"ERROR: flush_webhook_buffer: {len(batch)} events lost: {e}")
+            return
 
-        if entity_key.startswith("sp:"):
-            etid = int(entity_key.split(":", 1)[1])
-            resp = b24.call("crm.item.get", {"entityTypeId": etid, "id": entity_id})
-            if isinstance(resp, dict) and resp.get("error") == "OVERLOAD_LIMIT":
-                return None
-            if not isinstance(resp, dict):
-                return None
-            r = resp.get("result") or {}
-            if isinstance(r, dict):
-                return r.get("item") or None
+def _bitrix_get_one_command(entity_key: str, entity_id: int) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """(method, params) для получения одного элемента; None — сущность не поддерживается."""
+    if entity_key == "user":
+        return ("user.get", {"ID": str(int(entity_id))})
+    if entity_key == "deal":
+        return ("crm.deal.get", {"id": entity_id})
+    if entity_key == "contact":
+        return ("crm.contact.get", {"id": entity_id})
+    if entity_key == "lead":
+        return ("crm.lead.get", {"id": entity_id})
+    if entity_key.startswith("sp:"):
+        etid = int(entity_key.split(":", 1)[1])
+        return ("crm.item.get", {"entityTypeId": etid, "id": entity_id})
+    return None
+
+def _bitrix_extract_one(entity_key: str, result: Any) -> Optional[Dict[str, Any]]:
+    """Достаёт элемент из result ответа *.get (формат отличается у user.get и crm.item.get)."""
+    if entity_key == "user":
+        if isinstance(result, list) and result:
+            first = result[0]
+            return first if isinstance(first, dict) else None
+        return None
+    if entity_key.startswith("sp:"):
+        if isinstance(result, dict):
+            return result.get("item") or None
+        return None
+    return result if isinstance(result, dict) else None
+
+def _bitrix_get_one(entity_key: str, entity_id: int) -> Optional[Dict[str, Any]]:
+    try:
+        command = _bitrix_get_one_command(entity_key, entity_id)
+        if command is None:
             return None
+        resp = b24.call(command[0], command[1])
+        if not isinstance(resp, dict) or resp.get("error") == "OVERLOAD_LIMIT":
+            return None
+        return _bitrix_extract_one(entity_key, resp.get("result"))
     except Exception as e:
         logi(f"ERROR: _bitrix_get_one({entity_key},{entity_id}): {e}")
         traceback.print_exc()
     return None
 
+def _bitrix_list_by_ids_command(entity_key: str, ids: List[int], uf_fields: Optional[List[str]] = None) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    (method, params) списка по набору ID (до 50): один подзапрос вместо N *.get.
+    None — сущность получаем только через *.get (user и прочие).
+    """
+    ids = [int(x) for x in ids]
+    if entity_key == "deal":
+        params = _b24_deal_list_params(filter_params={"@ID": ids}, uf_fields=uf_fields)
+        params["start"] = -1
+        return ("crm.deal.list", params)
+    if entity_key in ("contact", "lead"):
+        # PHONE/EMAIL — как в ответе crm.*.get, который раньше сохранял webhook
+        select_list = ["*", "PHONE", "EMAIL"] + (list(uf_fields) if uf_fields else ["UF_*"])
+        return (f"crm.{entity_key}.list", {"select": select_list, "filter": {"@ID": ids}, "order": {"ID": "ASC"}, "start": -1})
+    if entity_key.startswith("sp:"):
+        etid = int(entity_key.split(":", 1)[1])
+        return ("crm.item.list", {"entityTypeId": etid, "select": ["*"], "filter": {"@id": ids}, "order": {"id": "ASC"}, "start": -1})
+    return None
+
+def _bitrix_get_many(
+    keys: List[Tuple[str, int]],
+    uf_fields_by_entity: Optional[Dict[str, List[str]]] = None,
+) -> Dict[Tuple[str, int], Optional[Dict[str, Any]]]:
+    """
+    Получает несколько элементов одним (или несколькими по 50) вызовом batch.
+    CRM-сущности группируются по entity_key и запрашиваются списком с фильтром @ID (до 50 ID на подзапрос),
+    остальные — через *.get. Элемента нет в ответе списка — значит его нет в Bitrix (None).
+    В ответе есть только ключи, по которым Bitrix дал определённый ответ (элемент или None);
+    если batch целиком не прошёл (OVERLOAD_LIMIT, сеть) — ключа нет, вызывающий может сходить через _bitrix_get_one.
+    """
+    commands: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    by_cmd_key: Dict[str, Tuple[str, int]] = {}
+    list_cmds: Dict[str, Tuple[str, List[int]]] = {}
+    by_entity: Dict[str, List[int]] = {}
+    for ek, eid in dict.fromkeys(keys):
+        by_entity.setdefault(ek, []).append(int(eid))
+    for ek, ids in by_entity.items():
+        for i in range(0, len(ids), 50):
+            chunk = ids[i:i + 50]
+            command = _bitrix_list_by_ids_command(ek, chunk, (uf_fields_by_entity or {}).get(ek))
+            if command is not None:
+                cmd_key = f"l{len(list_cmds)}"
+                commands[cmd_key] = command
+                list_cmds[cmd_key] = (ek, chunk)
+                continue
+            for eid in chunk:
+                command = _bitrix_get_one_command(ek, eid)
+                if command is None:
+                    continue
+                cmd_key = f"c{len(by_cmd_key)}"
+                commands[cmd_key] = command
+                by_cmd_key[cmd_key] = (ek, eid)
+    if not commands:
+        return {}
+
+    out: Dict[Tuple[str, int], Optional[Dict[str, Any]]] = {}
+    try:
+        results = b24.call_batch(commands)
+    except Exception as e:
+        logi(f"WARNING: _bitrix_get_many: batch failed ({len(commands)} commands): {e}")
+        return out
+    retry_keys: List[Tuple[str, int]] = []
+    for cmd_key, (ek, chunk) in list_cmds.items():
+        r = results.get(cmd_key) or {}
+        err = r.get("error")
+        if err == "OVERLOAD_LIMIT" or err == "BATCH_FAILED":
+            continue
+        if err:
+            # список не прошёл (лимит, неподдерживаемый фильтр) — эти ID получим отдельными *.get
+            logi(f"WARNING: _bitrix_get_many({ek} x{len(chunk)}): {err} {r.get('error_description') or ''}")
+            retry_keys.extend((ek, eid) for eid in chunk)
+            continue
+        items, _ = normalize_list_result(r)
+        found = {}
+        for it in items:
+            iid = _extract_int(it.get("ID") or it.get("id"))
+            if iid:
+                found[iid] = it
+        for eid in chunk:
+            out[(ek, eid)] = found.get(eid)
+    for cmd_key, key in by_cmd_key.items():
+        r = results.get(cmd_key) or {}
+        err = r.get("error")
+        if err == "OVERLOAD_LIMIT" or err == "BATCH_FAILED":
+            continue
+        if err and "LIMIT" in str(err):
+            # подзапрос упёрся в лимит внутри batch — повторяем его отдельно (с backoff клиента)
+            retry_keys.append(key)
+            continue
+        if err:
+            logi(f"WARNING: _bitrix_get_many({key[0]},{key[1]}): {err} {r.get('error_description') or ''}")
+            out[key] = None
+            continue
+        out[key] = _bitrix_extract_one(key[0], r.get("result"))
+    if retry_keys:
+        out.update(_bitrix_get_each(retry_keys))
+    return out
+
+def _bitrix_get_each(keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], Optional[Dict[str, Any]]]:
+    """
+    Отдельные *.get по каждому ключу, несколько запросов параллельно (AsyncBitrixClient).
+    Для ключей, которые не удалось получить, — None.
+    """
+    calls: List[Tuple[Tuple[str, int], Tuple[str, Dict[str, Any]]]] = []
+    for ek, eid in dict.fromkeys(keys):
+        command = _bitrix_get_one_command(ek, eid)
+        if command is not None:
+            calls.append(((ek, eid), command))
+    out: Dict[Tuple[str, int], Optional[Dict[str, Any]]] = {key: None for key in dict.fromkeys(keys)}
+    if not calls:
+        return out
+    try:
+        responses = b24_run_async(b24_async.call_many([c for _, c in calls], return_exceptions=True))
+    except Exception as e:
+        logi(f"ERROR: _bitrix_get_each: {e}")
+        return out
+    for (key, _), resp in zip(calls, responses):
+        if isinstance(resp, BaseException):
+            logi(f"ERROR: _bitrix_get_each({key[0]},{key[1]}): {resp}")
+            continue
+        if not isinstance(resp, dict) or resp.get("error") == "OVERLOAD_LIMIT":
+            continue
+        out[key] = _bitrix_extract_one(key[0], resp.get("result"))
+    return out
+
 def _upsert_single_item(conn, entity_key: str, item: Dict[str, Any]) -> bool:
     if entity_key == "user":
         raw_id = item.get("ID") if "ID" in item else item.get("id")
@@ -3187,48 +4922,185 @@ def _upsert_single_item(conn, entity_key: str, item: Dict[str, Any]) -> bool:
 
     table = table_name_for_entity(entity_key)
     ensure_pk_index(conn, table)
-    colmap = load_entity_colmap(conn, entity_key)
-    if not colmap:
+    builder = get_row_builder(conn, entity_key)
+    if not builder.has_fields:
         logi(f"WARNING: webhook upsert: no colmap for {entity_key} (run schema sync once)")
         return False
 
-    # Determine id field
-    raw_id = item.get("ID") if "ID" in item else item.get("id")
-    entity_id = _extract_int(raw_id)
-    if not entity_id:
+    # updated_at выставляет upsert_rows (now()), отдельно не передаём
+    row = builder.build(item)
+    if row is None:
+        return False
+
+    upsert_rows(conn, table, builder.col_order, [row])
+    return True
+
+
+def _upsert_items_bulk(conn, entity_key: str, items: List[Dict[str, Any]]) -> set:
+    """Upsert of several fetched items of one entity with a single upsert_rows; returns the IDs written."""
+    if entity_key == "user":
+        return {
+            int(_extract_int(it.get("ID") if "ID" in it else it.get("id")) or 0)
+            for it in items
+            if _upsert_single_item(conn, entity_key, it)
+        }
+
+    table = table_name_for_entity(entity_key)
+    ensure_pk_index(conn, table)
+    builder = get_row_builder(conn, entity_key)
+    if not builder.has_fields:
+        logi(f"WARNING: webhook upsert: no colmap for {entity_key} (run schema sync once)")
+        return set()
+
+    rows: List[List[Any]] = []
+    for it in items:
+        row = builder.build(it)
+        if row is not None:
+            rows.append(row)
+    if rows:
+        upsert_rows(conn, table, builder.col_order, rows)
+    return {int(r[0]) for r in rows}
+
+
+# Derived data refreshed after webhook upserts (instead of full-table recalculation):
+# assigned_by_name, entity-table custom formula columns, sources classifier.
+SOURCES_CLASSIFIER_REFRESH_MIN_SEC = max(60, int(os.getenv("SOURCES_CLASSIFIER_REFRESH_MIN_SEC", "600")))
+_sources_classifier_refreshed_at = 0.0
+_sources_classifier_refresh_lock = threading.Lock()
+
+def _propagate_assigned_by_name(conn, table: str, ids: List[int]) -> int:
+    """assigned_by_name for just-upserted deals: from b24_users, missing users — one user.get batch."""
+    if "assigned_by_name" not in _table_columns_cached(conn, table):
+        return 0
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT DISTINCT assigned_by_id::text
+            FROM {table} t
+            WHERE t.id = ANY(%s)
+              AND t.assigned_by_id IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM b24_users u WHERE u.id::text = t.assigned_by_id::text)
+        """, (list(ids),))
+        unknown = [str(r[0]).strip() for r in cur.fetchall() if r and r[0] is not None and str(r[0]).strip()]
+    if unknown:
+        for uid, name in _fetch_user_names(unknown).items():
+            if name and name != uid and str(uid).isdigit():
+                _upsert_b24_user(conn, int(uid), name)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {table} t
+            SET assigned_by_name = u.name
+            FROM b24_users u
+            WHERE t.id = ANY(%s)
+              AND u.id::text = t.assigned_by_id::text
+              AND t.assigned_by_name IS DISTINCT FROM u.name
+        """, (list(ids),))
+        return int(cur.rowcount or 0)
+
+def _propagate_user_name(conn, user_id: int) -> int:
+    """User renamed in Bitrix -> assigned_by_name of their deals."""
+    table = table_name_for_entity("deal")
+    if "assigned_by_name" not in _table_columns_cached(conn, table):
+        return 0
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {table} t
+            SET assigned_by_name = u.name
+            FROM b24_users u
+            WHERE u.id = %s
+              AND t.assigned_by_id::text = u.id::text
+              AND t.assigned_by_name IS DISTINCT FROM u.name
+        """, (int(user_id),))
+        return int(cur.rowcount or 0)
+
+def _propagate_sources_classifier(conn, table: str, ids: List[int]) -> bool:
+    """Deal got a source value that is not in b24_classifier_sources yet -> refresh the classifier (rate-limited)."""
+    global _sources_classifier_refreshed_at
+    from api_data import DEALS_F_SURSA
+    col = str(DEALS_F_SURSA or "").strip().lower()
+    if not col or col not in _table_columns_cached(conn, table):
         return False
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT 1
+            FROM {table} t
+            WHERE t.id = ANY(%s)
+              AND NULLIF(t."{col}"::text, '') IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM b24_classifier_sources s WHERE s.source_id::text = t."{col}"::text)
+            LIMIT 1
+        """, (list(ids),))
+        if cur.fetchone() is None:
+            return False
+    with _sources_classifier_refresh_lock:
+        if time.time() - _sources_classifier_refreshed_at < SOURCES_CLASSIFIER_REFRESH_MIN_SEC:
+            return False
+        _sources_classifier_refreshed_at = time.time()
+    sync_sources_classifier(conn)
+    return True
+
+def _propagate_custom_fields(conn, table: str, ids: List[int], heartbeat: Optional[Callable[[], None]] = None) -> int:
+    """Entity-table formula columns stored in this table: recalculated only for the changed rows."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('public.entity_table_custom_fields') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return 0
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("""
+            SELECT id, page_slug, table_index, code, editor, target_entity, source_entities,
+                   storage_table, storage_column, storage_pg_type
+            FROM entity_table_custom_fields
+            WHERE storage_table = %s AND COALESCE(editor, '') <> ''
+            ORDER BY id
+        """, (table,))
+        fields = [dict(r) for r in (cur.fetchall() or [])]
+    updated = 0
+    for cf in fields:
+        if heartbeat:
+            heartbeat()
+        cf["_only_ids"] = list(ids)
+        cf["_include_resolver_debug_rows"] = False
+        try:
+            res = _entity_table_recalculate_custom_field_editor(conn, cf)
+            updated += int(res.get("updated_rows") or 0)
+        except Exception as e:
+            logi(f"WARNING: propagate custom field {cf.get('code')} on {table}: {e}")
+    return updated
 
-    # Build column order
-    col_order = ["id", "raw"] + sorted({m["column_name"] for m in colmap.values()})
-    # keep updated_at
-    if "updated_at" not in col_order:
-        col_order.append("updated_at")
-
-    row = {c: None for c in col_order}
-    row["id"] = int(entity_id)
-    row["raw"] = Json(item)
-    row["updated_at"] = datetime.now(timezone.utc)
-
-    for b24_field, meta in colmap.items():
-        col = meta["column_name"]
-        b24_type = meta.get("b24_type")
-        is_multiple = meta.get("is_multiple", False)
-
-        value = None
-        if b24_field in item:
-            value = item[b24_field]
-        elif b24_field.upper() in item:
-            value = item[b24_field.upper()]
-        elif b24_field.lower() in item:
-            value = item[b24_field.lower()]
-        elif isinstance(item.get("fields"), dict) and b24_field in item["fields"]:
-            value = item["fields"][b24_field]
-
-        if value is not None:
-            row[col] = normalize_value(value, b24_type, is_multiple)
-
-    upsert_rows(conn, table, col_order, [[row.get(c) for c in col_order]])
-    return True
+def propagate_row_changes(
+    conn, entity_key: str, ids: List[int], heartbeat: Optional[Callable[[], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Change propagation after webhook upserts: recompute only the derived values that depend on these rows.
+    Each stage is independent; a failure is logged and does not fail the queue job.
+    heartbeat is called between stages and custom fields (the webhook worker renews its job lease there):
+    Bitrix lookups and aggregate formulas over the whole table can take longer than WEBHOOK_LEASE_SEC.
+    """
+    out: Dict[str, Any] = {}
+    if not ids:
+        return out
+    if entity_key == "user":
+        for uid in ids:
+            if heartbeat:
+                heartbeat()
+            try:
+                out["assigned_by_name"] = out.get("assigned_by_name", 0) + _propagate_user_name(conn, uid)
+            except Exception as e:
+                logi(f"WARNING: propagate user {uid}: {e}")
+        return out
+    table = table_name_for_entity(entity_key)
+    stages: List[Tuple[str, Any]] = []
+    if entity_key == "deal":
+        stages.append(("assigned_by_name", _propagate_assigned_by_name))
+        stages.append(("sources_classifier", _propagate_sources_classifier))
+    stages.append(("custom_fields", lambda c, t, i: _propagate_custom_fields(c, t, i, heartbeat)))
+    for name, fn in stages:
+        if heartbeat:
+            heartbeat()
+        try:
+            out[name] = fn(conn, table, ids)
+        except Exception as e:
+            logi(f"WARNING: propagate {name} for {entity_key} ({len(ids)} rows): {e}")
+            traceback.print_exc()
+    return out
 
 
 def _event_is_delete(event_name: str, payload: Optional[Dict[str, Any]] = None) -> bool:
@@ -3261,6 +5133,8 @@ def _delete_single_item(conn, entity_key: str, entity_id: int) -> bool:
         with conn.cursor() as cur:
             cur.execute(f"DELETE FROM {table} WHERE id=%s", (int(entity_id),))
             deleted = int(cur.rowcount or 0)
+        if deleted:
+            mark_counts_dirty(conn, table)
         logi(f"INFO: webhook delete: entity_key={entity_key} id={entity_id} deleted_rows={deleted}")
         return True
     except Exception as e:
@@ -3268,118 +5142,533 @@ def _delete_single_item(conn, entity_key: str, entity_id: int) -> bool:
         traceback.print_exc()
         return False
 
-def webhook_queue_worker(stop_event: threading.Event) -> None:
-    logi("INFO: webhook_queue_worker started")
-    while not stop_event.is_set():
-        try:
-            conn = pg_conn()
-            conn.autocommit = True
-            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT id, entity_key, entity_id,
-                           COALESCE(event_name, event) AS event_name,
-                           payload,
-                           attempts
+def _claim_webhook_jobs(worker_id: str, limit: int) -> List[Dict[str, Any]]:
+    """
+    Claim up to `limit` due jobs for this worker in one statement.
+    FOR UPDATE SKIP LOCKED: concurrent workers (threads or uvicorn processes) never get the same row;
+    locked_until is the lease — if the worker dies, the reaper returns the job to the queue after it expires.
+    """
+    with pg_connection(autocommit=True) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("""
+                WITH claimed AS (
+                    SELECT id
                     FROM public.b24_webhook_queue
                     WHERE status IN ('new','retry','pending')
                       AND (next_run_at IS NULL OR next_run_at <= now())
                     ORDER BY id
-                    LIMIT 10
-                """)
-                jobs = cur.fetchall() or []
-            conn.close()
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE public.b24_webhook_queue q
+                SET status='processing',
+                    locked_until=now() + (%s || ' seconds')::interval,
+                    locked_by=%s
+                FROM claimed
+                WHERE q.id = claimed.id
+                RETURNING q.id, q.entity_key, q.entity_id,
+                          COALESCE(q.event_name, q.event) AS event_name,
+                          q.payload,
+                          q.attempts
+            """, (int(limit), WEBHOOK_LEASE_SEC, worker_id))
+            jobs = [dict(r) for r in (cur.fetchall() or [])]
+            if jobs:
+                # coalescing: also take every other pending row for the same entities (even if not due yet) —
+                # they are served by the same fetch
+                cur.execute("""
+                    WITH keys AS (
+                        SELECT DISTINCT entity_key, entity_id
+                        FROM public.b24_webhook_queue
+                        WHERE id = ANY(%s)
+                    ),
+                    siblings AS (
+                        SELECT q.id
+                        FROM public.b24_webhook_queue q
+                        JOIN keys k ON k.entity_key = q.entity_key AND k.entity_id = q.entity_id
+                        WHERE q.status IN ('new','retry','pending')
+                        FOR UPDATE OF q SKIP LOCKED
+                    )
+                    UPDATE public.b24_webhook_queue q
+                    SET status='processing',
+                        locked_until=now() + (%s || ' seconds')::interval,
+                        locked_by=%s
+                    FROM siblings
+                    WHERE q.id = siblings.id
+                    RETURNING q.id, q.entity_key, q.entity_id,
+                              COALESCE(q.event_name, q.event) AS event_name,
+                              q.payload,
+                              q.attempts
+                """, ([int(j["id"]) for j in jobs], WEBHOOK_LEASE_SEC, worker_id))
+                jobs.extend(dict(r) for r in (cur.fetchall() or []))
+    # RETURNING does not keep the CTE order
+    jobs.sort(key=lambda j: int(j["id"]))
+    return jobs
+
+def _requeue_expired_webhook_jobs() -> int:
+    """Reaper: jobs stuck in 'processing' past their lease (worker crashed / was restarted) go back to 'retry'."""
+    with pg_connection(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE public.b24_webhook_queue
+                SET status=CASE WHEN attempts + 1 >= %s THEN 'dead' ELSE 'retry' END,
+                    attempts=attempts+1,
+                    last_error='lease expired',
+                    next_run_at=now(),
+                    locked_until=NULL, locked_by=NULL
+                WHERE status='processing'
+                  AND (locked_until IS NULL OR locked_until < now())
+            """, (WEBHOOK_MAX_ATTEMPTS,))
+            return int(cur.rowcount or 0)
+
+def purge_webhook_queue() -> int:
+    """Retention: drop (or archive) 'done' rows older than WEBHOOK_RETENTION_DAYS, chunk by chunk."""
+    total = 0
+    with pg_connection(autocommit=True) as conn:
+        while True:
+            with conn.cursor() as cur:
+                if WEBHOOK_QUEUE_ARCHIVE:
+                    cur.execute("""
+                        WITH moved AS (
+                            DELETE FROM public.b24_webhook_queue
+                            WHERE id IN (
+                                SELECT id FROM public.b24_webhook_queue
+                                WHERE status = 'done' AND processed_at < now() - (%s || ' days')::interval
+                                LIMIT %s
+                            )
+                            RETURNING id, entity_key, entity_id, COALESCE(event_name, event) AS event_name,
+                                      payload, attempts, received_at, processed_at
+                        )
+                        INSERT INTO public.b24_webhook_queue_archive
+                            (id, entity_key, entity_id, event_name, payload, attempts, received_at, processed_at)
+                        SELECT * FROM moved
+                        ON CONFLICT (id) DO NOTHING
+                    """, (WEBHOOK_RETENTION_DAYS, WEBHOOK_RETENTION_CHUNK))
+                else:
+                    cur.execute("""
+                        DELETE FROM public.b24_webhook_queue
+                        WHERE id IN (
+                            SELECT id FROM public.b24_webhook_queue
+                            WHERE status = 'done' AND processed_at < now() - (%s || ' days')::interval
+                            LIMIT %s
+                        )
+                    """, (WEBHOOK_RETENTION_DAYS, WEBHOOK_RETENTION_CHUNK))
+                n = int(cur.rowcount or 0)
+            total += n
+            if n < WEBHOOK_RETENTION_CHUNK:
+                break
+    return total
 
-            if not jobs:
-                time.sleep(1.0)
-                continue
+def webhook_queue_stats() -> Dict[str, Any]:
+    """Depth by status, age of the oldest waiting job and throughput (done per minute / hour)."""
+    with pg_connection(autocommit=True) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("""
+                SELECT status, count(*) AS n
+                FROM public.b24_webhook_queue
+                GROUP BY status
+            """)
+            by_status = {str(r["status"]): int(r["n"]) for r in cur.fetchall()}
+            cur.execute("""
+                SELECT count(*) AS waiting,
+                       count(*) FILTER (WHERE next_run_at IS NULL OR next_run_at <= now()) AS due,
+                       EXTRACT(EPOCH FROM (now() - min(received_at))) AS oldest_age_sec
+                FROM public.b24_webhook_queue
+                WHERE status IN ('new','retry','pending')
+            """)
+            pending = cur.fetchone() or {}
+            cur.execute("""
+                SELECT count(*) FILTER (WHERE processed_at >= now() - interval '1 minute') AS done_1m,
+                       count(*) FILTER (WHERE processed_at >= now() - interval '5 minutes') AS done_5m,
+                       count(*) AS done_1h,
+                       avg(EXTRACT(EPOCH FROM (processed_at - received_at)))
+                           FILTER (WHERE processed_at >= now() - interval '5 minutes') AS avg_latency_5m_sec
+                FROM public.b24_webhook_queue
+                WHERE status = 'done' AND processed_at >= now() - interval '1 hour'
+            """)
+            done = cur.fetchone() or {}
+    oldest = pending.get("oldest_age_sec")
+    latency = done.get("avg_latency_5m_sec")
+    return {
+        "depth": int(pending.get("waiting") or 0),
+        "due": int(pending.get("due") or 0),
+        "by_status": by_status,
+        "oldest_pending_age_sec": round(float(oldest), 1) if oldest is not None else None,
+        "throughput": {
+            "done_last_1m": int(done.get("done_1m") or 0),
+            "done_last_5m": int(done.get("done_5m") or 0),
+            "done_last_1h": int(done.get("done_1h") or 0),
+            "per_sec_5m": round(int(done.get("done_5m") or 0) / 300.0, 2),
+            "avg_latency_5m_sec": round(float(latency), 2) if latency is not None else None,
+        },
+        "retention_days": WEBHOOK_RETENTION_DAYS,
+        "circuit_open_sec": round(bitrix_circuit_remaining(), 1),
+        "process": webhook_queue_metrics(),
+    }
 
-            for job in jobs:
-                if stop_event.is_set():
-                    break
-                qid = int(job["id"])
-                ek = str(job["entity_key"])
-                eid = int(job["entity_id"])
-                ev = str(job.get("event_name") or "")
-                payload = job.get("payload") if isinstance(job.get("payload"), dict) else {}
-                attempts = int(job.get("attempts") or 0)
-
-                # mark processing
-                connp = pg_conn(); connp.autocommit = True
-                with connp.cursor() as curp:
-                    curp.execute("UPDATE public.b24_webhook_queue SET status='processing' WHERE id=%s", (qid,))
-                connp.close()
-
-                # delete event/action -> delete row from local DB, then mark queue item done
-                if _event_is_delete(ev, payload):
-                    connd = pg_conn(); connd.autocommit = True
-                    ok_del = False
-                    try:
-                        ok_del = _delete_single_item(connd, ek, eid)
-                    finally:
-                        connd.close()
+def _extend_webhook_lease(conn, qids: List[int], worker_id: str) -> set:
+    """
+    Push locked_until forward for the rows this worker still owns and return their ids.
+    Rows missing from the result were requeued by the reaper (and maybe claimed by another worker) — drop them.
+    """
+    if not qids:
+        return set()
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE public.b24_webhook_queue
+            SET locked_until=now() + (%s || ' seconds')::interval
+            WHERE id = ANY(%s) AND status='processing' AND locked_by=%s
+            RETURNING id
+        """, (WEBHOOK_LEASE_SEC, list(qids), worker_id))
+        return {int(r[0]) for r in (cur.fetchall() or [])}
+
+def _release_webhook_jobs(conn, qids: List[int], worker_id: str, delay_sec: float = 0.0) -> None:
+    """
+    Claimed but not processed (worker is stopping / circuit breaker is open) -> back to the queue
+    without waiting for the lease and without counting an attempt.
+    """
+    if not qids:
+        return
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE public.b24_webhook_queue
+            SET status='retry', next_run_at=now() + (%s || ' seconds')::interval, locked_until=NULL, locked_by=NULL
+            WHERE id = ANY(%s) AND status='processing' AND locked_by=%s
+        """, (float(delay_sec), list(qids), worker_id))
 
-                    connm = pg_conn(); connm.autocommit=True
-                    with connm.cursor() as curm:
-                        if ok_del:
-                            curm.execute("UPDATE public.b24_webhook_queue SET status='done', processed_at=now(), last_error=NULL WHERE id=%s", (qid,))
-                        else:
-                            backoff = min(300, 5 * (attempts + 1))
-                            curm.execute("""
-                                UPDATE public.b24_webhook_queue
-                                SET status='retry', attempts=attempts+1,
-                                    last_error=%s,
-                                    next_run_at=now() + (%s || ' seconds')::interval
-                                WHERE id=%s
-                            """, ("delete failed", backoff, qid))
-                    connm.close()
-                    continue
+def _webhook_job_done(conn, qids: List[int], worker_id: str) -> None:
+    # locked_by guard: a row whose lease expired belongs to whoever re-claimed it
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE public.b24_webhook_queue
+            SET status='done', processed_at=now(), last_error=NULL, locked_until=NULL, locked_by=NULL
+            WHERE id = ANY(%s) AND status='processing' AND locked_by=%s
+        """, (list(qids), worker_id))
+
+def _webhook_backoff_sec(attempts: int) -> float:
+    """Exponential backoff with jitter: failed jobs of one burst must not all come back at the same second."""
+    base = min(WEBHOOK_BACKOFF_MAX_SEC, 5 * (2 ** min(attempts, 16)))
+    return round(base * random.uniform(0.5, 1.0), 1)
+
+def _webhook_job_retry(conn, qids: List[int], worker_id: str, attempts: int, error: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE public.b24_webhook_queue
+            SET status=CASE WHEN attempts + 1 >= %s THEN 'dead' ELSE 'retry' END,
+                attempts=attempts+1,
+                last_error=%s,
+                next_run_at=now() + (%s || ' seconds')::interval,
+                locked_until=NULL, locked_by=NULL
+            WHERE id = ANY(%s) AND status='processing' AND locked_by=%s
+            RETURNING status
+        """, (WEBHOOK_MAX_ATTEMPTS, error, _webhook_backoff_sec(attempts), list(qids), worker_id))
+        dead = sum(1 for r in (cur.fetchall() or []) if r[0] == "dead")
+    if dead:
+        logi(f"WARNING: webhook queue: {dead} jobs moved to dead-letter after {WEBHOOK_MAX_ATTEMPTS} attempts ({error})")
+
+def replay_dead_webhook_jobs(ids: Optional[List[int]] = None, entity_key: Optional[str] = None, limit: int = 1000) -> int:
+    """Dead-letter replay: selected 'dead' jobs go back to the queue with a fresh attempt counter."""
+    where = ["status = 'dead'"]
+    params: List[Any] = []
+    if ids:
+        where.append("id = ANY(%s)")
+        params.append([int(x) for x in ids])
+    if entity_key:
+        where.append("entity_key = %s")
+        params.append(entity_key)
+    params.append(int(limit))
+    with pg_connection(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                UPDATE public.b24_webhook_queue
+                SET status='retry', attempts=0, last_error=NULL, next_run_at=now(), locked_until=NULL, locked_by=NULL
+                WHERE id IN (
+                    SELECT id FROM public.b24_webhook_queue
+                    WHERE {" AND ".join(where)}
+                    ORDER BY id
+                    LIMIT %s
+                )
+            """, params)
+            replayed = int(cur.rowcount or 0)
+            if replayed and WEBHOOK_LISTEN_ENABLED:
+                cur.execute("SELECT pg_notify(%s, %s)", (WEBHOOK_NOTIFY_CHANNEL, ""))
+    return replayed
+
+def _group_webhook_jobs(jobs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Collapse claimed rows per (entity_key, entity_id): one fetch (or delete) serves all of them.
+    A delete anywhere in the group wins over updates. Groups keep the order of their first row.
+    """
+    groups: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    for j in jobs:
+        key = (str(j["entity_key"]), int(j["entity_id"]))
+        payload = j.get("payload") if isinstance(j.get("payload"), dict) else {}
+        g = groups.setdefault(key, {"key": key, "ids": [], "delete": False, "attempts": 0})
+        g["ids"].append(int(j["id"]))
+        g["delete"] = g["delete"] or _event_is_delete(str(j.get("event_name") or ""), payload)
+        g["attempts"] = max(g["attempts"], int(j.get("attempts") or 0))
+    return list(groups.values())
+
+def _process_webhook_jobs(jobs: List[Dict[str, Any]], stop_event: threading.Event, worker_id: str) -> None:
+    groups = _group_webhook_jobs(jobs)
+
+    # The claim lease (WEBHOOK_LEASE_SEC) is renewed between Bitrix calls and per group: waiting on the token
+    # bucket / OVERLOAD backoff / circuit breaker must not let the reaper hand the rows to another worker.
+    # Rows lost anyway (renewal came too late) are skipped — their new owner processes them.
+    lease = {"at": time.time(), "owned": {int(j["id"]) for j in jobs}}
+
+    def renew_lease(conn, force: bool = False) -> None:
+        if not force and time.time() - lease["at"] < WEBHOOK_LEASE_SEC / 3.0:
+            return
+        owned = _extend_webhook_lease(conn, sorted(lease["owned"]), worker_id)
+        lost = len(lease["owned"]) - len(owned)
+        if lost:
+            logi(f"WARNING: webhook worker {worker_id}: lease expired for {lost} jobs, skipping them")
+        lease["owned"] = owned
+        lease["at"] = time.time()
+
+    def owned_ids(g: Dict[str, Any]) -> List[int]:
+        return [qid for qid in g["ids"] if qid in lease["owned"]]
+
+    # Все элементы пачки (кроме delete) забираем из Bitrix одним batch-вызовом: по одному list-подзапросу
+    # с фильтром @ID на каждые 50 элементов сущности
+    fetch_keys = [g["key"] for g in groups if not g["delete"]]
+    with pg_connection(autocommit=True) as conn:
+        uf_fields_by_entity = {
+            ek: _load_uf_fields(conn, ek)
+            for ek in dict.fromkeys(k[0] for k in fetch_keys)
+            if ek in ("deal", "contact", "lead")
+        }
+    prefetched = _bitrix_get_many(fetch_keys, uf_fields_by_entity)
+    # batch не прошёл целиком — добираем по одному, но параллельно (если портал не заблокирован)
+    missing = [k for k in fetch_keys if k not in prefetched]
+    if missing and bitrix_circuit_remaining() <= 0:
+        with pg_connection(autocommit=True) as conn:
+            renew_lease(conn)
+        prefetched.update(_bitrix_get_each(missing))
+    # OVERLOAD_LIMIT во время пачки: недополученные элементы возвращаются в очередь до закрытия breaker,
+    # без попытки и без отдельных повторов
+    circuit_pause = bitrix_circuit_remaining()
+
+    with pg_connection(autocommit=True) as conn:
+        renew_lease(conn)
+        done_ids: List[int] = []
+        to_upsert: Dict[str, List[Tuple[Dict[str, Any], Dict[str, Any]]]] = {}
+        for idx, g in enumerate(groups):
+            if stop_event.is_set():
+                _release_webhook_jobs(conn, [qid for rest in groups[idx:] for qid in owned_ids(rest)], worker_id)
+                break
+            ek, eid = g["key"]
+            renew_lease(conn)
+            qids = owned_ids(g)
+            if not qids:
+                continue
+            _webhook_metric_add(jobs_processed=len(qids), entity_fetches=1)
+
+            # delete event/action -> delete row from local DB, then mark queue items done
+            if g["delete"]:
+                if _delete_single_item(conn, ek, eid):
+                    done_ids.extend(qids)
+                else:
+                    _webhook_job_retry(conn, qids, worker_id, g["attempts"], "delete failed")
+                continue
 
+            if (ek, eid) in prefetched:
+                item = prefetched[(ek, eid)]
+            elif circuit_pause > 0:
+                _release_webhook_jobs(conn, qids, worker_id, delay_sec=circuit_pause)
+                continue
+            else:
+                renew_lease(conn, force=True)
                 item = _bitrix_get_one(ek, eid)
-                if not item:
-                    backoff = min(300, 5 * (attempts + 1))
-                    connr = pg_conn(); connr.autocommit=True
-                    with connr.cursor() as curr:
-                        curr.execute("""
-                            UPDATE public.b24_webhook_queue
-                            SET status='retry', attempts=attempts+1,
-                                last_error=%s,
-                                next_run_at=now() + (%s || ' seconds')::interval
-                            WHERE id=%s
-                        """, ("bitrix blocked / empty", backoff, qid))
-                    connr.close()
-                    continue
+            if not item:
+                _webhook_job_retry(conn, owned_ids(g), worker_id, g["attempts"], "bitrix blocked / empty")
+                continue
+            to_upsert.setdefault(ek, []).append((g, item))
 
-                connu = pg_conn(); connu.autocommit=True
-                ok = False
+        # одна запись на таблицу сущности
+        for ek, pairs in to_upsert.items():
+            renew_lease(conn)
+            written: set = set()
+            try:
+                written = _upsert_items_bulk(conn, ek, [item for _, item in pairs])
+            except Exception as e:
+                logi(f"ERROR: webhook upsert failed: entity_key={ek} items={len(pairs)}: {e}")
+                traceback.print_exc()
+            if written:
+                propagate_row_changes(conn, ek, sorted(written), heartbeat=lambda: renew_lease(conn))
+            for g, _ in pairs:
+                if g["key"][1] in written:
+                    done_ids.extend(owned_ids(g))
+                else:
+                    _webhook_job_retry(conn, owned_ids(g), worker_id, g["attempts"], "upsert failed")
+        if done_ids:
+            _webhook_job_done(conn, done_ids, worker_id)
+
+_webhook_wakeup = threading.Condition()
+_webhook_wakeup_seq = 0
+
+def _webhook_wake_workers() -> None:
+    global _webhook_wakeup_seq
+    with _webhook_wakeup:
+        _webhook_wakeup_seq += 1
+        _webhook_wakeup.notify_all()
+
+def _webhook_next_due_in() -> Optional[float]:
+    """Seconds until the earliest queued job becomes due (debounce / retry backoff); None if the queue is empty."""
+    with pg_connection(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT EXTRACT(EPOCH FROM (min(next_run_at) - now()))
+                FROM public.b24_webhook_queue
+                WHERE status IN ('new','retry','pending')
+            """)
+            row = cur.fetchone()
+    return float(row[0]) if row and row[0] is not None else None
+
+def _webhook_wait_for_work(wake_seq: int, stop_event: threading.Event) -> None:
+    """
+    Block until a NOTIFY arrived after `wake_seq` was read, the next queued job is due, or the fallback
+    poll interval passes — whichever comes first.
+    """
+    if not WEBHOOK_LISTEN_ENABLED:
+        time.sleep(1.0)
+        return
+    timeout = WEBHOOK_FALLBACK_POLL_SEC
+    due_in = _webhook_next_due_in()
+    if due_in is not None:
+        timeout = min(timeout, max(0.05, due_in))
+    with _webhook_wakeup:
+        _webhook_wakeup.wait_for(lambda: _webhook_wakeup_seq != wake_seq or stop_event.is_set(), timeout)
+
+def webhook_notify_listener(stop_event: threading.Event) -> None:
+    """LISTEN on one persistent connection per process; every NOTIFY from enqueue wakes the queue workers."""
+    logi(f"INFO: webhook_notify_listener started (channel={WEBHOOK_NOTIFY_CHANNEL})")
+    while not stop_event.is_set():
+        conn = None
+        try:
+            # соединение из пула занято слушателем на всё время его работы
+            conn = pg_pool_conn()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {WEBHOOK_NOTIFY_CHANNEL}")
+            # after (re)connect we may have missed notifications
+            _webhook_wake_workers()
+            while not stop_event.is_set():
+                if select.select([conn], [], [], WEBHOOK_FALLBACK_POLL_SEC) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    del conn.notifies[:]
+                    _webhook_wake_workers()
+        except Exception as e:
+            logi(f"ERROR: webhook_notify_listener: {e}")
+            time.sleep(2.0)
+        finally:
+            if conn is not None:
                 try:
-                    ok = _upsert_single_item(connu, ek, item)
-                finally:
-                    connu.close()
+                    with conn.cursor() as cur:
+                        cur.execute("UNLISTEN *")
+                except Exception:
+                    pass
+                conn.close()
+    logi("INFO: webhook_notify_listener stopped")
 
-                connf = pg_conn(); connf.autocommit=True
-                with connf.cursor() as curf:
-                    if ok:
-                        curf.execute("UPDATE public.b24_webhook_queue SET status='done', processed_at=now(), last_error=NULL WHERE id=%s", (qid,))
-                    else:
-                        backoff = min(300, 5 * (attempts + 1))
-                        curf.execute("""
-                            UPDATE public.b24_webhook_queue
-                            SET status='retry', attempts=attempts+1,
-                                last_error=%s,
-                                next_run_at=now() + (%s || ' seconds')::interval
-                            WHERE id=%s
-                        """, ("upsert failed", backoff, qid))
-                connf.close()
+@bitrix_priority("high")
+def webhook_queue_worker(stop_event: threading.Event, worker_no: int = 0) -> None:
+    """
+    One queue consumer. Safe to run WEBHOOK_WORKER_CONCURRENCY threads per process and in every uvicorn
+    worker: jobs are claimed with FOR UPDATE SKIP LOCKED. Worker 0 of each process also runs the lease reaper.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{worker_no}"
+    logi(f"INFO: webhook_queue_worker {worker_id} started")
+    next_reap_at = 0.0
+    next_purge_at = time.time() + 60
+    while not stop_event.is_set():
+        try:
+            if worker_no == 0 and time.time() >= next_reap_at:
+                requeued = _requeue_expired_webhook_jobs()
+                if requeued:
+                    logi(f"WARNING: webhook_queue_worker: requeued {requeued} jobs with expired lease")
+                next_reap_at = time.time() + max(5, WEBHOOK_LEASE_SEC // 2)
+            if worker_no == 0 and time.time() >= next_purge_at:
+                next_purge_at = time.time() + WEBHOOK_RETENTION_INTERVAL_SEC
+                purged = purge_webhook_queue()
+                if purged:
+                    logi(f"INFO: webhook_queue_worker: retention removed {purged} done jobs older than {WEBHOOK_RETENTION_DAYS}d")
+
+            # portal is blocked (OVERLOAD_LIMIT): all workers of all processes wait for the breaker
+            circuit_pause = bitrix_circuit_remaining()
+            if circuit_pause > 0:
+                stop_event.wait(min(circuit_pause, 5.0))
+                continue
+
+            wake_seq = _webhook_wakeup_seq
+            jobs = _claim_webhook_jobs(worker_id, WEBHOOK_CLAIM_BATCH)
+            if not jobs:
+                _webhook_wait_for_work(wake_seq, stop_event)
+                continue
+            _process_webhook_jobs(jobs, stop_event, worker_id)
 
         except Exception as e:
             logi(f"ERROR: webhook_queue_worker: {e}")
             traceback.print_exc()
             time.sleep(2.0)
 
-    logi("INFO: webhook_queue_worker stopped")
+    logi(f"INFO: webhook_queue_worker {worker_id} stopped")
 
 WEBHOOK_WORKER_STOP = threading.Event()
-WEBHOOK_WORKER_THREAD: Optional[threading.Thread] = None
+WEBHOOK_WORKER_THREADS: List[threading.Thread] = []
+WEBHOOK_LISTENER_THREAD: Optional[threading.Thread] = None
+
+def start_webhook_workers() -> None:
+    """Start (or restart dead) WEBHOOK_WORKER_CONCURRENCY queue worker threads and the NOTIFY listener."""
+    global WEBHOOK_LISTENER_THREAD
+    if WEBHOOK_LISTEN_ENABLED and (WEBHOOK_LISTENER_THREAD is None or not WEBHOOK_LISTENER_THREAD.is_alive()):
+        WEBHOOK_LISTENER_THREAD = threading.Thread(target=webhook_notify_listener, args=(WEBHOOK_WORKER_STOP,), daemon=True, name="webhook-listener")
+        WEBHOOK_LISTENER_THREAD.start()
+    for n in range(WEBHOOK_WORKER_CONCURRENCY):
+        if n < len(WEBHOOK_WORKER_THREADS) and WEBHOOK_WORKER_THREADS[n].is_alive():
+            continue
+        t = threading.Thread(target=webhook_queue_worker, args=(WEBHOOK_WORKER_STOP, n), daemon=True, name=f"webhook-worker-{n}")
+        if n < len(WEBHOOK_WORKER_THREADS):
+            WEBHOOK_WORKER_THREADS[n] = t
+        else:
+            WEBHOOK_WORKER_THREADS.append(t)
+        t.start()
+
+@app.get("/webhooks/b24/queue-stats")
+def webhook_queue_stats_endpoint():
+    try:
+        return {"ok": True, **webhook_queue_stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=repr(e))
+
+@app.get("/webhooks/b24/dead-letter")
+def webhook_dead_letter_endpoint(entity_key: Optional[str] = None, limit: int = Query(100, ge=1, le=1000)):
+    with pg_connection(autocommit=True) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("""
+                SELECT id, entity_key, entity_id, COALESCE(event_name, event) AS event_name,
+                       attempts, last_error, received_at, next_run_at
+                FROM public.b24_webhook_queue
+                WHERE status = 'dead' AND (%s::text IS NULL OR entity_key = %s)
+                ORDER BY id DESC
+                LIMIT %s
+            """, (entity_key, entity_key, int(limit)))
+            rows = cur.fetchall() or []
+    return {"ok": True, "count": len(rows), "items": rows, "circuit_open_sec": round(bitrix_circuit_remaining(), 1)}
+
+@app.post("/webhooks/b24/dead-letter/replay")
+def webhook_dead_letter_replay_endpoint(
+    ids: Optional[str] = Query(None, description="ID строк очереди через запятую; по умолчанию все dead"),
+    entity_key: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=100000),
+):
+    try:
+        id_list = [int(x) for x in ids.split(",") if x.strip()] if ids else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    return {"ok": True, "replayed": replay_dead_webhook_jobs(id_list, entity_key, limit)}
 
 @app.post("/webhooks/b24/dynamic-item-update")
 async def b24_dynamic_item_update(request: Request):
@@ -3471,8 +5760,10 @@ async def b24_dynamic_item_update(request: Request):
             logi(f"WARNING: webhook parse failed: cannot int(entity_id) from '{entity_id_str}'")
             return {"ok": True, "queued": False}
 
-        # --- 5) enqueue ---
-        _enqueue_webhook_event(entity_key, entity_id, norm_event, payload)
+        # --- 5) enqueue (in-memory buffer; the flusher writes to b24_webhook_queue in bulk) ---
+        if not _buffer_webhook_event(entity_key, entity_id, norm_event, payload):
+            logi(f"WARNING: webhook buffer full ({WEBHOOK_BUFFER_MAX}), rejecting {entity_key}:{entity_id}")
+            return JSONResponse(status_code=503, content={"ok": False, "queued": False}, headers={"Retry-After": "5"})
         return {"ok": True, "queued": True, "entity_key": entity_key, "entity_id": entity_id}
 
     except Exception as e:
@@ -3536,9 +5827,18 @@ def _daily_reports_cron_thread():
         time.sleep(check_interval_sec)
 
 
+@app.on_event("shutdown")
+def on_shutdown():
+    # события, принятые webhook-ом, но ещё не записанные в очередь
+    flush_webhook_buffer()
+
+
 @app.on_event("startup")
 def on_startup():
 
+    # Пул соединений PG: открываем PG_POOL_MIN соединений заранее
+    pg_pool_warm_up()
+
     # Ежедневная отправка отчётов в 23:55 (те же 7 PDF в Telegram и в Bitrix)
     report_cron_thread = threading.Thread(target=_daily_reports_cron_thread, daemon=True)
     report_cron_thread.start()
@@ -3554,16 +5854,20 @@ def on_startup():
     # WEBHOOK ONLY: do not poll Bitrix, process only outbound events
     if WEBHOOK_ONLY:
         ensure_webhook_queue_schema()
-        global WEBHOOK_WORKER_THREAD
-        if WEBHOOK_WORKER_THREAD is None or not WEBHOOK_WORKER_THREAD.is_alive():
-            WEBHOOK_WORKER_THREAD = threading.Thread(target=webhook_queue_worker, args=(WEBHOOK_WORKER_STOP,), daemon=True)
-            WEBHOOK_WORKER_THREAD.start()
+        start_webhook_workers()
         print("WEBHOOK ONLY MODE: polling is disabled; waiting for outbound Bitrix events...", flush=True)
         return
     # Синхронизируем данные из Bitrix сразу при старте сервиса (в отдельном потоке, чтобы не блокировать запуск)
     # Это обеспечивает: БИТРИКС -> БАЗА -> PDF
     initial_sync_thread = threading.Thread(target=_initial_sync_thread, daemon=True)
     initial_sync_thread.start()
+
+    # Незавершённые задачи полной пересинхронизации продолжаются с последнего чекпоинта
+    threading.Thread(target=_resume_sync_jobs_thread, daemon=True).start()
+
+    # Сверка удалений: polling не видит удалённые в Bitrix элементы
+    if RECONCILE_INTERVAL_SEC > 0:
+        threading.Thread(target=_reconcile_scheduler_thread, daemon=True).start()
     
     # Запускаем фоновую синхронизацию каждые 30 секунд
     t = threading.Thread(target=background_loop, daemon=True)
@@ -3865,13 +6169,13 @@ def _entity_table_custom_field_storage_pg_type(field_type: str) -> str:
 def _entity_table_add_physical_custom_field_column(conn, storage_table: str, storage_column: str, storage_pg_type: str) -> None:
     ensure_table_base(conn, storage_table)
     ensure_columns(conn, storage_table, [(storage_column, storage_pg_type)])
-    _ENTITY_TABLE_EDITOR_TABLE_COL_CACHE.pop(str(storage_table), None)
+    bump_schema_version(conn)
 
 
 def _entity_table_drop_physical_custom_field_column(conn, storage_table: str, storage_column: str) -> None:
     with conn.cursor() as cur:
         cur.execute(f'ALTER TABLE {storage_table} DROP COLUMN IF EXISTS "{storage_column}";')
-    _ENTITY_TABLE_EDITOR_TABLE_COL_CACHE.pop(str(storage_table), None)
+    bump_schema_version(conn)
     conn.commit()
 
 
@@ -4701,13 +7005,7 @@ def _entity_table_editor_find_direct_join_from_target(
     target_table: str,
     ref_entity_key: str,
 ) -> Optional[Dict[str, Any]]:
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("""
-            SELECT column_name, b24_field, b24_type, settings
-            FROM b24_meta_fields
-            WHERE entity_key=%s
-        """, (target_entity_key,))
-        rows = cur.fetchall() or []
+    rows = _entity_table_meta_field_rows(conn, target_entity_key)
 
     existing_cols = _table_columns_cached(conn, target_table)
     matches: List[Dict[str, Any]] = []
@@ -4772,13 +7070,7 @@ def _entity_table_editor_find_reverse_join_from_target_hint(
         return None
 
     meta_aliases = _entity_table_editor_entity_key_meta_aliases(ref_entity_key)
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("""
-            SELECT column_name, b24_field, b24_type, settings
-            FROM b24_meta_fields
-            WHERE entity_key = ANY(%s)
-        """, (meta_aliases,))
-        rows = cur.fetchall() or []
+    rows = [r for alias in dict.fromkeys(meta_aliases) for r in _entity_table_meta_field_rows(conn, alias)]
 
     matches: List[Dict[str, Any]] = []
     target_only_matches: List[Dict[str, Any]] = []
@@ -5074,13 +7366,7 @@ def _entity_table_editor_resolve_column(conn, entity_key: str, table_name: str,
             "settings": None,
         }
 
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("""
-            SELECT column_name, b24_field, b24_type, b24_title, b24_labels, settings
-            FROM b24_meta_fields
-            WHERE entity_key=%s
-        """, (entity_key,))
-        rows = cur.fetchall() or []
+    rows = _entity_table_meta_field_rows(conn, entity_key)
 
     for meta in rows:
         col = str(meta.get("column_name") or "").strip()
@@ -5121,13 +7407,7 @@ def _entity_table_editor_resolve_column_tech(conn, entity_key: str, table_name:
             "settings": None,
         }
 
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("""
-            SELECT column_name, b24_field, b24_type, b24_title, settings
-            FROM b24_meta_fields
-            WHERE entity_key=%s
-        """, (entity_key,))
-        rows = cur.fetchall() or []
+    rows = _entity_table_meta_field_rows(conn, entity_key)
 
     for meta in rows:
         col = str(meta.get("column_name") or "").strip()
@@ -5161,23 +7441,27 @@ def _entity_table_editor_resolve_column_tech(conn, entity_key: str, table_name:
     raise HTTPException(status_code=400, detail=f"Unknown field technical code '{field_code}' for entity '{entity_key}'")
 
 
-_ENTITY_TABLE_EDITOR_TABLE_COL_CACHE: Dict[str, set] = {}
-
-
+@cached_meta("table_columns")
 def _table_columns_cached(conn, table_name: str) -> set:
-    cache_key = str(table_name)
-    cols = _ENTITY_TABLE_EDITOR_TABLE_COL_CACHE.get(cache_key)
-    if cols is not None:
-        return cols
     with conn.cursor() as cur:
         cur.execute("""
             SELECT column_name
             FROM information_schema.columns
             WHERE table_schema='public' AND table_name=%s
         """, (table_name,))
-        cols = {str(r[0]) for r in (cur.fetchall() or []) if r and r[0]}
-    _ENTITY_TABLE_EDITOR_TABLE_COL_CACHE[cache_key] = cols
-    return cols
+        return {str(r[0]) for r in (cur.fetchall() or []) if r and r[0]}
+
+
+@cached_meta("entity_table_meta_fields")
+def _entity_table_meta_field_rows(conn, entity_key: str) -> List[Dict[str, Any]]:
+    """Строки b24_meta_fields сущности для резолва колонок entity-table (только чтение — общие для всех вызовов)."""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("""
+            SELECT column_name, b24_field, b24_type, b24_title, b24_labels, settings
+            FROM b24_meta_fields
+            WHERE entity_key=%s
+        """, (entity_key,))
+        return [dict(r) for r in (cur.fetchall() or [])]
 
 
 def _entity_table_editor_parse_number(v: Any) -> Optional[float]:
@@ -6413,9 +8697,14 @@ def _entity_table_write_custom_field_row_values(
     return len(updates)
 
 
-def _entity_table_write_custom_field_scalar_value(conn, storage_table: str, storage_column: str, scalar_value: Optional[str]) -> int:
+def _entity_table_write_custom_field_scalar_value(
+    conn, storage_table: str, storage_column: str, scalar_value: Optional[str], only_changed: bool = False
+) -> int:
+    # only_changed: пишем только строки, где значение отличается (новые строки / значение агрегата изменилось)
+    cond = f' AND "{storage_column}" IS DISTINCT FROM %s' if only_changed else ""
+    params = (scalar_value, scalar_value) if only_changed else (scalar_value,)
     with conn.cursor() as cur:
-        cur.execute(f'UPDATE "{storage_table}" SET "{storage_column}"=%s WHERE id IS NOT NULL;', (scalar_value,))
+        cur.execute(f'UPDATE "{storage_table}" SET "{storage_column}"=%s WHERE id IS NOT NULL{cond};', params)
         updated = int(cur.rowcount or 0)
     return updated
 
@@ -6450,12 +8739,16 @@ def _entity_table_recalculate_custom_field_editor(conn, row: Dict[str, Any]) ->
         resolver_debug_limit = 1
     if resolver_debug_limit > 200:
         resolver_debug_limit = 200
+    # _only_ids: пересчёт только для изменившихся строк (change propagation после webhook upsert)
+    only_ids: Optional[List[int]] = [int(x) for x in row["_only_ids"]] if row.get("_only_ids") is not None else None
     if _entity_table_editor_ast_has_aggregate(ast):
         value = _entity_table_editor_eval_ast(conn, ast, row)
         if isinstance(value, tuple) and value and value[0] == "field_ref":
             raise HTTPException(status_code=400, detail="editor cannot resolve to a direct field reference without aggregate/scalar function")
         text_value = _entity_table_editor_format_result_for_text(value)
-        updated_rows = _entity_table_write_custom_field_scalar_value(conn, storage_table, storage_column, text_value)
+        updated_rows = _entity_table_write_custom_field_scalar_value(
+            conn, storage_table, storage_column, text_value, only_changed=only_ids is not None
+        )
         mode = "editor_eval"
         mode_detail = "aggregate"
         value_preview = text_value
@@ -6563,7 +8856,10 @@ def _entity_table_recalculate_custom_field_editor(conn, row: Dict[str, Any]) ->
         select_cols = [c for c in cols_needed if c]
         cols_sql = ", ".join(f'"{c}"' for c in select_cols)
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(f'SELECT {cols_sql} FROM "{storage_table}" WHERE id IS NOT NULL')
+            if only_ids is not None:
+                cur.execute(f'SELECT {cols_sql} FROM "{storage_table}" WHERE id = ANY(%s)', (only_ids,))
+            else:
+                cur.execute(f'SELECT {cols_sql} FROM "{storage_table}" WHERE id IS NOT NULL')
             rows = cur.fetchall() or []
 
         # Debug refs: capture resolved values for all row-wise refs/tokens.
@@ -6627,33 +8923,34 @@ def _entity_table_recalculate_custom_field_editor(conn, row: Dict[str, Any]) ->
         mode_detail = "row_wise"
         value_preview = updates[0][1] if updates else None
         # Align recalculate preview snippet with /preview sampling logic for mixed/nested row-wise formulas.
-        try:
-            preview_row = dict(row)
-            preview_row["storage_table"] = storage_table
-            preview_row["storage_column"] = storage_column
-            preview_row["storage_pg_type"] = row.get("storage_pg_type") or "TEXT"
-            preview_info = _entity_table_preview_custom_field_editor(conn, preview_row)
-            if isinstance(preview_info, dict):
-                value_preview = preview_info.get("sample_value", value_preview)
-                sample_row_id = preview_info.get("sample_row_id")
-                stored_sample_value = None
-                if sample_row_id not in (None, ""):
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            f'SELECT "{storage_column}" FROM "{storage_table}" WHERE id=%s LIMIT 1',
-                            (int(sample_row_id),)
-                        )
-                        rr = cur.fetchone()
-                        stored_sample_value = rr[0] if rr else None
-                materialization_debug = {
-                    "preview_sample_row_id": sample_row_id,
-                    "preview_sample_value": preview_info.get("sample_value"),
-                    "stored_sample_value": stored_sample_value,
-                    "updates_total": len(updates),
-                    "updates_nonempty": sum(1 for _, v in updates if v not in (None, "")),
-                }
-        except Exception:
-            pass
+        if only_ids is None:  # incremental recalculation: no preview sampling over the whole table
+            try:
+                preview_row = dict(row)
+                preview_row["storage_table"] = storage_table
+                preview_row["storage_column"] = storage_column
+                preview_row["storage_pg_type"] = row.get("storage_pg_type") or "TEXT"
+                preview_info = _entity_table_preview_custom_field_editor(conn, preview_row)
+                if isinstance(preview_info, dict):
+                    value_preview = preview_info.get("sample_value", value_preview)
+                    sample_row_id = preview_info.get("sample_row_id")
+                    stored_sample_value = None
+                    if sample_row_id not in (None, ""):
+                        with conn.cursor() as cur:
+                            cur.execute(
+                                f'SELECT "{storage_column}" FROM "{storage_table}" WHERE id=%s LIMIT 1',
+                                (int(sample_row_id),)
+                            )
+                            rr = cur.fetchone()
+                            stored_sample_value = rr[0] if rr else None
+                    materialization_debug = {
+                        "preview_sample_row_id": sample_row_id,
+                        "preview_sample_value": preview_info.get("sample_value"),
+                        "stored_sample_value": stored_sample_value,
+                        "updates_total": len(updates),
+                        "updates_nonempty": sum(1 for _, v in updates if v not in (None, "")),
+                    }
+            except Exception:
+                pass
 
     out = {
         "updated_rows": updated_rows,
@@ -7797,7 +10094,9 @@ def health():
             "deal_limit": AUTO_SYNC_DEAL_LIMIT,
             "smart_limit": AUTO_SYNC_SMART_LIMIT,
             "time_budget_sec": SYNC_TIME_BUDGET_SEC,
-        }
+        },
+        "webhook_queue": webhook_queue_metrics(),
+        "meta_cache": meta_cache_stats(),
     }
 
 @app.post("/sync/schema")
@@ -7944,18 +10243,16 @@ def run_sync_reference_data() -> None:
         sync_smart_process_stages(conn)
         sync_deal_types(conn)
         sync_companies(conn)
-        sync_field_enums(conn, "deal")
-        sync_field_enums(conn, "contact")
-        sync_field_enums(conn, "lead")
-        sync_field_enums(conn, "company")
         with conn.cursor() as cur:
             cur.execute("SELECT entity_key FROM b24_meta_entities WHERE entity_key LIKE 'sp:%'")
-            for row in cur.fetchall():
-                sync_field_enums(conn, row[0])
+            sp_keys = [row[0] for row in cur.fetchall()]
+        sync_field_enums_many(conn, ["deal", "contact", "lead", "company"] + sp_keys)
         sync_userfield_titles(conn, "deal")
         sync_userfield_titles(conn, "contact")
         sync_userfield_titles(conn, "lead")
         sync_userfield_titles(conn, "company")
+        bump_schema_version(conn)
+        conn.commit()
     except Exception as e:
         print(f"WARNING: run_sync_reference_data: {e}", file=sys.stderr, flush=True)
     finally:
@@ -7989,19 +10286,18 @@ def sync_reference_data_endpoint(debug: Optional[str] = Query(None, description=
         sync_companies(conn)
         sync_sources_from_status(conn)
         sync_sources_classifier(conn)
-        enum_deal_n, enum_deal_notes = sync_field_enums(conn, "deal")
-        all_notes.extend(enum_deal_notes)
-        sync_field_enums(conn, "contact")
-        sync_field_enums(conn, "lead")
-        sync_field_enums(conn, "company")
         with conn.cursor() as cur:
             cur.execute("SELECT entity_key FROM b24_meta_entities WHERE entity_key LIKE 'sp:%'")
-            for row in cur.fetchall():
-                sync_field_enums(conn, row[0])
+            sp_keys = [row[0] for row in cur.fetchall()]
+        enum_results = sync_field_enums_many(conn, ["deal", "contact", "lead", "company"] + sp_keys)
+        enum_deal_n, enum_deal_notes = enum_results.get("deal", (0, []))
+        all_notes.extend(enum_deal_notes)
         titles_deal = sync_userfield_titles(conn, "deal")
         titles_contact = sync_userfield_titles(conn, "contact")
         titles_lead = sync_userfield_titles(conn, "lead")
         sync_userfield_titles(conn, "company")
+        bump_schema_version(conn)
+        conn.commit()
         with conn.cursor() as cur:
             cur.execute("SELECT COUNT(*) FROM b24_deal_categories")
             cat_count = cur.fetchone()[0]
@@ -8120,36 +10416,92 @@ def sync_data_endpoint(deal_limit: int = 0, smart_limit: int = 0, time_budget_se
 @app.post("/sync/data/full")
 def sync_data_full_endpoint():
     """
-    Принудительная полная синхронизация всех сделок и smart processes.
-    Запускается в фоновом потоке, чтобы не блокировать ответ.
+    Принудительная полная синхронизация всех сделок, контактов, лидов и smart processes.
+    Запускается как задача b24_sync_jobs (с чекпоинтами): переживает рестарт, прогресс — GET /sync/jobs/{id}.
     Возвращает сразу, синхронизация продолжается в фоне.
     """
-    def _full_sync():
-        try:
-            print("INFO: sync_data_full_endpoint: Starting full sync in background...", file=sys.stderr, flush=True)
-            # Полная синхронизация без ограничений по времени и количеству
-            result = sync_data(
-                deal_limit=0,  # Без ограничений
-                smart_limit=0,  # Без ограничений
-                time_budget_sec=3600,  # 1 час на синхронизацию
-                contact_limit=0,  # Без ограничений
-                lead_limit=0  # Без ограничений
-            )
-            print(f"INFO: sync_data_full_endpoint: Full sync completed: {result}", file=sys.stderr, flush=True)
-        except Exception as e:
-            print(f"ERROR: sync_data_full_endpoint: Full sync failed: {e}", file=sys.stderr, flush=True)
-            traceback.print_exc()
-    
-    # Запускаем в отдельном потоке
-    t = threading.Thread(target=_full_sync, daemon=True)
-    t.start()
-    
+    try:
+        job = create_sync_job()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=repr(e))
     return {
         "ok": True,
-        "message": "Full sync started in background. Check logs for progress.",
-        "note": "This may take several minutes depending on the number of deals."
+        "message": "Full sync started in background. Progress: GET /sync/jobs/{id}.",
+        "note": "This may take several minutes depending on the number of deals.",
+        "job": job,
     }
 
+
+def _parse_sync_job_entities(entities: Optional[str]) -> Optional[List[str]]:
+    if not entities:
+        return None
+    keys = [x.strip() for x in entities.split(",") if x.strip()]
+    conn = pg_conn()
+    try:
+        ensure_meta_tables(conn)
+        allowed = set(_sync_job_entity_keys(conn))
+    finally:
+        conn.close()
+    unknown = [k for k in keys if k not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown entities: {unknown}. Allowed: {sorted(allowed)}")
+    return keys
+
+
+@app.post("/sync/jobs")
+def create_sync_job_endpoint(
+    entities: Optional[str] = Query(None, description="Сущности через запятую (deal,contact,lead,sp:1036); по умолчанию все")
+):
+    """Новая задача полной пересинхронизации (с ID 0) с чекпоинтами, паузой и продолжением."""
+    return {"ok": True, "job": create_sync_job(_parse_sync_job_entities(entities))}
+
+
+@app.post("/sync/reconcile")
+def create_reconcile_job_endpoint(
+    entities: Optional[str] = Query(None, description="Сущности через запятую (deal,contact,lead,sp:1036); по умолчанию все")
+):
+    """Сверка удалений: строки, которых больше нет в Bitrix, удаляются. Прогресс — GET /sync/jobs/{id}."""
+    return {"ok": True, "job": create_sync_job(_parse_sync_job_entities(entities), kind="reconcile")}
+
+
+@app.get("/sync/jobs")
+def list_sync_jobs_endpoint(limit: int = Query(20, ge=1, le=200)):
+    conn = pg_conn()
+    try:
+        ensure_sync_jobs_schema(conn)
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("SELECT * FROM b24_sync_jobs ORDER BY id DESC LIMIT %s", (int(limit),))
+            rows = cur.fetchall()
+        return {"ok": True, "jobs": [_sync_job_view(dict(r)) for r in rows]}
+    finally:
+        conn.close()
+
+
+@app.get("/sync/jobs/{job_id}")
+def get_sync_job_endpoint(job_id: int):
+    job = get_sync_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return {"ok": True, "job": job}
+
+
+@app.post("/sync/jobs/{job_id}/pause")
+def pause_sync_job_endpoint(job_id: int):
+    job = pause_sync_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return {"ok": True, "job": job}
+
+
+@app.post("/sync/jobs/{job_id}/resume")
+def resume_sync_job_endpoint(job_id: int):
+    job = resume_sync_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return {"ok": True, "job": job}
+
 @app.post("/sync/update-assigned-by-names")
 def update_assigned_by_names_endpoint(limit: int = 1000, time_budget_sec: int = 60):
     """
@@ -8179,6 +10531,9 @@ def update_assigned_by_names_endpoint(limit: int = 1000, time_budget_sec: int =
         
         updated = 0
         start_time = time.time()
+        _user_name_cache.update(_fetch_user_names(
+            [str(a).strip() for _, a in deals_to_update if str(a).strip() not in _user_name_cache]
+        ))
         
         for deal_id, assigned_by_id in deals_to_update:
             # Проверяем time budget
@@ -8187,37 +10542,7 @@ def update_assigned_by_names_endpoint(limit: int = 1000, time_budget_sec: int =
                 break
             
             user_id_str = str(assigned_by_id).strip()
-            
-            # Проверяем кэш
-            if user_id_str in _user_name_cache:
-                assigned_by_name = _user_name_cache[user_id_str]
-            else:
-                try:
-                    user_resp = b24.call("user.get", {"ID": user_id_str})
-                    if user_resp and "result" in user_resp and len(user_resp["result"]) > 0:
-                        user = user_resp["result"][0]
-                        name = user.get("NAME", "").strip()
-                        last_name = user.get("LAST_NAME", "").strip()
-                        if name and last_name:
-                            assigned_by_name = f"{name} {last_name}"
-                        elif name:
-                            assigned_by_name = name
-                        elif last_name:
-                            assigned_by_name = last_name
-                        elif user.get("FULL_NAME"):
-                            assigned_by_name = str(user.get("FULL_NAME")).strip()
-                        elif user.get("LOGIN"):
-                            assigned_by_name = str(user.get("LOGIN")).strip()
-                        else:
-                            assigned_by_name = None
-                        _user_name_cache[user_id_str] = assigned_by_name or user_id_str
-                    else:
-                        assigned_by_name = None
-                        _user_name_cache[user_id_str] = user_id_str
-                except Exception as e:
-                    print(f"WARNING: Failed to get user name for deal {deal_id}, user_id {user_id_str}: {e}", file=sys.stderr, flush=True)
-                    assigned_by_name = None
-                    _user_name_cache[user_id_str] = user_id_str
+            assigned_by_name = _user_name_cache.get(user_id_str)
             
             # Обновляем в базе
             if assigned_by_name and assigned_by_name != user_id_str:
@@ -8289,6 +10614,28 @@ def _user_record_to_name(u: Dict[str, Any]) -> Optional[str]:
     return (u.get("FULL_NAME") or u.get("LOGIN") or "").strip() or None
 
 
+def _fetch_user_names(user_ids: List[str]) -> Dict[str, str]:
+    """
+    Имена пользователей по ID через batch user.get (до 50 пользователей за один запрос к Bitrix).
+    Для ID без имени (или если Bitrix не ответил) возвращается сам ID — как негативный кэш в _user_name_cache.
+    """
+    ids: List[int] = []
+    for uid in dict.fromkeys(user_ids or []):
+        try:
+            ids.append(int(uid))
+        except (TypeError, ValueError):
+            continue
+    out: Dict[str, str] = {str(uid).strip(): str(uid).strip() for uid in user_ids or [] if str(uid).strip()}
+    if not ids:
+        return out
+    fetched = _bitrix_get_many([("user", uid) for uid in ids])
+    for (_, uid), user in fetched.items():
+        name = _user_record_to_name(user) if isinstance(user, dict) else None
+        if name:
+            out[str(uid)] = name
+    return out
+
+
 def sync_all_users_from_bitrix(conn, time_budget_sec: int = 600) -> Dict[str, Any]:
     """
     Загрузить всех пользователей из Bitrix user.get (пагинация start=0, 50, 100, ...)
@@ -0,0 +1,265 @@
+"""
+Общий HTTP-транспорт для всех исходящих вызовов Bitrix24 REST.
+
+Один requests.Session на процесс: keep-alive + пул соединений (urllib3), чтобы каждый вызов
+не открывал заново TCP+TLS к порталу. Используется BitrixClient (app.py), api_data.py
+(user.get, отправка PDF) и daily_auto_home_png_report.py.
+
+Настройки (env):
+  BITRIX_HTTP_POOL_SIZE        — максимум соединений на хост (по умолчанию 10)
+  BITRIX_HTTP_POOL_HOSTS       — сколько хостов держать в пуле (портал + upload-хосты диска, по умолчанию 4)
+  BITRIX_HTTP_CONNECT_TIMEOUT  — таймаут установки соединения, сек (по умолчанию 10)
+  BITRIX_HTTP_READ_TIMEOUT     — таймаут чтения ответа по умолчанию, сек (по умолчанию 60)
+
+Лимитер запросов (общий для всех процессов на хосте: uvicorn-воркеры, webhook worker, отчёты).
+Bitrix считает лимит по порталу как "дырявое ведро": BITRIX_RATE_BURST запросов можно сделать сразу,
+дальше ведро освобождается со скоростью BITRIX_RATE_PER_SEC. Состояние ведра лежит в файле
+BITRIX_RATE_STATE_FILE, доступ сериализуется через flock — так все процессы тратят один бюджет.
+Классы приоритета: high (webhook), normal (по умолчанию), low (массовые ресинки, отчёты). Низшие
+классы не могут забрать последние BITRIX_RATE_RESERVE_NORMAL / BITRIX_RATE_RESERVE_LOW токенов.
+  BITRIX_RATE_LIMIT_ENABLED    — 1/0 (по умолчанию 1; 0 — старый троттлинг BitrixClient внутри процесса)
+  BITRIX_RATE_BURST            — размер ведра (по умолчанию 50, как у стандартного тарифа)
+  BITRIX_RATE_PER_SEC          — скорость пополнения, токенов/сек (по умолчанию 2)
+  BITRIX_RATE_RESERVE_NORMAL   — сколько токенов зарезервировано только для high (по умолчанию 5)
+  BITRIX_RATE_RESERVE_LOW      — сколько токенов недоступно low (по умолчанию 20)
+
+Circuit breaker (тоже общий для всех процессов, файл BITRIX_CIRCUIT_STATE_FILE): на OVERLOAD_LIMIT портал
+блокирует вызовы на время — BitrixClient открывает breaker, и фоновые потребители (очередь webhook)
+ждут его закрытия, вместо того чтобы каждый по отдельности продолжать долбить API. Повторное срабатывание
+сразу после закрытия удваивает паузу (до BITRIX_CIRCUIT_MAX_OPEN_SEC).
+  BITRIX_CIRCUIT_ENABLED       — 1/0 (по умолчанию 1)
+  BITRIX_CIRCUIT_OPEN_SEC      — первая пауза, сек (по умолчанию 30)
+  BITRIX_CIRCUIT_MAX_OPEN_SEC  — максимальная пауза, сек (по умолчанию 600)
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+try:
+    import fcntl  # type: ignore
+except ImportError:  # не-POSIX: лимитер работает только внутри процесса
+    fcntl = None  # type: ignore
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BITRIX_HTTP_POOL_SIZE = max(1, int(os.getenv("BITRIX_HTTP_POOL_SIZE", "10")))
+BITRIX_HTTP_POOL_HOSTS = max(1, int(os.getenv("BITRIX_HTTP_POOL_HOSTS", "4")))
+BITRIX_HTTP_CONNECT_TIMEOUT = float(os.getenv("BITRIX_HTTP_CONNECT_TIMEOUT", "10"))
+BITRIX_HTTP_READ_TIMEOUT = float(os.getenv("BITRIX_HTTP_READ_TIMEOUT", "60"))
+
+BITRIX_RATE_LIMIT_ENABLED = os.getenv("BITRIX_RATE_LIMIT_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+BITRIX_RATE_BURST = max(1.0, float(os.getenv("BITRIX_RATE_BURST", "50")))
+BITRIX_RATE_PER_SEC = max(0.1, float(os.getenv("BITRIX_RATE_PER_SEC", "2")))
+BITRIX_RATE_STATE_FILE = os.getenv("BITRIX_RATE_STATE_FILE", "/tmp/bitrix_rate_bucket.json")
+BITRIX_RATE_RESERVE = {
+    "high": 0.0,
+    "normal": min(BITRIX_RATE_BURST - 1, max(0.0, float(os.getenv("BITRIX_RATE_RESERVE_NORMAL", "5")))),
+    "low": min(BITRIX_RATE_BURST - 1, max(0.0, float(os.getenv("BITRIX_RATE_RESERVE_LOW", "20")))),
+}
+
+BITRIX_CIRCUIT_ENABLED = os.getenv("BITRIX_CIRCUIT_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+BITRIX_CIRCUIT_STATE_FILE = os.getenv("BITRIX_CIRCUIT_STATE_FILE", "/tmp/bitrix_circuit.json")
+BITRIX_CIRCUIT_OPEN_SEC = max(1.0, float(os.getenv("BITRIX_CIRCUIT_OPEN_SEC", "30")))
+BITRIX_CIRCUIT_MAX_OPEN_SEC = max(BITRIX_CIRCUIT_OPEN_SEC, float(os.getenv("BITRIX_CIRCUIT_MAX_OPEN_SEC", "600")))
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def bitrix_session() -> requests.Session:
+    """Общая keep-alive сессия процесса (создаётся лениво, потокобезопасно)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                # retries=0: повторы и backoff делает вызывающий код (BitrixClient), а не urllib3
+                adapter = HTTPAdapter(
+                    pool_connections=BITRIX_HTTP_POOL_HOSTS,
+                    pool_maxsize=BITRIX_HTTP_POOL_SIZE,
+                    max_retries=0,
+                    pool_block=False,
+                )
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+
+# -----------------------------
+# Лимитер (token bucket между процессами)
+# -----------------------------
+_priority: ContextVar[str] = ContextVar("bitrix_priority", default="normal")
+_state_thread_lock = threading.Lock()
+
+
+@contextmanager
+def bitrix_priority(priority: str) -> Iterator[None]:
+    """
+    Класс приоритета для всех Bitrix-вызовов внутри блока: "high" | "normal" | "low".
+    Можно использовать как декоратор функции потока: @bitrix_priority("low").
+    """
+    if priority not in BITRIX_RATE_RESERVE:
+        raise ValueError(f"Unknown bitrix priority: {priority}")
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def bitrix_rate_limiter_enabled() -> bool:
+    return BITRIX_RATE_LIMIT_ENABLED
+
+
+def _with_state_file(path: str, fn) -> Any:
+    """Под локом (flock + threading.Lock) читает JSON-состояние из файла, передаёт в fn(state) и записывает обратно."""
+    with _state_thread_lock:
+        f = None
+        try:
+            try:
+                f = open(path, "a+")
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                f.seek(0)
+                raw = f.read()
+            except OSError:
+                f, raw = None, ""
+            try:
+                state = json.loads(raw) if raw else {}
+            except ValueError:
+                state = {}
+            if not isinstance(state, dict):
+                state = {}
+            result = fn(state)
+            if f is not None:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            return result
+        finally:
+            if f is not None:
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                finally:
+                    f.close()
+
+
+def _bucket_update(fn) -> Any:
+    """Пополняет ведро по прошедшему времени и передаёт состояние в fn(state)."""
+    def _refill(state: Dict[str, Any]) -> Any:
+        now = time.time()
+        tokens = float(state.get("tokens", BITRIX_RATE_BURST))
+        ts = float(state.get("ts", now))
+        tokens = min(BITRIX_RATE_BURST, tokens + max(0.0, now - ts) * BITRIX_RATE_PER_SEC)
+        state.clear()
+        state.update({"tokens": tokens, "ts": now})
+        return fn(state)
+
+    return _with_state_file(BITRIX_RATE_STATE_FILE, _refill)
+
+
+def bitrix_rate_acquire(priority: Optional[str] = None) -> float:
+    """
+    Забирает один токен из общего ведра; ждёт, пока токен станет доступен для данного класса.
+    Возвращает время ожидания (сек).
+    """
+    if not BITRIX_RATE_LIMIT_ENABLED:
+        return 0.0
+    reserve = BITRIX_RATE_RESERVE.get(priority or _priority.get(), BITRIX_RATE_RESERVE["normal"])
+    waited = 0.0
+
+    def _take(state: Dict[str, float]) -> float:
+        if state["tokens"] - 1.0 >= reserve:
+            state["tokens"] -= 1.0
+            return 0.0
+        return (reserve + 1.0 - state["tokens"]) / BITRIX_RATE_PER_SEC
+
+    while True:
+        wait = _bucket_update(_take)
+        if wait <= 0:
+            return waited
+        # спим небольшими шагами: токены могли освободиться для более приоритетного процесса раньше
+        wait = min(wait, 1.0)
+        time.sleep(wait)
+        waited += wait
+
+
+def bitrix_rate_penalize() -> None:
+    """Bitrix ответил QUERY_LIMIT_EXCEEDED/429/OVERLOAD_LIMIT: опустошаем ведро для всех процессов."""
+    if not BITRIX_RATE_LIMIT_ENABLED:
+        return
+
+    def _drain(state: Dict[str, float]) -> None:
+        state["tokens"] = 0.0
+
+    _bucket_update(_drain)
+
+
+def bitrix_timeout(read_timeout: Optional[float] = None) -> Tuple[float, float]:
+    """(connect, read) таймаут: connect общий, read — переданный или BITRIX_HTTP_READ_TIMEOUT."""
+    return (BITRIX_HTTP_CONNECT_TIMEOUT, float(read_timeout) if read_timeout is not None else BITRIX_HTTP_READ_TIMEOUT)
+
+
+def bitrix_post(
+    url: str,
+    timeout: Union[None, float, Tuple[float, float]] = None,
+    rate_limited: bool = True,
+    **kwargs: Any,
+) -> requests.Response:
+    """
+    POST в Bitrix через общую сессию. timeout — число (таймаут чтения) или кортеж (connect, read).
+    rate_limited=False — для запросов, которые не являются REST-методами (uploadUrl диска).
+    Остальные аргументы — как у requests.post (json=, data=, files=).
+    """
+    if rate_limited:
+        bitrix_rate_acquire()
+    if not isinstance(timeout, tuple):
+        timeout = bitrix_timeout(timeout)
+    return bitrix_session().post(url, timeout=timeout, **kwargs)
+
+
+# -----------------------------
+# Circuit breaker (OVERLOAD_LIMIT)
+# -----------------------------
+def bitrix_circuit_trip() -> float:
+    """
+    Bitrix ответил OVERLOAD_LIMIT: открыть breaker для всех процессов. Уже открытый не продлевается
+    (каждый упавший вызов не должен отодвигать паузу). Возвращает, сколько секунд breaker ещё открыт.
+    """
+    if not BITRIX_CIRCUIT_ENABLED:
+        return 0.0
+
+    def _trip(state: Dict[str, Any]) -> float:
+        now = time.time()
+        open_until = float(state.get("open_until", 0))
+        if now < open_until:
+            return open_until - now
+        # сработал снова вскоре после закрытия — блокировка не снята, удваиваем паузу
+        trips = int(state.get("trips", 0)) + 1 if now - open_until < BITRIX_CIRCUIT_OPEN_SEC else 1
+        pause = min(BITRIX_CIRCUIT_MAX_OPEN_SEC, BITRIX_CIRCUIT_OPEN_SEC * (2 ** (trips - 1)))
+        state.clear()
+        state.update({"open_until": now + pause, "trips": trips})
+        print(f"WARNING: bitrix circuit breaker open for {pause:.0f}s (OVERLOAD_LIMIT, trip #{trips})", file=sys.stderr, flush=True)
+        return pause
+
+    return _with_state_file(BITRIX_CIRCUIT_STATE_FILE, _trip)
+
+
+def bitrix_circuit_remaining() -> float:
+    """Сколько секунд breaker ещё открыт (0 — закрыт, вызовы можно делать)."""
+    if not BITRIX_CIRCUIT_ENABLED:
+        return 0.0
+
+    def _read(state: Dict[str, Any]) -> float:
+        return max(0.0, float(state.get("open_until", 0)) - time.time())
+
+    return _with_state_file(BITRIX_CIRCUIT_STATE_FILE, _read)
@@ -8,8 +8,8 @@ from textwrap import shorten
 from typing import Any, Dict, List, Optional
 from zoneinfo import ZoneInfo
 
-import psycopg2
-import requests
+from bitrix_http import bitrix_post, bitrix_priority
+from pg_pool import pg_pool_conn
 from fastapi import APIRouter, HTTPException
 from psycopg2 import sql
 from reportlab.graphics import renderPM
@@ -48,18 +48,7 @@ def _log(msg: str) -> None:
 
 
 def _pg_conn():
-    conn = psycopg2.connect(
-        host=PG_HOST,
-        port=PG_PORT,
-        dbname=PG_DB,
-        user=PG_USER,
-        password=PG_PASS,
-    )
-    try:
-        conn.set_client_encoding("UTF8")
-    except Exception:
-        pass
-    return conn
+    return pg_pool_conn()
 
 
 def _table_columns(conn, table_name: str) -> List[str]:
@@ -167,7 +156,7 @@ def _bitrix_user_name(user_id: str) -> str:
     if not webhook:
         return ""
     try:
-        r = requests.post(f"{webhook}/user.get.json", json={"ID": uid}, timeout=15)
+        r = bitrix_post(f"{webhook}/user.get.json", json={"ID": uid}, timeout=15)
         r.raise_for_status()
         data = r.json()
         users = data.get("result") if isinstance(data, dict) else None
@@ -291,7 +280,7 @@ def _bitrix_list_items(entity_type_id: int, select_fields: List[str], order_desc
             "order": {"createdTime": "DESC" if order_desc else "ASC"},
             "start": start,
         }
-        r = requests.post(f"{webhook}/crm.item.list.json", json=payload, timeout=60)
+        r = bitrix_post(f"{webhook}/crm.item.list.json", json=payload, timeout=60)
         r.raise_for_status()
         data = r.json() if r.content else {}
         result = data.get("result") if isinstance(data, dict) else {}
@@ -458,7 +447,7 @@ def _build_png(rows: List[Dict[str, Any]]) -> bytes:
 def _bitrix_post(method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     webhook = BITRIX_WEBHOOK_REPORTS or BITRIX_WEBHOOK
     url = f"{webhook}/{method}.json"
-    r = requests.post(url, json=payload, timeout=60)
+    r = bitrix_post(url, json=payload, timeout=60)
     r.raise_for_status()
     data = r.json()
     if isinstance(data, dict) and data.get("error"):
@@ -488,10 +477,11 @@ def _send_png_to_chat(png_bytes: bytes, filename: str, caption: str) -> Dict[str
     if not upload_url:
         raise RuntimeError(f"disk.folder.uploadfile did not return uploadUrl: {init}")
 
-    upload_resp = requests.post(
+    upload_resp = bitrix_post(
         upload_url,
         files={field_name: (filename, png_bytes, "image/png")},
         timeout=120,
+        rate_limited=False,
     )
     upload_resp.raise_for_status()
     up_json = upload_resp.json() if "application/json" in (upload_resp.headers.get("content-type") or "") else {}
@@ -527,6 +517,7 @@ def _send_png_to_chat(png_bytes: bytes, filename: str, caption: str) -> Dict[str
     }
 
 
+@bitrix_priority("low")
 def generate_and_send_auto_home_png() -> Dict[str, Any]:
     rows = _fetch_rows()
     png = _build_png(rows)
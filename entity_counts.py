@@ -0,0 +1,236 @@
+"""
+total для списков (entity-meta-data, /api/data/deals, /api/processes-deals) без COUNT(*) на каждый запрос.
+
+Режимы (параметр total_mode, по умолчанию ENTITY_TOTAL_MODE):
+  exact     — SELECT COUNT(*), как раньше;
+  estimated — без фильтра pg_class.reltuples, с фильтром — оценка планировщика (EXPLAIN);
+  cached    — без фильтра / только по воронке — счётчик из b24_entity_counts; с другими фильтрами —
+              COUNT(*), запомненный на ENTITY_COUNTS_TTL_SEC.
+
+b24_entity_counts (table_name, category_id -> row_count; category_id '*' — вся таблица) пересчитывается
+одним GROUP BY, если после прошлого пересчёта в таблицу писали синк или вебхуки (mark_counts_dirty
+увеличивает b24_entity_counts_state.dirty_seq, пересчёт запоминает seq, по которому считал),
+но не чаще раза в ENTITY_COUNTS_REFRESH_SEC — на столько total в режиме cached может отставать.
+
+Настройки (env):
+  ENTITY_TOTAL_MODE         — режим по умолчанию (exact)
+  ENTITY_COUNTS_REFRESH_SEC — минимальный интервал пересчёта счётчиков таблицы (по умолчанию 30)
+  ENTITY_COUNTS_TTL_SEC     — сколько помнить COUNT(*) с произвольным фильтром в режиме cached (по умолчанию 60)
+"""
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+
+from pg_pool import pg_connection
+
+TOTAL_MODES = ("exact", "estimated", "cached")
+ENTITY_TOTAL_MODE = os.getenv("ENTITY_TOTAL_MODE", "exact").strip().lower()
+if ENTITY_TOTAL_MODE not in TOTAL_MODES:
+    ENTITY_TOTAL_MODE = "exact"
+ENTITY_COUNTS_REFRESH_SEC = max(0, int(os.getenv("ENTITY_COUNTS_REFRESH_SEC", "30")))
+ENTITY_COUNTS_TTL_SEC = max(0.0, float(os.getenv("ENTITY_COUNTS_TTL_SEC", "60")))
+
+_lock = threading.Lock()
+_schema_ready = False
+# (table, where_sql, params) -> (время, count) для режима cached с произвольным фильтром
+_filtered_counts: Dict[Tuple[str, str, str], Tuple[float, int]] = {}
+
+
+def _ensure_schema() -> None:
+    """Таблицы счётчиков — отдельным соединением, чтобы не коммитить транзакцию вызывающего."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with pg_connection(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS b24_entity_counts (
+                    table_name TEXT NOT NULL,
+                    category_id TEXT NOT NULL,
+                    row_count BIGINT NOT NULL,
+                    updated_at TIMESTAMPTZ DEFAULT now(),
+                    PRIMARY KEY (table_name, category_id)
+                );
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS b24_entity_counts_state (
+                    table_name TEXT PRIMARY KEY,
+                    category_col TEXT,
+                    dirty_seq BIGINT NOT NULL DEFAULT 0,
+                    refreshed_seq BIGINT,
+                    refreshed_at TIMESTAMPTZ
+                );
+            """)
+            cur.execute("ALTER TABLE b24_entity_counts_state ADD COLUMN IF NOT EXISTS dirty_seq BIGINT NOT NULL DEFAULT 0;")
+            cur.execute("ALTER TABLE b24_entity_counts_state ADD COLUMN IF NOT EXISTS refreshed_seq BIGINT;")
+    _schema_ready = True
+
+
+def resolve_total_mode(mode: Optional[str]) -> str:
+    m = (mode or ENTITY_TOTAL_MODE).strip().lower()
+    if m not in TOTAL_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid total_mode: '{mode}'. Must be one of {', '.join(TOTAL_MODES)}")
+    return m
+
+
+def mark_counts_dirty(conn, table: str) -> None:
+    """
+    Отметить, что в таблицу писали (upsert/delete): в транзакции conn, вызывать после самой записи,
+    прямо перед commit (строка состояния остаётся заблокированной до commit вызывающего).
+    Счётчик dirty_seq только растёт и коммитится вместе с данными: пересчёт, посчитавший таблицу
+    до этого commit, запомнит меньший seq, и следующий запрос в режиме cached пересчитает снова.
+    """
+    with _lock:
+        for key in [k for k in _filtered_counts if k[0] == table]:
+            _filtered_counts.pop(key, None)
+    try:
+        _ensure_schema()
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO b24_entity_counts_state (table_name, dirty_seq)
+                VALUES (%s, 1)
+                ON CONFLICT (table_name) DO UPDATE
+                SET dirty_seq = b24_entity_counts_state.dirty_seq + 1
+            """, (table,))
+    except Exception as e:
+        print(f"WARNING: entity_counts: mark dirty {table}: {e}", file=sys.stderr, flush=True)
+
+
+def _refresh_if_stale(conn, table: str, category_col: Optional[str]) -> None:
+    """
+    Пересчёт счётчиков таблицы, если они устарели. dirty_seq читается до подсчёта и без блокировки строки
+    состояния (пишущие транзакции не ждут пересчёта): всё, что закоммичено до чтения seq, попадёт в COUNT,
+    а более поздняя запись увеличит seq сверх запомненного. Параллельный пересчёт той же таблицы не ждём.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO b24_entity_counts_state (table_name) VALUES (%s) ON CONFLICT (table_name) DO NOTHING",
+            (table,),
+        )
+        conn.commit()
+        cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (f"b24_entity_counts:{table}",))
+        if not cur.fetchone()[0]:
+            conn.commit()
+            return
+        cur.execute("""
+            SELECT category_col,
+                   dirty_seq,
+                   refreshed_at IS NULL
+                   OR (%s::text IS NOT NULL AND category_col IS DISTINCT FROM %s::text)
+                   OR (dirty_seq > COALESCE(refreshed_seq, -1)
+                       AND refreshed_at < now() - make_interval(secs => %s))
+            FROM b24_entity_counts_state
+            WHERE table_name = %s
+        """, (category_col, category_col, ENTITY_COUNTS_REFRESH_SEC, table))
+        row = cur.fetchone()
+        if row and row[2]:
+            # без category_col (нужен только '*') сохраняем прежнюю разбивку по воронкам
+            category_col = category_col or row[0]
+            seen_seq = int(row[1] or 0)
+            if category_col:
+                # один проход по таблице: счётчики всех воронок сразу, NULL — под ''
+                safe_col = category_col.replace('"', '""')
+                cur.execute(f'SELECT COALESCE("{safe_col}"::text, \'\'), COUNT(*) FROM "{table}" GROUP BY 1')
+                counts = {str(k): int(n) for k, n in cur.fetchall()}
+                counts["*"] = sum(counts.values())
+            else:
+                cur.execute(f'SELECT COUNT(*) FROM "{table}"')
+                counts = {"*": int(cur.fetchone()[0])}
+            cur.execute("DELETE FROM b24_entity_counts WHERE table_name = %s", (table,))
+            for category_id, n in counts.items():
+                cur.execute("""
+                    INSERT INTO b24_entity_counts (table_name, category_id, row_count)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (table_name, category_id) DO UPDATE
+                    SET row_count = EXCLUDED.row_count, updated_at = now()
+                """, (table, category_id, n))
+            cur.execute("""
+                UPDATE b24_entity_counts_state
+                SET refreshed_at = now(), refreshed_seq = %s, category_col = %s
+                WHERE table_name = %s
+            """, (seen_seq, category_col, table))
+    conn.commit()
+
+
+def _cached_count(conn, table: str, category_col: Optional[str], category_value: Optional[str]) -> int:
+    _ensure_schema()
+    _refresh_if_stale(conn, table, category_col)
+    key = "*" if category_value is None else str(category_value)
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT row_count FROM b24_entity_counts WHERE table_name = %s AND category_id = %s",
+            (table, key),
+        )
+        row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def _reltuples(conn, table: str) -> Optional[int]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", (f'public."{table}"',))
+        row = cur.fetchone()
+    # -1 (PG14+) / 0 — таблицу ещё не анализировали: оценки нет
+    if not row or row[0] is None or int(row[0]) <= 0:
+        return None
+    return int(row[0])
+
+
+def _explain_rows(conn, table: str, where_sql: str, params: Sequence[Any]) -> Optional[int]:
+    with conn.cursor() as cur:
+        cur.execute(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM "{table}"{where_sql}', list(params))
+        plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    try:
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+def _exact_count(conn, table: str, where_sql: str, params: Sequence[Any]) -> int:
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT COUNT(*) FROM "{table}"{where_sql}', list(params))
+        return int(cur.fetchone()[0])
+
+
+def count_total(
+    conn,
+    table: str,
+    where_sql: str = "",
+    params: Sequence[Any] = (),
+    mode: Optional[str] = None,
+    category_col: Optional[str] = None,
+    category_value: Optional[str] = None,
+) -> Tuple[int, str]:
+    """
+    total для SELECT ... FROM table{where_sql}. where_sql — " WHERE ..." или "".
+    category_col / category_value — если фильтр ровно по воронке (тогда в cached берётся счётчик воронки;
+    category_col без значения — только для группировки счётчиков).
+    Возвращает (total, режим, которым он реально посчитан): без оценки планировщика — exact.
+    """
+    mode = resolve_total_mode(mode)
+    if mode == "estimated":
+        n = _explain_rows(conn, table, where_sql, params) if where_sql else _reltuples(conn, table)
+        if n is not None:
+            return n, "estimated"
+    elif mode == "cached":
+        if not where_sql or category_value is not None:
+            return _cached_count(conn, table, category_col, category_value), "cached"
+        key = (table, where_sql, repr(list(params)))
+        now = time.time()
+        with _lock:
+            hit = _filtered_counts.get(key)
+        if hit and now - hit[0] < ENTITY_COUNTS_TTL_SEC:
+            return hit[1], "cached"
+        n = _exact_count(conn, table, where_sql, params)
+        with _lock:
+            if len(_filtered_counts) >= 1000:
+                _filtered_counts.clear()
+            _filtered_counts[key] = (now, n)
+        return n, "cached"
+    return _exact_count(conn, table, where_sql, params), "exact"
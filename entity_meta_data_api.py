@@ -5,18 +5,28 @@ API значений полей сущностей: тип сущности + п
 Лид — название лида, Источник — название из классификатора (и т.д.).
 GET /api/entity-meta-data/?type=deal&limit=10&offset=0
 GET /api/entity-meta-data/?type=smart_process&entity_key=sp:1114&limit=10&offset=0
+GET /api/entity-meta-data/export?type=deal&format=csv — вся таблица потоком (NDJSON/CSV)
 """
+import csv
+import io
+import os
 import sys
 import json
 import re
 import unicodedata
-from typing import Any, Dict, List, Optional, Tuple
+import uuid
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import psycopg2
 import psycopg2.extras
 from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
 
-from api_data import pg_conn
+from api_data import keyset_page_cursors, keyset_page_sql, pg_conn
+from entity_counts import count_total, resolve_total_mode
+from meta_cache import cached_meta
 from entity_meta_fields_api import (
     table_name_for_entity,
     normalize_string,
@@ -28,6 +38,8 @@ router = APIRouter(prefix="/api/entity-meta-data", tags=["entity-meta-data"])
 
 
 _CUSTOM_COLUMN_RE = re.compile(r"^custom_[a-z0-9_]+$")
+# /export: строк на одну выборку из серверного курсора (и на одну расшифровку имён/справочников)
+ENTITY_EXPORT_CHUNK_ROWS = max(100, int(os.getenv("ENTITY_EXPORT_CHUNK_ROWS", "2000")))
 
 
 def _normalize_value(value: Any) -> Any:
@@ -44,14 +56,10 @@ def _normalize_value(value: Any) -> Any:
 
 
 def _table_has_column(conn, table_name: str, column_name: str) -> bool:
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT 1 FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = %s AND column_name = %s
-        """, (table_name, column_name))
-        return cur.fetchone() is not None
+    return column_name in _table_existing_columns(conn, table_name)
 
 
+@cached_meta("table_columns")
 def _table_existing_columns(conn, table_name: str) -> set:
     with conn.cursor() as cur:
         cur.execute(
@@ -79,18 +87,13 @@ def _merge_custom_columns_into_titles(col_to_title: Dict[str, str], existing_col
 
 def _get_category_column_from_table(conn, table_name: str) -> Optional[str]:
     """Возвращает имя колонки воронки (category_id и т.п.) в таблице, если есть."""
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = %s
-        """, (table_name,))
-        for row in cur.fetchall() or []:
-            col = row[0] if isinstance(row, (list, tuple)) else row.get("column_name")
-            if col and _is_category_column(col):
-                return col
+    for col in sorted(_table_existing_columns(conn, table_name)):
+        if _is_category_column(col):
+            return col
     return None
 
 
+@cached_meta("col_to_human_title")
 def _col_to_human_title_map(conn, entity_key: str) -> Dict[str, str]:
     """
     Возвращает маппинг column_name -> human_title для сущности.
@@ -131,6 +134,7 @@ def _col_to_human_title_map(conn, entity_key: str) -> Dict[str, str]:
                 SELECT column_name
                 FROM information_schema.columns
                 WHERE table_schema = 'public' AND table_name = %s
+                  AND column_name <> 'raw_hash'
                 ORDER BY ordinal_position
             """, (table_name,))
             cols = [row[0] for row in cur.fetchall()] if cur.rowcount else []
@@ -165,6 +169,7 @@ def _infer_column_type(column_name: str) -> Optional[str]:
     return None
 
 
+@cached_meta("meta_column_types")
 def _load_meta_column_types(conn, entity_key: str) -> Dict[str, str]:
     """Маппинг column_name -> b24_type для сущности (для расшифровки значений)."""
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
@@ -202,6 +207,7 @@ def _entity_key_from_parent_id(name: str) -> Optional[str]:
     return f"sp:{num}"
 
 
+@cached_meta("crm_entity_targets")
 def _load_crm_entity_targets(conn, entity_key: str) -> Dict[str, str]:
     """
     column_name -> target_entity_key для полей-связей crm_entity/crm.
@@ -382,6 +388,7 @@ def _col_types_with_infer(conn, entity_key: str, columns: List[str], col_types:
     return result
 
 
+@cached_meta("sources_classifier")
 def _load_sources_classifier(conn) -> Dict[str, str]:
     """source_id -> source_name из b24_classifier_sources. Добавляем ключи в верхнем регистре для поиска без учёта регистра."""
     out: Dict[str, str] = {}
@@ -487,6 +494,7 @@ def _load_company_data(conn, ids: List[int]) -> Dict[str, Dict[str, Any]]:
     return out
 
 
+@cached_meta("company_field_to_human_title")
 def _load_company_field_to_human_title(conn) -> Dict[str, str]:
     """b24_field -> human_title для entity_key=company (из b24_meta_fields)."""
     out: Dict[str, str] = {}
@@ -578,6 +586,7 @@ def _load_user_names(conn, ids: List[str]) -> Dict[str, str]:
     return out
 
 
+@cached_meta("col_to_b24_field")
 def _load_col_to_b24_field(conn, entity_key: str) -> Dict[str, str]:
     """column_name -> b24_field для сущности (из b24_meta_fields)."""
     out: Dict[str, str] = {}
@@ -596,6 +605,7 @@ def _load_col_to_b24_field(conn, entity_key: str) -> Dict[str, str]:
     return out
 
 
+@cached_meta("deal_categories")
 def _load_deal_categories(conn) -> Dict[str, str]:
     """category_id -> name из b24_deal_categories."""
     out: Dict[str, str] = {}
@@ -611,6 +621,7 @@ def _load_deal_categories(conn) -> Dict[str, str]:
     return out
 
 
+@cached_meta("sp_categories")
 def _load_sp_categories(conn, entity_type_id: str) -> Dict[str, str]:
     """category_id -> name из b24_sp_categories для смарт-процесса (воронки)."""
     out: Dict[str, str] = {}
@@ -631,6 +642,7 @@ def _load_sp_categories(conn, entity_type_id: str) -> Dict[str, str]:
     return out
 
 
+@cached_meta("deal_stages")
 def _load_deal_stages(conn) -> Dict[str, str]:
     """stage_id -> name из b24_deal_stages."""
     out: Dict[str, str] = {}
@@ -646,6 +658,7 @@ def _load_deal_stages(conn) -> Dict[str, str]:
     return out
 
 
+@cached_meta("field_enum_map")
 def _load_field_enum_map(conn, entity_key: str, b24_fields: List[str]) -> Dict[Tuple[str, str], str]:
     """(b24_field, value_id) -> value_title из b24_field_enum для указанных полей.
     Заголовки сохраняем через NFC без normalize_string, чтобы не портить диакритику (e.g. ţ)."""
@@ -678,6 +691,7 @@ def _load_field_enum_map(conn, entity_key: str, b24_fields: List[str]) -> Dict[T
     return out
 
 
+@cached_meta("iblock_field_ids")
 def _load_iblock_field_ids(conn, entity_key: str) -> Dict[str, str]:
     """b24_field -> iblock_id для полей типа iblock_element."""
     out: Dict[str, str] = {}
@@ -1096,12 +1110,605 @@ def debug_entity_enum(
             pass
 
 
+_FILTER_OPS = ("eq", "ne", "in", "not_in", "gt", "gte", "lt", "lte", "between", "like", "is_null")
+_FILTER_RANGE_SQL = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+_NUMERIC_PG_TYPES = ("smallint", "integer", "bigint", "numeric", "real", "double precision")
+_TEMPORAL_PG_TYPES = ("date", "timestamp with time zone", "timestamp without time zone")
+
+
+@cached_meta("table_column_pg_types")
+def _table_column_pg_types(conn, table_name: str) -> Dict[str, str]:
+    """column_name -> data_type (information_schema) — по нему фильтр выбирает сравнение."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s
+            """,
+            (table_name,),
+        )
+        return {str(r[0]): str(r[1] or "").lower() for r in (cur.fetchall() or []) if r and r[0]}
+
+
+def _parse_filters_param(filters: Optional[str]) -> List[Dict[str, Any]]:
+    """filters: JSON-список [{"field", "op", "value"}] или объект {поле: значение} (eq; список — in)."""
+    if not filters or not filters.strip():
+        return []
+    try:
+        parsed = json.loads(filters)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="filters must be JSON: [{\"field\": ..., \"op\": ..., \"value\": ...}]")
+    if isinstance(parsed, dict):
+        return [{"field": k, "op": "in" if isinstance(v, list) else "eq", "value": v} for k, v in parsed.items()]
+    if not isinstance(parsed, list) or not all(isinstance(f, dict) for f in parsed):
+        raise HTTPException(status_code=400, detail="filters must be a JSON list of {field, op, value} objects")
+    return parsed
+
+
+def _filter_title_key(value: Any) -> str:
+    return unicodedata.normalize("NFC", str(value)).strip().casefold()
+
+
+def _filter_number(value: Any) -> Optional[Any]:
+    try:
+        f = float(str(value).strip().replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+    return int(f) if f.is_integer() else f
+
+
+def _parse_filter_number(field: str, value: Any) -> Any:
+    n = _filter_number(value)
+    if n is None:
+        raise HTTPException(status_code=400, detail=f"Filter '{field}': '{value}' is not a number")
+    return n
+
+
+def _parse_filter_date(field: str, value: Any) -> Tuple[str, bool]:
+    """Значение фильтра по дате -> (ISO-строка, задана ли только дата). Принимает ISO и ДД.ММ.ГГГГ[ ЧЧ:ММ[:СС]]."""
+    s = str(value).strip()
+    for fmt in ("%d.%m.%Y", "%d.%m.%Y %H:%M", "%d.%m.%Y %H:%M:%S"):
+        try:
+            d = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        return (d.date().isoformat(), True) if fmt == "%d.%m.%Y" else (d.isoformat(), False)
+    try:
+        d = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Filter '{field}': '{value}' is not a date (YYYY-MM-DD or DD.MM.YYYY)")
+    return (d.date().isoformat(), True) if len(s) == 10 else (d.isoformat(), False)
+
+
+def _enum_filter_ids(conn, entity_key: str, col: str, b24_field: Optional[str], titles: List[Any]) -> List[str]:
+    """
+    Фильтр по названию значения: id воронок/стадий/источников/enum-вариантов, чьё название совпало
+    (без учёта регистра) — те же справочники, что расшифровывают значения в _decode_record.
+    """
+    wanted = {_filter_title_key(t) for t in titles}
+    is_sp = (entity_key or "").startswith("sp:")
+    c = (col or "").lower()
+    maps: List[Dict[str, str]] = []
+    if _is_category_column(col) and entity_key == "deal":
+        maps.append(_load_deal_categories(conn))
+    elif _is_category_column(col) and is_sp:
+        maps.append(_load_sp_categories(conn, entity_key.split(":")[-1]))
+    if (entity_key == "deal" or is_sp) and c in ("stage_id", "stageid"):
+        maps.append(_load_deal_stages(conn))
+    if c == "source_id":
+        maps.append(_load_sources_classifier(conn))
+    out = [k for m in maps for k, title in m.items() if _filter_title_key(title) in wanted]
+    if b24_field:
+        for (fld, vid), title in _load_field_enum_map(conn, entity_key, [b24_field]).items():
+            if fld == b24_field and _filter_title_key(title) in wanted:
+                out.append(vid)
+    return out
+
+
+def _filter_condition(
+    conn, entity_key: str, field: str, col: str, pg_type: str, b24_field: Optional[str], op: str, value: Any
+) -> Tuple[str, List[Any]]:
+    """Один фильтр -> (SQL-условие, параметры) по типу колонки в PG."""
+    ident = '"' + col.replace('"', '""') + '"'
+    if pg_type in _NUMERIC_PG_TYPES:
+        kind = "number"
+    elif pg_type in _TEMPORAL_PG_TYPES:
+        kind = "date"
+    elif pg_type == "boolean":
+        kind = "bool"
+    elif pg_type in ("json", "jsonb"):
+        kind = "json"
+    else:
+        kind = "text"
+
+    if op == "is_null" or (op in ("eq", "ne") and value is None):
+        is_null = (value is None and op == "eq") or (op == "is_null" and value not in (False, 0, "false", "0"))
+        return (f"{ident} IS NULL" if is_null else f"{ident} IS NOT NULL"), []
+    if op == "like":
+        pattern = "%" + str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return f"{ident}::text ILIKE %s", [pattern]
+    if op == "between":
+        if not isinstance(value, list) or len(value) != 2:
+            raise HTTPException(status_code=400, detail=f"Filter '{field}': between needs [from, to]")
+        parts: List[str] = []
+        params: List[Any] = []
+        for sub_op, sub_value in (("gte", value[0]), ("lte", value[1])):
+            if sub_value is None:
+                continue
+            sql, p = _filter_condition(conn, entity_key, field, col, pg_type, b24_field, sub_op, sub_value)
+            parts.append(sql)
+            params.extend(p)
+        return ("(" + " AND ".join(parts) + ")" if parts else "TRUE"), params
+    if op in _FILTER_RANGE_SQL:
+        if kind == "number":
+            return f"{ident} {_FILTER_RANGE_SQL[op]} %s", [_parse_filter_number(field, value)]
+        if kind != "date":
+            raise HTTPException(status_code=400, detail=f"Filter '{field}': {op} works only on number and date fields")
+        iso, date_only = _parse_filter_date(field, value)
+        if date_only and pg_type != "date" and op in ("lte", "gt"):
+            # дата без времени на timestamp-колонке — весь день: <= 31.01 -> < 01.02, > 31.01 -> >= 01.02
+            return f"{ident} {'<' if op == 'lte' else '>='} (%s::date + 1)", [iso]
+        return f"{ident} {_FILTER_RANGE_SQL[op]} %s", [iso]
+
+    # eq / ne / in / not_in: значение или его название (enum, воронка, стадия, источник)
+    values = [v for v in (value if isinstance(value, list) else [value]) if v is not None]
+    candidates = values + _enum_filter_ids(conn, entity_key, col, b24_field, values)
+    if kind == "number":
+        # нечисловые значения — названия, не нашедшиеся в справочнике
+        nums = [n for n in (_filter_number(v) for v in candidates) if n is not None]
+        sql, params = (f"{ident} = ANY(%s)", [nums]) if nums else ("FALSE", [])
+    elif kind == "date":
+        sql, params = f"{ident}::date = ANY(%s::date[])", [[_parse_filter_date(field, v)[0] for v in values]]
+    elif kind == "bool":
+        sql, params = f"{ident} = ANY(%s)", [[str(v).strip().lower() in ("1", "true", "y", "yes") for v in values]]
+    elif kind == "json":
+        # множественные поля (JSONB-массив): совпадение любого элемента
+        sql = (
+            f"EXISTS (SELECT 1 FROM jsonb_array_elements_text(CASE WHEN jsonb_typeof({ident}::jsonb) = 'array' "
+            f"THEN {ident}::jsonb ELSE jsonb_build_array({ident}::jsonb) END) AS e(v) WHERE e.v = ANY(%s))"
+        )
+        params = [[str(v) for v in candidates]]
+    else:
+        sql, params = f"{ident} = ANY(%s)", [[str(v) for v in candidates]]
+    if op in ("ne", "not_in"):
+        return f"({ident} IS NULL OR NOT ({sql}))", params
+    return sql, params
+
+
+def _meta_data_filter_sql(
+    conn,
+    entity_key: str,
+    table_name: str,
+    filters: List[Dict[str, Any]],
+    resolve_field: Callable[[str], str],
+    col_to_b24: Dict[str, str],
+) -> Tuple[List[str], List[Any]]:
+    """filters -> (условия WHERE, параметры); поле — human_title, имя колонки или поле Bitrix."""
+    pg_types = _table_column_pg_types(conn, table_name)
+    where_parts: List[str] = []
+    where_params: List[Any] = []
+    for f in filters:
+        field = str(f.get("field") or "").strip()
+        op = str(f.get("op") or "eq").strip().lower()
+        if op not in _FILTER_OPS:
+            raise HTTPException(status_code=400, detail=f"Filter '{field}': unknown op '{op}'. Must be one of {', '.join(_FILTER_OPS)}")
+        col = resolve_field(field)
+        sql, params = _filter_condition(
+            conn, entity_key, field, col, pg_types.get(col, "text"), col_to_b24.get(col), op, f.get("value")
+        )
+        where_parts.append(sql)
+        where_params.extend(params)
+    return where_parts, where_params
+
+
+def _meta_data_order_sql(sort: Optional[str], resolve_field: Callable[[str], str]) -> Optional[str]:
+    """sort: поля через запятую, "-" перед полем — по убыванию. Ничья разрешается по id DESC."""
+    parts: List[str] = []
+    cols: List[str] = []
+    for item in (sort or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        desc = item.startswith("-")
+        col = resolve_field(item.lstrip("+-").strip())
+        cols.append(col)
+        parts.append('"' + col.replace('"', '""') + '"' + (" DESC" if desc else " ASC") + " NULLS LAST")
+    if not parts:
+        return None
+    if "id" not in cols:
+        parts.append("id DESC")
+    return ", ".join(parts)
+
+
+def _meta_data_entity_key(type: str, entity_key: Optional[str]) -> str:
+    """type (+ entity_key для smart_process) -> entity_key таблицы; 400 при неверных параметрах."""
+    if type not in ("smart_process", "deal", "contact", "lead", "company"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid type: '{type}'. Must be smart_process, deal, contact, lead or company",
+        )
+    if type != "smart_process":
+        return type
+    if not entity_key or not entity_key.startswith("sp:"):
+        raise HTTPException(
+            status_code=400,
+            detail="entity_key is required for type=smart_process (e.g. sp:1114)",
+        )
+    return entity_key
+
+
+def _meta_data_query_plan(
+    conn,
+    type: str,
+    final_entity_key: str,
+    table_name: str,
+    id: Optional[int],
+    ids: Optional[str],
+    contact_id: Optional[int],
+    lead_id: Optional[int],
+    company_id: Optional[int],
+    fields: Optional[str],
+    category_id: Optional[str],
+    filters: Optional[str] = None,
+    sort: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Общая часть get_entity_meta_data и /export: колонки выборки, алиасы полей, WHERE (category_id, id/ids,
+    filters), ORDER BY из sort, типы колонок для расшифровки и ключи записей. None — для сущности нет meta-полей.
+    """
+    col_to_title = _col_to_human_title_map(conn, final_entity_key)
+    if not col_to_title:
+        return None
+
+    existing_cols = _table_existing_columns(conn, table_name)
+    # Защита от битой meta-схемы (например id_2 в b24_meta_fields, которого нет физически в таблице)
+    col_to_title = {c: t for c, t in col_to_title.items() if c in existing_cols}
+    col_to_title = _merge_custom_columns_into_titles(col_to_title, existing_cols)
+    all_columns = list(col_to_title.keys())
+    category_col = next((c for c in all_columns if _is_category_column(c)), None)
+    cid = (str(category_id).strip() if category_id is not None else "") or ""
+    if cid and not category_col:
+        category_col = _get_category_column_from_table(conn, table_name)
+
+    # Универсальные фильтры: category_id + id/ids
+    where_parts: List[str] = []
+    where_params: List[Any] = []
+    if cid and category_col:
+        safe_col = category_col.replace('"', '""')
+        where_parts.append(f'"{safe_col}"::text = %s')
+        where_params.append(cid)
+
+    id_values: List[int] = []
+    if type == "contact" and contact_id is not None:
+        id = contact_id
+    elif type == "lead" and lead_id is not None:
+        id = lead_id
+    elif type == "company" and company_id is not None:
+        id = company_id
+
+    if id is not None:
+        try:
+            iv = int(id)
+            if iv > 0:
+                id_values.append(iv)
+        except Exception:
+            pass
+    if ids:
+        for s in [x.strip() for x in str(ids).split(",") if x.strip()]:
+            try:
+                iv = int(s)
+                if iv > 0:
+                    id_values.append(iv)
+            except Exception:
+                continue
+    id_values = list(dict.fromkeys(id_values))
+    if id_values:
+        id_values_str = [str(v) for v in id_values]
+        id_predicates: List[str] = []
+        if "id" in existing_cols:
+            id_predicates.append("id = ANY(%s)")
+            where_params.append(id_values)
+        if "id_2" in existing_cols:
+            id_predicates.append("id_2::text = ANY(%s)")
+            where_params.append(id_values_str)
+        id_predicates.append("COALESCE(raw->>'ID', raw->>'id', '') = ANY(%s)")
+        where_params.append(id_values_str)
+        where_parts.append("(" + " OR ".join(id_predicates) + ")")
+
+    columns = list(all_columns)
+    # При дублях human_title выбираем более "каноничную" колонку (id > id_2, title > title_2)
+    title_to_col: Dict[str, str] = {}
+    for col, title in col_to_title.items():
+        if title not in title_to_col:
+            title_to_col[title] = col
+            continue
+        prev = title_to_col[title]
+        if title == "ID" and col == "id":
+            title_to_col[title] = col
+        elif title == "Название" and col == "title":
+            title_to_col[title] = col
+        elif prev.endswith("_2") and not col.endswith("_2"):
+            title_to_col[title] = col
+    col_to_b24 = _load_col_to_b24_field(conn, final_entity_key)
+    # Алиасы для fields: human_title / column_name / b24_field (регистронезависимо)
+    field_alias_to_col: Dict[str, str] = {}
+    for col, title in col_to_title.items():
+        for k in (title, str(title).lower(), col, str(col).lower()):
+            if k:
+                field_alias_to_col[k] = col
+        b24_f = col_to_b24.get(col)
+        if b24_f:
+            field_alias_to_col[str(b24_f)] = col
+            field_alias_to_col[str(b24_f).lower()] = col
+    # Для deal: даже если "Ответственный" показывается через assigned_by_name,
+    # запрос fields=assigned_by_id должен явно маппиться в raw id колонку.
+    if final_entity_key == "deal":
+        has_assigned_id = _table_has_column(conn, table_name, "assigned_by_id")
+        has_assigned_name = _table_has_column(conn, table_name, "assigned_by_name")
+        if has_assigned_id:
+            field_alias_to_col["assigned_by_id"] = "assigned_by_id"
+            field_alias_to_col["ASSIGNED_BY_ID"] = "assigned_by_id"
+        # Критично для фронта: эти ключи должны маппиться всегда.
+        # Если нет физической assigned_by_name — используем assigned_by_id и резолвим имя в _decode_record.
+        if has_assigned_name:
+            field_alias_to_col["assigned_by_name"] = "assigned_by_name"
+            field_alias_to_col["ASSIGNED_BY_NAME"] = "assigned_by_name"
+            field_alias_to_col["Ответственный"] = "assigned_by_name"
+            field_alias_to_col["ответственный"] = "assigned_by_name"
+        elif has_assigned_id:
+            field_alias_to_col["assigned_by_name"] = "assigned_by_id"
+            field_alias_to_col["ASSIGNED_BY_NAME"] = "assigned_by_id"
+            field_alias_to_col["Ответственный"] = "assigned_by_id"
+            field_alias_to_col["ответственный"] = "assigned_by_id"
+
+    def resolve_field(name: str) -> str:
+        col = title_to_col.get(name) or field_alias_to_col.get(name) or field_alias_to_col.get(name.lower())
+        if not col and name in existing_cols:
+            col = name
+        if not col:
+            raise HTTPException(status_code=400, detail=f"Unknown field: '{name}'")
+        return col
+
+    filter_parts, filter_params = _meta_data_filter_sql(
+        conn, final_entity_key, table_name, _parse_filters_param(filters), resolve_field, col_to_b24
+    )
+    where_parts.extend(filter_parts)
+    where_params.extend(filter_params)
+    order_sql = _meta_data_order_sql(sort, resolve_field)
+
+    requested_output_pairs: List[Tuple[str, Optional[str]]] = []
+    if fields:
+        requested_titles = [s.strip() for s in fields.split(",") if s.strip()]
+        if requested_titles:
+            requested_cols: List[str] = []
+            for t in requested_titles:
+                c = (
+                    title_to_col.get(t)
+                    or field_alias_to_col.get(t)
+                    or field_alias_to_col.get(str(t).lower())
+                )
+                requested_output_pairs.append((t, c))
+                if c:
+                    requested_cols.append(c)
+            requested_cols = list(dict.fromkeys(c for c in requested_cols if c))
+            # strict contract: если fields передан, в output только запрошенные ключи
+            columns = requested_cols
+
+    # Для user-полей иногда нужен сырой id из assigned_by_id, даже если фронт просит "Ответственный".
+    query_columns = list(columns)
+    has_user_requested = False
+    col_types_preview = _col_types_with_infer(
+        conn, final_entity_key, query_columns, _load_meta_column_types(conn, final_entity_key)
+    )
+    for c in query_columns:
+        t = (col_types_preview.get(c) or "").strip().lower()
+        if t in ("user", "crm_user", "assigned_by"):
+            has_user_requested = True
+            break
+        if c == "assigned_by_id" or (col_to_b24.get(c, "").upper() == "ASSIGNED_BY_ID"):
+            has_user_requested = True
+            break
+    if has_user_requested and _table_has_column(conn, table_name, "assigned_by_id") and "assigned_by_id" not in query_columns:
+        query_columns.append("assigned_by_id")
+
+    if not query_columns:
+        # Технический минимум для валидного SELECT, если ни один requested key не сматчился с колонкой.
+        query_columns = ["id"]
+
+    col_types = _col_types_with_infer(
+        conn, final_entity_key, query_columns, _load_meta_column_types(conn, final_entity_key)
+    )
+
+    output_pairs: List[Tuple[str, Optional[str]]]
+    if requested_output_pairs:
+        # Сохраняем запрошенные ключи фронта как ключи output row
+        output_pairs = requested_output_pairs
+    else:
+        output_pairs = [(col_to_title.get(c, c), c) for c in columns]
+
+    output_to_col: Dict[str, str] = {}
+    for out_key, c in output_pairs:
+        if out_key and c:
+            output_to_col[out_key] = c
+
+    return {
+        "entity_key": final_entity_key,
+        "table_name": table_name,
+        "col_to_title": col_to_title,
+        "existing_cols": existing_cols,
+        "category_col": category_col,
+        "cid": cid,
+        "where_parts": where_parts,
+        "where_params": where_params,
+        "order_sql": order_sql,
+        "title_to_col": title_to_col,
+        "field_alias_to_col": field_alias_to_col,
+        "col_to_b24": col_to_b24,
+        "query_columns": query_columns,
+        "col_types": col_types,
+        "crm_entity_targets": _load_crm_entity_targets(conn, final_entity_key),
+        "output_pairs": output_pairs,
+        "output_to_col": output_to_col,
+        "fields": [k for k, _ in output_pairs],
+    }
+
+
+def _meta_data_decode_maps(conn, plan: Dict[str, Any]) -> Dict[str, Any]:
+    """Справочники расшифровки, не зависящие от выбранных строк (для /export — один раз на весь поток)."""
+    final_entity_key = plan["entity_key"]
+    col_to_b24 = plan["col_to_b24"]
+    sp_entity_type_id = (final_entity_key or "").split(":")[-1] if (final_entity_key or "").startswith("sp:") else ""
+    b24_fields_for_enum = list(dict.fromkeys(col_to_b24.values())) if col_to_b24 else []
+    iblock_field_ids = _load_iblock_field_ids(conn, final_entity_key)
+    iblock_ids = list(dict.fromkeys(iblock_field_ids.values())) if iblock_field_ids else []
+    return {
+        "sources_map": (
+            _load_sources_classifier(conn)
+            if final_entity_key in ("deal", "lead", "contact") or (final_entity_key or "").startswith("sp:")
+            else {}
+        ),
+        "categories_map": _load_deal_categories(conn) if final_entity_key == "deal" else {},
+        "sp_categories_map": _load_sp_categories(conn, sp_entity_type_id) if sp_entity_type_id else {},
+        "stages_map": (
+            _load_deal_stages(conn)
+            if final_entity_key == "deal" or (final_entity_key or "").startswith("sp:")
+            else {}
+        ),
+        "field_enum_map": (
+            _load_field_enum_map(conn, final_entity_key, b24_fields_for_enum) if b24_fields_for_enum else {}
+        ),
+        "iblock_field_ids": iblock_field_ids,
+        "iblock_element_names": _load_iblock_element_names(conn, iblock_ids) if iblock_ids else {},
+    }
+
+
+def _decode_meta_data_rows(
+    conn, plan: Dict[str, Any], decode_maps: Dict[str, Any], rows: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """Строки выборки -> записи с ключами human_title; имена контактов/лидов/компаний/пользователей — только для этих строк."""
+    final_entity_key = plan["entity_key"]
+    col_types = plan["col_types"]
+    crm_entity_targets = plan["crm_entity_targets"]
+
+    contact_ids: List[int] = []
+    lead_ids: List[int] = []
+    company_ids: List[int] = []
+    user_ids: List[str] = []
+    crm_entity_ids_by_target: Dict[str, List[int]] = {}
+    for col, t in col_types.items():
+        if t in ("crm_contact", "contact"):
+            for row in rows:
+                v = row.get(col)
+                if v is not None and str(v).strip():
+                    try:
+                        contact_ids.append(int(v))
+                    except (TypeError, ValueError):
+                        pass
+        elif t in ("crm_lead", "lead"):
+            for row in rows:
+                v = row.get(col)
+                if v is not None and str(v).strip():
+                    try:
+                        lead_ids.append(int(v))
+                    except (TypeError, ValueError):
+                        pass
+        elif t in ("crm_company", "company"):
+            for row in rows:
+                v = row.get(col)
+                if v is not None and str(v).strip():
+                    try:
+                        company_ids.append(int(v))
+                    except (TypeError, ValueError):
+                        pass
+        elif t in ("user", "crm_user", "assigned_by"):
+            for row in rows:
+                v = row.get(col)
+                if v is not None and str(v).strip():
+                    user_ids.append(str(v).strip())
+        elif t in ("crm_entity", "crm"):
+            target_entity_key = crm_entity_targets.get(col)
+            if not target_entity_key:
+                continue
+            bucket = crm_entity_ids_by_target.setdefault(target_entity_key, [])
+            for row in rows:
+                bucket.extend(_extract_ref_ids(row.get(col)))
+
+    contact_names_map = _load_contact_names(conn, list(dict.fromkeys(contact_ids))) if contact_ids else {}
+    lead_titles_map = _load_lead_titles(conn, list(dict.fromkeys(lead_ids))) if lead_ids else {}
+    company_ids_unique = list(dict.fromkeys(company_ids))
+    company_titles_map = _load_company_titles(conn, company_ids_unique) if company_ids else {}
+    company_data_map = _load_company_data(conn, company_ids_unique) if company_ids else {}
+    company_field_to_title_map = _load_company_field_to_human_title(conn) if company_ids else {}
+    company_b24_fields = list(company_field_to_title_map.keys()) if company_field_to_title_map else []
+    company_field_enum_map = (
+        _load_field_enum_map(conn, "company", company_b24_fields) if company_b24_fields else {}
+    )
+    user_ids_unique = list(dict.fromkeys(user_ids))
+    user_names_map = _load_user_names(conn, user_ids_unique) if user_ids_unique else {}
+    crm_entity_titles: Dict[Tuple[str, str], str] = {}
+    for target_entity_key, ref_ids in crm_entity_ids_by_target.items():
+        ids_unique = list(dict.fromkeys(ref_ids))
+        if not ids_unique:
+            continue
+        for rid, title in _load_generic_entity_titles(conn, target_entity_key, ids_unique).items():
+            crm_entity_titles[(target_entity_key, str(rid))] = title
+
+    data: List[Dict[str, Any]] = []
+    for row in rows:
+        record: Dict[str, Any] = {}
+        for out_key, col in plan["output_pairs"]:
+            value = row.get(col) if col else None
+            try:
+                record[out_key] = _normalize_value(value)
+            except Exception as e:
+                print(f"WARNING: entity-meta-data normalize {col}: {e}", file=sys.stderr, flush=True)
+                record[out_key] = value
+        _decode_record(
+            record,
+            row,
+            final_entity_key,
+            plan["col_to_title"],
+            plan["output_to_col"],
+            col_types,
+            decode_maps["sources_map"],
+            contact_names_map,
+            lead_titles_map,
+            user_names_map,
+            categories_map=decode_maps["categories_map"],
+            stages_map=decode_maps["stages_map"],
+            field_enum_map=decode_maps["field_enum_map"],
+            col_to_b24_field=plan["col_to_b24"],
+            company_titles=company_titles_map,
+            company_data=company_data_map,
+            company_field_to_title=company_field_to_title_map,
+            company_field_enum_map=company_field_enum_map,
+            sp_categories_map=decode_maps["sp_categories_map"],
+            iblock_field_ids=decode_maps["iblock_field_ids"],
+            iblock_element_names=decode_maps["iblock_element_names"],
+            crm_entity_targets=crm_entity_targets,
+            crm_entity_titles=crm_entity_titles,
+        )
+        if final_entity_key == "company":
+            raw_obj = row.get("raw") if isinstance(row.get("raw"), dict) else {}
+            rid = row.get("id") or row.get("id_2") or raw_obj.get("ID") or raw_obj.get("id")
+            rtitle = row.get("title") or row.get("title_2") or raw_obj.get("TITLE") or raw_obj.get("title")
+            if "ID" in record and (record.get("ID") is None or str(record.get("ID")).strip() == ""):
+                record["ID"] = rid
+            if "Название" in record and (record.get("Название") is None or str(record.get("Название")).strip() == ""):
+                record["Название"] = _normalize_value(rtitle) if rtitle is not None else rtitle
+        data.append(record)
+    return data
+
+
 @router.get("/")
 def get_entity_meta_data(
     type: str = Query(..., description="Тип сущности: deal, contact, lead, company, smart_process"),
     entity_key: Optional[str] = Query(None, description="Для smart_process обязателен, например sp:1114"),
     limit: int = Query(100, ge=1, le=10000, description="Максимум записей"),
     offset: int = Query(0, ge=0, description="Смещение"),
+    after_id: Optional[int] = Query(None, description="Keyset: следующая страница после этого id (next_cursor); offset игнорируется"),
+    before_id: Optional[int] = Query(None, description="Keyset: предыдущая страница перед этим id (prev_cursor); offset игнорируется"),
     id: Optional[int] = Query(None, description="Фильтр по одному ID записи"),
     ids: Optional[str] = Query(None, description="Фильтр по нескольким ID (через запятую)"),
     contact_id: Optional[int] = Query(None, description="Alias для id при type=contact"),
@@ -1115,375 +1722,122 @@ def get_entity_meta_data(
         None,
         description="Фильтр по воронке/категории (для deal и smart_process). В ответе только записи этой категории; total считается по отфильтрованным.",
     ),
+    total_mode: Optional[str] = Query(
+        None,
+        description="Как считать total: exact (COUNT(*)), estimated (оценка PG), cached (счётчик, обновляемый после синка). По умолчанию ENTITY_TOTAL_MODE",
+    ),
+    filters: Optional[str] = Query(
+        None,
+        description=(
+            'JSON-фильтры: [{"field": "Сумма", "op": "gte", "value": 1000}, ...] или {"Стадия": "Новая"}. '
+            "op: eq, ne, in, not_in, gt, gte, lt, lte, between, like, is_null; field — human_title или колонка; "
+            "для списков/воронок/стадий/источников value может быть названием"
+        ),
+    ),
+    sort: Optional[str] = Query(
+        None,
+        description='Сортировка: поля через запятую, "-" — по убыванию (например "-Дата создания,Сумма"). По умолчанию id DESC',
+    ),
 ) -> Dict[str, Any]:
     """
     Возвращает значения полей сущности: массив записей, ключи в каждой записи = human_title
     (как в /api/entity-meta-fields/), значения — из БД.
     Параметр fields — только запрошенные поля в каждой записи.
     Параметр category_id — фильтр по воронке (deal/smart_process); total — по отфильтрованным записям.
+    Пагинация: offset или keyset (after_id/before_id = next_cursor/prev_cursor из предыдущего ответа) —
+    время страницы не растёт с глубиной.
+    total_mode — exact/estimated/cached (см. entity_counts); в ответе — каким способом total реально посчитан.
+    filters / sort — фильтрация и сортировка в PG (total — по отфильтрованным); keyset-курсоры — только
+    при сортировке по умолчанию (id), с sort — пагинация через offset.
     """
-    if type not in ("smart_process", "deal", "contact", "lead", "company"):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid type: '{type}'. Must be smart_process, deal, contact, lead or company",
-        )
-
-    if type == "deal":
-        final_entity_key = "deal"
-    elif type == "contact":
-        final_entity_key = "contact"
-    elif type == "lead":
-        final_entity_key = "lead"
-    elif type == "company":
-        final_entity_key = "company"
-    else:
-        if not entity_key or not entity_key.startswith("sp:"):
-            raise HTTPException(
-                status_code=400,
-                detail="entity_key is required for type=smart_process (e.g. sp:1114)",
-            )
-        final_entity_key = entity_key
+    total_mode = resolve_total_mode(total_mode)
+    final_entity_key = _meta_data_entity_key(type, entity_key)
 
+    keyset_sql, keyset_params, order_sql, reverse_rows = keyset_page_sql(after_id, before_id)
+    if keyset_sql:
+        offset = 0
     table_name = table_name_for_entity(final_entity_key)
     conn = pg_conn()
     try:
         with conn.cursor() as cur:
             cur.execute("SET client_encoding TO 'UTF8'")
-        col_to_title = _col_to_human_title_map(conn, final_entity_key)
-        if not col_to_title:
+        plan = _meta_data_query_plan(
+            conn, type, final_entity_key, table_name, id, ids, contact_id, lead_id, company_id, fields, category_id,
+            filters=filters, sort=sort,
+        )
+        if plan is None:
             return {
                 "ok": True,
                 "entity_key": final_entity_key,
                 "type": type,
                 "total": 0,
+                "total_mode": "exact",
                 "limit": limit,
                 "offset": offset,
                 "data": [],
                 "fields": [],
+                "next_cursor": None,
+                "prev_cursor": None,
             }
 
-        existing_cols = _table_existing_columns(conn, table_name)
-        # Защита от битой meta-схемы (например id_2 в b24_meta_fields, которого нет физически в таблице)
-        col_to_title = {c: t for c, t in col_to_title.items() if c in existing_cols}
-        col_to_title = _merge_custom_columns_into_titles(col_to_title, existing_cols)
-        all_columns = list(col_to_title.keys())
-        category_col = next((c for c in all_columns if _is_category_column(c)), None)
-        cid = (str(category_id).strip() if category_id is not None else "") or ""
-        if cid and not category_col:
-            category_col = _get_category_column_from_table(conn, table_name)
-
-        # Универсальные фильтры: category_id + id/ids
-        where_parts: List[str] = []
-        where_params: List[Any] = []
-        if cid and category_col:
-            safe_col = category_col.replace('"', '""')
-            where_parts.append(f'"{safe_col}"::text = %s')
-            where_params.append(cid)
-
-        id_values: List[int] = []
-        if type == "contact" and contact_id is not None:
-            id = contact_id
-        elif type == "lead" and lead_id is not None:
-            id = lead_id
-        elif type == "company" and company_id is not None:
-            id = company_id
-
-        if id is not None:
-            try:
-                iv = int(id)
-                if iv > 0:
-                    id_values.append(iv)
-            except Exception:
-                pass
-        if ids:
-            for s in [x.strip() for x in str(ids).split(",") if x.strip()]:
-                try:
-                    iv = int(s)
-                    if iv > 0:
-                        id_values.append(iv)
-                except Exception:
-                    continue
-        id_values = list(dict.fromkeys(id_values))
-        if id_values:
-            id_values_str = [str(v) for v in id_values]
-            id_predicates: List[str] = []
-            if "id" in existing_cols:
-                id_predicates.append("id = ANY(%s)")
-                where_params.append(id_values)
-            if "id_2" in existing_cols:
-                id_predicates.append("id_2::text = ANY(%s)")
-                where_params.append(id_values_str)
-            id_predicates.append("COALESCE(raw->>'ID', raw->>'id', '') = ANY(%s)")
-            where_params.append(id_values_str)
-            where_parts.append("(" + " OR ".join(id_predicates) + ")")
-
+        if plan["order_sql"]:
+            if keyset_sql:
+                raise HTTPException(
+                    status_code=400,
+                    detail="after_id/before_id work only with the default sort by id; use offset together with sort",
+                )
+            order_sql = plan["order_sql"]
+        where_parts = plan["where_parts"]
         where_sql = f" WHERE {' AND '.join(where_parts)}" if where_parts else ""
-        count_params: List[Any] = list(where_params)
-        select_params: List[Any] = list(where_params) + [limit, offset]
-
-        with conn.cursor() as cur:
-            if where_sql:
-                cur.execute(f'SELECT COUNT(*) AS cnt FROM "{table_name}"{where_sql}', count_params)
-            else:
-                cur.execute(f'SELECT COUNT(*) AS cnt FROM "{table_name}"')
-            total = cur.fetchone()[0] if cur.rowcount else 0
-
-        columns = list(all_columns)
-        # При дублях human_title выбираем более "каноничную" колонку (id > id_2, title > title_2)
-        title_to_col: Dict[str, str] = {}
-        for col, title in col_to_title.items():
-            if title not in title_to_col:
-                title_to_col[title] = col
-                continue
-            prev = title_to_col[title]
-            if title == "ID" and col == "id":
-                title_to_col[title] = col
-            elif title == "Название" and col == "title":
-                title_to_col[title] = col
-            elif prev.endswith("_2") and not col.endswith("_2"):
-                title_to_col[title] = col
-        col_to_b24 = _load_col_to_b24_field(conn, final_entity_key)
-        # Алиасы для fields: human_title / column_name / b24_field (регистронезависимо)
-        field_alias_to_col: Dict[str, str] = {}
-        for col, title in col_to_title.items():
-            for k in (title, str(title).lower(), col, str(col).lower()):
-                if k:
-                    field_alias_to_col[k] = col
-            b24_f = col_to_b24.get(col)
-            if b24_f:
-                field_alias_to_col[str(b24_f)] = col
-                field_alias_to_col[str(b24_f).lower()] = col
-        # Для deal: даже если "Ответственный" показывается через assigned_by_name,
-        # запрос fields=assigned_by_id должен явно маппиться в raw id колонку.
-        if final_entity_key == "deal":
-            has_assigned_id = _table_has_column(conn, table_name, "assigned_by_id")
-            has_assigned_name = _table_has_column(conn, table_name, "assigned_by_name")
-            if has_assigned_id:
-                field_alias_to_col["assigned_by_id"] = "assigned_by_id"
-                field_alias_to_col["ASSIGNED_BY_ID"] = "assigned_by_id"
-            # Критично для фронта: эти ключи должны маппиться всегда.
-            # Если нет физической assigned_by_name — используем assigned_by_id и резолвим имя в _decode_record.
-            if has_assigned_name:
-                field_alias_to_col["assigned_by_name"] = "assigned_by_name"
-                field_alias_to_col["ASSIGNED_BY_NAME"] = "assigned_by_name"
-                field_alias_to_col["Ответственный"] = "assigned_by_name"
-                field_alias_to_col["ответственный"] = "assigned_by_name"
-            elif has_assigned_id:
-                field_alias_to_col["assigned_by_name"] = "assigned_by_id"
-                field_alias_to_col["ASSIGNED_BY_NAME"] = "assigned_by_id"
-                field_alias_to_col["Ответственный"] = "assigned_by_id"
-                field_alias_to_col["ответственный"] = "assigned_by_id"
-        requested_output_pairs: List[Tuple[str, Optional[str]]] = []
-        if fields:
-            requested_titles = [s.strip() for s in fields.split(",") if s.strip()]
-            if requested_titles:
-                requested_cols: List[str] = []
-                for t in requested_titles:
-                    c = (
-                        title_to_col.get(t)
-                        or field_alias_to_col.get(t)
-                        or field_alias_to_col.get(str(t).lower())
-                    )
-                    requested_output_pairs.append((t, c))
-                    if c:
-                        requested_cols.append(c)
-                requested_cols = list(dict.fromkeys(c for c in requested_cols if c))
-                # strict contract: если fields передан, в output только запрошенные ключи
-                columns = requested_cols
-
-        # Для user-полей иногда нужен сырой id из assigned_by_id, даже если фронт просит "Ответственный".
-        query_columns = list(columns)
-        has_user_requested = False
-        col_types_preview = _col_types_with_infer(
-            conn, final_entity_key, query_columns, _load_meta_column_types(conn, final_entity_key)
+        count_params: List[Any] = list(plan["where_params"])
+        # keyset-условие только для выборки страницы: total считается по всему (отфильтрованному) набору
+        page_where_parts = where_parts + ([keyset_sql] if keyset_sql else [])
+        page_where_sql = f" WHERE {' AND '.join(page_where_parts)}" if page_where_parts else ""
+        select_params: List[Any] = list(plan["where_params"]) + list(keyset_params) + [limit, offset]
+
+        # фильтр ровно по воронке — в режиме cached берётся счётчик воронки
+        only_category = bool(plan["cid"] and plan["category_col"]) and len(where_parts) == 1
+        total, total_mode = count_total(
+            conn,
+            table_name,
+            where_sql,
+            count_params,
+            mode=total_mode,
+            category_col=plan["category_col"],
+            category_value=plan["cid"] if only_category else None,
         )
-        for c in query_columns:
-            t = (col_types_preview.get(c) or "").strip().lower()
-            if t in ("user", "crm_user", "assigned_by"):
-                has_user_requested = True
-                break
-            if c == "assigned_by_id" or (col_to_b24.get(c, "").upper() == "ASSIGNED_BY_ID"):
-                has_user_requested = True
-                break
-        if has_user_requested and _table_has_column(conn, table_name, "assigned_by_id") and "assigned_by_id" not in query_columns:
-            query_columns.append("assigned_by_id")
-
-        if not query_columns:
-            # Технический минимум для валидного SELECT, если ни один requested key не сматчился с колонкой.
-            query_columns = ["id"]
 
+        query_columns = plan["query_columns"]
         columns_str = ", ".join(f'"{c}"' for c in query_columns)
-        col_types = _col_types_with_infer(
-            conn, final_entity_key, query_columns, _load_meta_column_types(conn, final_entity_key)
-        )
-        crm_entity_targets = _load_crm_entity_targets(conn, final_entity_key)
-
+        # id нужен для next_cursor/prev_cursor, даже если его не запросили в fields
+        page_columns_str = columns_str if "id" in query_columns else f'{columns_str}, "id"'
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            if where_sql:
-                cur.execute(
-                    f'SELECT {columns_str} FROM "{table_name}"{where_sql} ORDER BY id DESC LIMIT %s OFFSET %s',
-                    tuple(select_params),
-                )
-            else:
-                cur.execute(
-                    f'SELECT {columns_str} FROM "{table_name}" ORDER BY id DESC LIMIT %s OFFSET %s',
-                    (limit, offset),
-                )
+            cur.execute(
+                f'SELECT {page_columns_str} FROM "{table_name}"{page_where_sql} ORDER BY {order_sql} LIMIT %s OFFSET %s',
+                tuple(select_params),
+            )
             rows = cur.fetchall()
+        if reverse_rows:
+            rows.reverse()
 
-        contact_ids: List[int] = []
-        lead_ids: List[int] = []
-        company_ids: List[int] = []
-        user_ids: List[str] = []
-        crm_entity_ids_by_target: Dict[str, List[int]] = {}
-        for col, t in col_types.items():
-            if t in ("crm_contact", "contact"):
-                for row in rows:
-                    v = row.get(col)
-                    if v is not None and str(v).strip():
-                        try:
-                            contact_ids.append(int(v))
-                        except (TypeError, ValueError):
-                            pass
-            elif t in ("crm_lead", "lead"):
-                for row in rows:
-                    v = row.get(col)
-                    if v is not None and str(v).strip():
-                        try:
-                            lead_ids.append(int(v))
-                        except (TypeError, ValueError):
-                            pass
-            elif t in ("crm_company", "company"):
-                for row in rows:
-                    v = row.get(col)
-                    if v is not None and str(v).strip():
-                        try:
-                            company_ids.append(int(v))
-                        except (TypeError, ValueError):
-                            pass
-            elif t in ("user", "crm_user", "assigned_by"):
-                for row in rows:
-                    v = row.get(col)
-                    if v is not None and str(v).strip():
-                        user_ids.append(str(v).strip())
-            elif t in ("crm_entity", "crm"):
-                target_entity_key = crm_entity_targets.get(col)
-                if not target_entity_key:
-                    continue
-                bucket = crm_entity_ids_by_target.setdefault(target_entity_key, [])
-                for row in rows:
-                    bucket.extend(_extract_ref_ids(row.get(col)))
+        data = _decode_meta_data_rows(conn, plan, _meta_data_decode_maps(conn, plan), rows)
 
-        sources_map = (
-            _load_sources_classifier(conn)
-            if final_entity_key in ("deal", "lead", "contact") or (final_entity_key or "").startswith("sp:")
-            else {}
-        )
-        contact_names_map = _load_contact_names(conn, list(dict.fromkeys(contact_ids))) if contact_ids else {}
-        lead_titles_map = _load_lead_titles(conn, list(dict.fromkeys(lead_ids))) if lead_ids else {}
-        company_ids_unique = list(dict.fromkeys(company_ids))
-        company_titles_map = _load_company_titles(conn, company_ids_unique) if company_ids else {}
-        company_data_map = _load_company_data(conn, company_ids_unique) if company_ids else {}
-        company_field_to_title_map = _load_company_field_to_human_title(conn) if company_ids else {}
-        company_b24_fields = list(company_field_to_title_map.keys()) if company_field_to_title_map else []
-        company_field_enum_map = (
-            _load_field_enum_map(conn, "company", company_b24_fields) if company_b24_fields else {}
-        )
-        user_ids_unique = list(dict.fromkeys(user_ids))
-        user_names_map = _load_user_names(conn, user_ids_unique) if user_ids_unique else {}
-        crm_entity_titles: Dict[Tuple[str, str], str] = {}
-        for target_entity_key, ref_ids in crm_entity_ids_by_target.items():
-            ids_unique = list(dict.fromkeys(ref_ids))
-            if not ids_unique:
-                continue
-            for rid, title in _load_generic_entity_titles(conn, target_entity_key, ids_unique).items():
-                crm_entity_titles[(target_entity_key, str(rid))] = title
-
-        categories_map = _load_deal_categories(conn) if final_entity_key == "deal" else {}
-        sp_entity_type_id = (final_entity_key or "").split(":")[-1] if (final_entity_key or "").startswith("sp:") else ""
-        sp_categories_map = _load_sp_categories(conn, sp_entity_type_id) if sp_entity_type_id else {}
-        stages_map = (
-            _load_deal_stages(conn)
-            if final_entity_key == "deal" or (final_entity_key or "").startswith("sp:")
-            else {}
-        )
-        b24_fields_for_enum = list(dict.fromkeys(col_to_b24.values())) if col_to_b24 else []
-        field_enum_map = _load_field_enum_map(conn, final_entity_key, b24_fields_for_enum) if b24_fields_for_enum else {}
-        iblock_field_ids = _load_iblock_field_ids(conn, final_entity_key)
-        iblock_ids = list(dict.fromkeys(iblock_field_ids.values())) if iblock_field_ids else []
-        iblock_element_names = _load_iblock_element_names(conn, iblock_ids) if iblock_ids else {}
-
-        output_pairs: List[Tuple[str, Optional[str]]]
-        if requested_output_pairs:
-            # Сохраняем запрошенные ключи фронта как ключи output row
-            output_pairs = requested_output_pairs
-        else:
-            output_pairs = [(col_to_title.get(c, c), c) for c in columns]
-
-        output_to_col: Dict[str, str] = {}
-        for out_key, c in output_pairs:
-            if out_key and c:
-                output_to_col[out_key] = c
-
-        data: List[Dict[str, Any]] = []
-        for row in rows:
-            record: Dict[str, Any] = {}
-            for out_key, col in output_pairs:
-                value = row.get(col) if col else None
-                try:
-                    record[out_key] = _normalize_value(value)
-                except Exception as e:
-                    print(f"WARNING: entity-meta-data normalize {col}: {e}", file=sys.stderr, flush=True)
-                    record[out_key] = value
-            _decode_record(
-                record,
-                row,
-                final_entity_key,
-                col_to_title,
-                output_to_col,
-                col_types,
-                sources_map,
-                contact_names_map,
-                lead_titles_map,
-                user_names_map,
-                categories_map=categories_map,
-                stages_map=stages_map,
-                field_enum_map=field_enum_map,
-                col_to_b24_field=col_to_b24,
-                company_titles=company_titles_map,
-                company_data=company_data_map,
-                company_field_to_title=company_field_to_title_map,
-                company_field_enum_map=company_field_enum_map,
-                sp_categories_map=sp_categories_map,
-                iblock_field_ids=iblock_field_ids,
-                iblock_element_names=iblock_element_names,
-                crm_entity_targets=crm_entity_targets,
-                crm_entity_titles=crm_entity_titles,
-            )
-            if final_entity_key == "company":
-                raw_obj = row.get("raw") if isinstance(row.get("raw"), dict) else {}
-                rid = row.get("id") or row.get("id_2") or raw_obj.get("ID") or raw_obj.get("id")
-                rtitle = row.get("title") or row.get("title_2") or raw_obj.get("TITLE") or raw_obj.get("title")
-                if "ID" in record and (record.get("ID") is None or str(record.get("ID")).strip() == ""):
-                    record["ID"] = rid
-                if "Название" in record and (record.get("Название") is None or str(record.get("Название")).strip() == ""):
-                    record["Название"] = _normalize_value(rtitle) if rtitle is not None else rtitle
-            data.append(record)
-
-        out: Dict[str, Any] = {
+        return {
             "ok": True,
             "entity_key": final_entity_key,
             "type": type,
             "total": total,
+            "total_mode": total_mode,
             "limit": limit,
             "offset": offset,
             "data": data,
+            **(
+                {"next_cursor": None, "prev_cursor": None}
+                if plan["order_sql"]
+                else keyset_page_cursors([r.get("id") for r in rows], limit, offset, after_id, before_id)
+            ),
+            "fields": plan["fields"],
         }
-        if requested_output_pairs:
-            out["fields"] = [k for k, _ in output_pairs]
-        else:
-            out["fields"] = [col_to_title.get(c, c) for c in columns]
-        return out
     except HTTPException:
         raise
     except Exception as e:
@@ -1495,6 +1849,121 @@ def get_entity_meta_data(
             pass
 
 
+def _export_json_default(value: Any) -> Any:
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def _export_csv_line(values: List[Any]) -> str:
+    cells: List[Any] = []
+    for v in values:
+        if v is None:
+            cells.append("")
+        elif isinstance(v, (dict, list)):
+            cells.append(json.dumps(v, ensure_ascii=False, default=_export_json_default))
+        elif isinstance(v, (datetime, date, dt_time, Decimal)):
+            cells.append(_export_json_default(v))
+        else:
+            cells.append(v)
+    buf = io.StringIO()
+    csv.writer(buf).writerow(cells)
+    return buf.getvalue()
+
+
+@router.get("/export")
+def export_entity_meta_data(
+    type: str = Query(..., description="Тип сущности: deal, contact, lead, company, smart_process"),
+    entity_key: Optional[str] = Query(None, description="Для smart_process обязателен, например sp:1114"),
+    format: str = Query("ndjson", description="ndjson (по записи JSON на строку) или csv"),
+    id: Optional[int] = Query(None, description="Фильтр по одному ID записи"),
+    ids: Optional[str] = Query(None, description="Фильтр по нескольким ID (через запятую)"),
+    contact_id: Optional[int] = Query(None, description="Alias для id при type=contact"),
+    lead_id: Optional[int] = Query(None, description="Alias для id при type=lead"),
+    company_id: Optional[int] = Query(None, description="Alias для id при type=company"),
+    fields: Optional[str] = Query(None, description="Список полей (human_title через запятую); иначе все"),
+    category_id: Optional[str] = Query(None, description="Фильтр по воронке/категории (для deal и smart_process)"),
+    filters: Optional[str] = Query(None, description="JSON-фильтры, как в GET /api/entity-meta-data/"),
+    sort: Optional[str] = Query(None, description="Сортировка, как в GET /api/entity-meta-data/; по умолчанию по id"),
+) -> StreamingResponse:
+    """
+    Выгрузка всех записей сущности (для BI) потоком NDJSON или CSV: те же ключи и расшифровка значений,
+    что в GET /api/entity-meta-data/, но без limit. Строки читаются серверным курсором пачками
+    по ENTITY_EXPORT_CHUNK_ROWS и расшифровываются попачечно — память воркера не зависит от размера таблицы.
+    Порядок — по id или по sort.
+    """
+    fmt = (format or "").strip().lower()
+    if fmt not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail=f"Invalid format: '{format}'. Must be ndjson or csv")
+    final_entity_key = _meta_data_entity_key(type, entity_key)
+    table_name = table_name_for_entity(final_entity_key)
+
+    conn = pg_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET client_encoding TO 'UTF8'")
+        plan = _meta_data_query_plan(
+            conn, type, final_entity_key, table_name, id, ids, contact_id, lead_id, company_id, fields, category_id,
+            filters=filters, sort=sort,
+        )
+        decode_maps = _meta_data_decode_maps(conn, plan) if plan else {}
+    except HTTPException:
+        conn.close()
+        raise
+    except Exception as e:
+        conn.close()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    def generate():
+        try:
+            if plan is None:
+                return
+            out_keys = plan["fields"]
+            if fmt == "csv":
+                yield _export_csv_line(out_keys)
+            where_parts = plan["where_parts"]
+            where_sql = f" WHERE {' AND '.join(where_parts)}" if where_parts else ""
+            columns_str = ", ".join(f'"{c}"' for c in plan["query_columns"])
+            # серверный (named) курсор: PG отдаёт строки пачками, а не весь результат в память клиента
+            with conn.cursor(
+                name=f"entity_export_{uuid.uuid4().hex}", cursor_factory=psycopg2.extras.RealDictCursor
+            ) as cur:
+                cur.itersize = ENTITY_EXPORT_CHUNK_ROWS
+                cur.execute(
+                    f'SELECT {columns_str} FROM "{table_name}"{where_sql} ORDER BY {plan["order_sql"] or "id"}',
+                    tuple(plan["where_params"]),
+                )
+                while True:
+                    rows = cur.fetchmany(ENTITY_EXPORT_CHUNK_ROWS)
+                    if not rows:
+                        break
+                    records = _decode_meta_data_rows(conn, plan, decode_maps, rows)
+                    if fmt == "csv":
+                        yield "".join(_export_csv_line([r.get(k) for k in out_keys]) for r in records)
+                    else:
+                        yield "".join(
+                            json.dumps(r, ensure_ascii=False, default=_export_json_default) + "\n" for r in records
+                        )
+        except Exception as e:
+            # заголовки уже отправлены — статус не поменять, поток просто обрывается
+            print(f"ERROR: entity-meta-data export {final_entity_key}: {e}", file=sys.stderr, flush=True)
+            raise
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    filename = f"{final_entity_key.replace(':', '_')}.{fmt}"
+    return StreamingResponse(
+        generate(),
+        media_type="text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @router.get("/by-ids")
 def get_entity_meta_data_by_ids(
     type: str = Query(..., description="Тип сущности: contact, lead, company"),
@@ -14,6 +14,7 @@ import psycopg2
 import psycopg2.extras
 
 from api_data import pg_conn
+from meta_cache import cached_meta
 
 router = APIRouter(prefix="/api/entity-meta-fields", tags=["entity-meta-fields"])
 
@@ -179,6 +180,7 @@ def _field_type_display(b24_type: Optional[str], is_multiple: bool) -> str:
     return b24_type
 
 
+@cached_meta("entity_fields_flat")
 def _fetch_entity_fields_flat(conn, entity_key: str) -> List[Dict[str, Any]]:
     """
     Возвращает список полей сущности в формате {id, b24_field, column_name, human_title, field_type}.
@@ -208,6 +210,7 @@ def _fetch_entity_fields_flat(conn, entity_key: str) -> List[Dict[str, Any]]:
                     SELECT column_name
                     FROM information_schema.columns
                     WHERE table_name = %s
+                      AND column_name <> 'raw_hash'
                     ORDER BY ordinal_position
                 """, (table_name,))
                 column_rows = cur.fetchall()
@@ -317,6 +320,135 @@ def _resolve_nested_entity_key(
     return None
 
 
+@cached_meta("entity_meta_fields_response")
+def _entity_meta_fields_response(conn, type: str, final_entity_key: str, request_entity_key: str) -> Dict[str, Any]:
+    """Ответ GET /api/entity-meta-fields/ — строится только из метаданных, поэтому кэшируется целиком."""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("""
+            SELECT
+                b24_field,
+                column_name,
+                b24_type,
+                is_multiple,
+                is_required,
+                is_readonly,
+                b24_title,
+                b24_labels,
+                settings
+            FROM b24_meta_fields
+            WHERE entity_key = %s
+            ORDER BY b24_field
+        """, (final_entity_key,))
+        rows = cur.fetchall()
+
+    if not rows:
+        table_name = table_name_for_entity(final_entity_key)
+        with conn.cursor() as cur:
+            try:
+                cur.execute("""
+                    SELECT column_name
+                    FROM information_schema.columns
+                    WHERE table_name = %s
+                      AND column_name <> 'raw_hash'
+                    ORDER BY ordinal_position
+                """, (table_name,))
+                column_rows = cur.fetchall()
+                columns = [row[0] for row in column_rows] if column_rows else []
+            except Exception as e:
+                print(f"WARNING: entity-meta-fields: {e}", file=sys.stderr, flush=True)
+                columns = []
+
+        base_field_titles = {
+            "id": "ID",
+            "raw": "Данные (JSON)",
+            "created_at": "Дата создания",
+            "updated_at": "Дата обновления",
+            "title": "Название",
+            "name": "Имя",
+            "last_name": "Фамилия",
+            "second_name": "Отчество",
+            "phone": "Телефон",
+            "email": "Email",
+            "company_id": "ID компании",
+            "assigned_by_id": "Ответственный",
+            "status_id": "Статус",
+            "source_id": "Источник",
+            "opportunity": "Сумма",
+            "currency_id": "Валюта",
+        }
+
+        fields: List[Dict[str, Any]] = []
+        for idx, col in enumerate(columns, start=1):
+            human = base_field_titles.get(col, col.replace("_", " ").title())
+            fields.append({
+                "id": idx,
+                "b24_field": col,
+                "column_name": col,
+                "field_code": (col or "").strip(),
+                "human_title": human,
+                "field_type": "string",
+            })
+        return {
+            "ok": True,
+            "entity_key": request_entity_key,
+            "resolved_entity_key": final_entity_key,
+            "type": type,
+            "fields_count": len(fields),
+            "fields": fields,
+        }
+
+    fields = []
+    for idx, row in enumerate(rows, start=1):
+        b24_field = row.get("b24_field") or ""
+        column_name = row.get("column_name") or b24_field
+        human_title = _human_title_from_row(row)
+        b24_type = row.get("b24_type")
+        is_multiple = bool(row.get("is_multiple", False))
+        field_type = _field_type_display(b24_type, is_multiple)
+
+        field_item = {
+            "id": idx,
+            "b24_field": b24_field,
+            "column_name": column_name,
+            "field_code": (b24_field or column_name or "").strip(),
+            "human_title": human_title,
+            "field_type": field_type,
+        }
+
+        ft_lower = (field_type or "").strip().lower()
+        is_crm_ref = ft_lower in ("crm_contact", "crm_lead", "crm_company", "crm_entity")
+        nested_key = None
+        if is_crm_ref:
+            nested_key = _resolve_nested_entity_key(
+                conn,
+                ft_lower,
+                human_title,
+                row.get("settings"),
+                b24_field=b24_field,
+                column_name=column_name,
+            )
+        if not nested_key and (_entity_key_from_parent_id(b24_field) or _entity_key_from_parent_id(column_name)):
+            nested_key = _entity_key_from_parent_id(b24_field) or _entity_key_from_parent_id(column_name)
+        if is_crm_ref or nested_key:
+            if nested_key:
+                field_item["nested_entity_key"] = nested_key
+                field_item["nested_fields"] = _fetch_entity_fields_flat(conn, nested_key)
+            else:
+                field_item["nested_entity_key"] = None
+                field_item["nested_fields"] = []
+
+        fields.append(field_item)
+
+    return {
+        "ok": True,
+        "entity_key": request_entity_key,
+        "resolved_entity_key": final_entity_key,
+        "type": type,
+        "fields_count": len(fields),
+        "fields": fields,
+    }
+
+
 @router.get("/")
 def get_entity_meta_fields(
     type: str = Query(..., description="Тип сущности: deal, contact, lead, company, smart_process"),
@@ -356,129 +488,7 @@ def get_entity_meta_fields(
 
     conn = pg_conn()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute("""
-                SELECT
-                    b24_field,
-                    column_name,
-                    b24_type,
-                    is_multiple,
-                    is_required,
-                    is_readonly,
-                    b24_title,
-                    b24_labels,
-                    settings
-                FROM b24_meta_fields
-                WHERE entity_key = %s
-                ORDER BY b24_field
-            """, (final_entity_key,))
-            rows = cur.fetchall()
-
-        if not rows:
-            table_name = table_name_for_entity(final_entity_key)
-            with conn.cursor() as cur:
-                try:
-                    cur.execute("""
-                        SELECT column_name
-                        FROM information_schema.columns
-                        WHERE table_name = %s
-                        ORDER BY ordinal_position
-                    """, (table_name,))
-                    column_rows = cur.fetchall()
-                    columns = [row[0] for row in column_rows] if column_rows else []
-                except Exception as e:
-                    print(f"WARNING: entity-meta-fields: {e}", file=sys.stderr, flush=True)
-                    columns = []
-
-            base_field_titles = {
-                "id": "ID",
-                "raw": "Данные (JSON)",
-                "created_at": "Дата создания",
-                "updated_at": "Дата обновления",
-                "title": "Название",
-                "name": "Имя",
-                "last_name": "Фамилия",
-                "second_name": "Отчество",
-                "phone": "Телефон",
-                "email": "Email",
-                "company_id": "ID компании",
-                "assigned_by_id": "Ответственный",
-                "status_id": "Статус",
-                "source_id": "Источник",
-                "opportunity": "Сумма",
-                "currency_id": "Валюта",
-            }
-
-            fields: List[Dict[str, Any]] = []
-            for idx, col in enumerate(columns, start=1):
-                human = base_field_titles.get(col, col.replace("_", " ").title())
-                fields.append({
-                    "id": idx,
-                    "b24_field": col,
-                    "column_name": col,
-                    "field_code": (col or "").strip(),
-                    "human_title": human,
-                    "field_type": "string",
-                })
-            return {
-                "ok": True,
-                "entity_key": request_entity_key,
-                "resolved_entity_key": final_entity_key,
-                "type": type,
-                "fields_count": len(fields),
-                "fields": fields,
-            }
-
-        fields = []
-        for idx, row in enumerate(rows, start=1):
-            b24_field = row.get("b24_field") or ""
-            column_name = row.get("column_name") or b24_field
-            human_title = _human_title_from_row(row)
-            b24_type = row.get("b24_type")
-            is_multiple = bool(row.get("is_multiple", False))
-            field_type = _field_type_display(b24_type, is_multiple)
-
-            field_item = {
-                "id": idx,
-                "b24_field": b24_field,
-                "column_name": column_name,
-                "field_code": (b24_field or column_name or "").strip(),
-                "human_title": human_title,
-                "field_type": field_type,
-            }
-
-            ft_lower = (field_type or "").strip().lower()
-            is_crm_ref = ft_lower in ("crm_contact", "crm_lead", "crm_company", "crm_entity")
-            nested_key = None
-            if is_crm_ref:
-                nested_key = _resolve_nested_entity_key(
-                    conn,
-                    ft_lower,
-                    human_title,
-                    row.get("settings"),
-                    b24_field=b24_field,
-                    column_name=column_name,
-                )
-            if not nested_key and (_entity_key_from_parent_id(b24_field) or _entity_key_from_parent_id(column_name)):
-                nested_key = _entity_key_from_parent_id(b24_field) or _entity_key_from_parent_id(column_name)
-            if is_crm_ref or nested_key:
-                if nested_key:
-                    field_item["nested_entity_key"] = nested_key
-                    field_item["nested_fields"] = _fetch_entity_fields_flat(conn, nested_key)
-                else:
-                    field_item["nested_entity_key"] = None
-                    field_item["nested_fields"] = []
-
-            fields.append(field_item)
-
-        return {
-            "ok": True,
-            "entity_key": request_entity_key,
-            "resolved_entity_key": final_entity_key,
-            "type": type,
-            "fields_count": len(fields),
-            "fields": fields,
-        }
+        return _entity_meta_fields_response(conn, type, final_entity_key, request_entity_key)
     except HTTPException:
         raise
     except Exception as e:
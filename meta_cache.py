@@ -0,0 +1,202 @@
+"""
+Кэш метаданных сущностей в памяти процесса: заголовки и типы колонок, enum-значения, воронки/стадии,
+список колонок таблиц — всё, что entity-meta-data, entity-meta-fields и entity-table читают
+перед каждой выборкой данных.
+
+Запись живёт META_CACHE_TTL_SEC и сбрасывается раньше, если изменилась версия схемы
+(b24_meta_schema_version, одна строка). Версию увеличивает bump_schema_version(): sync_schema,
+синхронизация справочников и DDL кастомных полей entity-table. Процесс перечитывает версию
+не чаще раза в META_CACHE_VERSION_CHECK_SEC — так сброс, сделанный в одном uvicorn-воркере,
+доходит до остальных.
+
+Загрузчик подключается декоратором:
+
+    @cached_meta("meta_column_types")
+    def _load_meta_column_types(conn, entity_key): ...
+
+Ключ записи — имя + аргументы после conn (списки -> tuple). Одинаковое имя в разных модулях —
+общая запись (например, "table_columns").
+
+Настройки (env):
+  META_CACHE_TTL_SEC           — сколько живёт запись (по умолчанию 300; 0 — кэш выключен)
+  META_CACHE_VERSION_CHECK_SEC — как часто сверять версию схемы с БД (по умолчанию 5)
+"""
+import os
+import sys
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from pg_pool import pg_connection
+
+META_CACHE_TTL_SEC = max(0.0, float(os.getenv("META_CACHE_TTL_SEC", "300")))
+META_CACHE_VERSION_CHECK_SEC = max(0.0, float(os.getenv("META_CACHE_VERSION_CHECK_SEC", "5")))
+
+_lock = threading.Lock()
+# ключ -> (время записи, версия схемы, значение)
+_entries: Dict[Tuple[Hashable, ...], Tuple[float, Optional[int], Any]] = {}
+_version: Optional[int] = None
+_version_checked_at = 0.0
+_schema_ready = False
+_hits = 0
+_misses = 0
+_listeners: List[Callable[[], None]] = []
+
+
+def _ensure_schema(conn) -> None:
+    global _schema_ready
+    if _schema_ready:
+        return
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS b24_meta_schema_version (
+                id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                version BIGINT NOT NULL DEFAULT 1,
+                updated_at TIMESTAMPTZ DEFAULT now()
+            );
+        """)
+        cur.execute("INSERT INTO b24_meta_schema_version (id, version) VALUES (1, 1) ON CONFLICT (id) DO NOTHING")
+    _schema_ready = True
+
+
+def _notify_listeners() -> None:
+    for fn in list(_listeners):
+        try:
+            fn()
+        except Exception as e:
+            print(f"WARNING: meta_cache: invalidate listener {fn!r} failed: {e}", file=sys.stderr, flush=True)
+
+
+def _read_version(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM b24_meta_schema_version WHERE id = 1")
+        row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def _current_version(conn=None) -> Optional[int]:
+    """
+    Версия схемы из БД (не чаще раза в META_CACHE_VERSION_CHECK_SEC); при ошибке — последняя известная.
+    Перечитывает один поток (проверку он занимает под _lock), остальные пока берут известную версию.
+    Запрос — на соединении вызывающего: одна строка, транзакцию чтения не портит, второй слот пула не нужен.
+    """
+    global _version, _version_checked_at
+    now = time.time()
+    with _lock:
+        if now - _version_checked_at < META_CACHE_VERSION_CHECK_SEC:
+            return _version
+        _version_checked_at = now
+        version = _version
+    try:
+        if not _schema_ready:
+            # таблица версии — один раз за процесс, отдельным autocommit-соединением: ошибка CREATE
+            # не должна оборвать транзакцию вызывающего
+            with pg_connection(autocommit=True) as own:
+                _ensure_schema(own)
+        if conn is not None:
+            version = _read_version(conn)
+        else:
+            with pg_connection(autocommit=True) as own:
+                version = _read_version(own)
+    except Exception as e:
+        print(f"WARNING: meta_cache: schema version check failed: {e}", file=sys.stderr, flush=True)
+    changed = False
+    with _lock:
+        if _version is not None and version != _version:
+            _entries.clear()
+            changed = True
+        _version = version
+    if changed:
+        _notify_listeners()
+    return version
+
+
+def _copy(value: Any) -> Any:
+    # вызывающие иногда дополняют полученный dict/set — отдаём поверхностную копию
+    if isinstance(value, (dict, list, set)):
+        return value.copy()
+    return value
+
+
+def meta_cached(key: Tuple[Hashable, ...], loader: Callable[[], Any], conn=None) -> Any:
+    """Значение из кэша по key; нет или устарело — loader() и запись в кэш. conn — для сверки версии схемы."""
+    global _hits, _misses
+    if META_CACHE_TTL_SEC <= 0:
+        return loader()
+    version = _current_version(conn)
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry and entry[1] == version and now - entry[0] < META_CACHE_TTL_SEC:
+            _hits += 1
+            return _copy(entry[2])
+        _misses += 1
+    value = loader()
+    with _lock:
+        _entries[key] = (now, version, value)
+    return _copy(value)
+
+
+def _hashable(v: Any) -> Hashable:
+    if isinstance(v, (list, tuple)):
+        return tuple(_hashable(x) for x in v)
+    if isinstance(v, (set, frozenset)):
+        return tuple(sorted(_hashable(x) for x in v))
+    if isinstance(v, dict):
+        return tuple(sorted((k, _hashable(x)) for k, x in v.items()))
+    return v
+
+
+def cached_meta(name: str):
+    """Декоратор загрузчика метаданных f(conn, *args, **kwargs): кэш по name + аргументам (conn в ключ не входит)."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(conn, *args, **kwargs):
+            key = (name,) + tuple(_hashable(a) for a in args) + tuple(sorted((k, _hashable(v)) for k, v in kwargs.items()))
+            return meta_cached(key, lambda: fn(conn, *args, **kwargs), conn)
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+
+def invalidate_meta_cache() -> None:
+    """Сбросить кэш этого процесса и перечитать версию схемы при следующем обращении."""
+    global _version, _version_checked_at
+    with _lock:
+        _entries.clear()
+        _version = None
+        _version_checked_at = 0.0
+    _notify_listeners()
+
+
+def bump_schema_version(conn) -> None:
+    """
+    Увеличивает версию схемы в транзакции conn (остальные процессы увидят её после commit вызывающего)
+    и сразу сбрасывает кэш этого процесса.
+    """
+    try:
+        with pg_connection(autocommit=True) as own:
+            _ensure_schema(own)
+    except Exception as e:
+        print(f"WARNING: meta_cache: schema table check failed: {e}", file=sys.stderr, flush=True)
+    with conn.cursor() as cur:
+        cur.execute("UPDATE b24_meta_schema_version SET version = version + 1, updated_at = now() WHERE id = 1")
+    invalidate_meta_cache()
+
+
+def on_meta_invalidate(fn: Callable[[], None]) -> None:
+    """Колбэк на сброс кэша (локальный или по смене версии схемы) — для кэшей вне этого модуля."""
+    _listeners.append(fn)
+
+
+def meta_cache_stats() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "enabled": META_CACHE_TTL_SEC > 0,
+            "ttl_sec": META_CACHE_TTL_SEC,
+            "schema_version": _version,
+            "entries": len(_entries),
+            "hits": _hits,
+            "misses": _misses,
+        }
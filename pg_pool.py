@@ -0,0 +1,268 @@
+"""
+Общий пул соединений PostgreSQL для всех модулей (app.py, api_data.py, Login.py, отчёты).
+
+Раньше каждый pg_conn() открывал новое соединение к удалённому PG (TCP + auth + SET client_encoding);
+теперь соединение берётся из пула, а conn.close() возвращает его обратно.
+Вызывающий код не меняется: pg_conn() / _pg_conn() отдают обёртку с тем же API, что у psycopg2-соединения.
+
+(psycopg2.pool не подходит: его пулы держат открытыми не больше minconn свободных соединений,
+остальные закрывают при возврате — т.е. под нагрузкой снова connect на каждый запрос.)
+
+Настройки (env, те же PG_* что в app.py):
+  PG_POOL_MIN                  — сколько соединений держать открытыми даже без нагрузки (по умолчанию 1)
+  PG_POOL_MAX                  — максимум соединений на процесс (по умолчанию 20)
+  PG_POOL_TIMEOUT_SEC          — сколько ждать свободного соединения, если пул исчерпан (по умолчанию 30)
+  PG_POOL_HEALTHCHECK_IDLE_SEC — соединение, простоявшее дольше, проверяется SELECT 1 перед выдачей (по умолчанию 30)
+  PG_POOL_MAX_IDLE_SEC         — свободные соединения сверх PG_POOL_MIN закрываются после простоя (по умолчанию 300)
+"""
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+PG_HOST = os.getenv("PG_HOST", "194.33.40.197")
+PG_PORT = int(os.getenv("PG_PORT", "5432"))
+PG_DB = os.getenv("PG_DB", "crm")
+PG_USER = os.getenv("PG_USER", "crm")
+PG_PASS = os.getenv("PG_PASS", "crm")
+
+PG_POOL_MAX = max(1, int(os.getenv("PG_POOL_MAX", "20")))
+PG_POOL_MIN = min(PG_POOL_MAX, max(0, int(os.getenv("PG_POOL_MIN", "1"))))
+PG_POOL_TIMEOUT_SEC = float(os.getenv("PG_POOL_TIMEOUT_SEC", "30"))
+PG_POOL_HEALTHCHECK_IDLE_SEC = float(os.getenv("PG_POOL_HEALTHCHECK_IDLE_SEC", "30"))
+PG_POOL_MAX_IDLE_SEC = float(os.getenv("PG_POOL_MAX_IDLE_SEC", "300"))
+
+
+def _set_utf8(conn) -> None:
+    try:
+        conn.set_client_encoding("UTF8")
+    except Exception as e:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET client_encoding TO 'UTF8'")
+            conn.commit()
+        except Exception:
+            print(f"WARNING: pg_pool: could not set UTF8 encoding: {e}", file=sys.stderr, flush=True)
+
+
+def _new_connection():
+    conn = psycopg2.connect(host=PG_HOST, port=PG_PORT, dbname=PG_DB, user=PG_USER, password=PG_PASS)
+    # кодировка один раз при создании соединения, а не на каждый запрос
+    _set_utf8(conn)
+    return conn
+
+
+def _ping(conn) -> bool:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def _close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class _ConnectionPool:
+    """Потокобезопасный LIFO-пул: свободные (conn, время возврата) + семафор на PG_POOL_MAX выданных."""
+
+    def __init__(self) -> None:
+        self._idle: Deque[Tuple[Any, float]] = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(PG_POOL_MAX)
+        self.in_use = 0
+        self.created = 0
+        self.discarded = 0
+
+    def get(self):
+        if not self._slots.acquire(timeout=PG_POOL_TIMEOUT_SEC):
+            raise psycopg2.pool.PoolError(
+                f"pg_pool: no free connection in {PG_POOL_TIMEOUT_SEC:.0f}s (PG_POOL_MAX={PG_POOL_MAX})"
+            )
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    conn = _new_connection()
+                    with self._lock:
+                        self.created += 1
+                    break
+                conn, returned_at = item
+                if conn.closed:
+                    self._count_discard()
+                    continue
+                # health check только для давно простаивавших — свежие соединения отдаём без лишнего round trip
+                if time.time() - returned_at >= PG_POOL_HEALTHCHECK_IDLE_SEC and not _ping(conn):
+                    _close_quietly(conn)
+                    self._count_discard()
+                    continue
+                break
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+        return conn
+
+    def put(self, conn, discard: bool = False) -> None:
+        try:
+            now = time.time()
+            to_close = []
+            with self._lock:
+                self.in_use -= 1
+                if discard or conn.closed:
+                    to_close.append(conn)
+                    self.discarded += 1
+                else:
+                    self._idle.append((conn, now))
+                # лишние (сверх PG_POOL_MIN) давно простаивающие соединения закрываем
+                while len(self._idle) > PG_POOL_MIN and now - self._idle[0][1] >= PG_POOL_MAX_IDLE_SEC:
+                    to_close.append(self._idle.popleft()[0])
+            for c in to_close:
+                _close_quietly(c)
+        finally:
+            self._slots.release()
+
+    def warm_up(self) -> None:
+        with self._lock:
+            missing = PG_POOL_MIN - len(self._idle) - self.in_use
+        for _ in range(max(0, missing)):
+            conn = _new_connection()
+            with self._lock:
+                self.created += 1
+                self._idle.append((conn, time.time()))
+
+    def _count_discard(self) -> None:
+        with self._lock:
+            self.discarded += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "min": PG_POOL_MIN,
+                "max": PG_POOL_MAX,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "created": self.created,
+                "discarded": self.discarded,
+            }
+
+
+_pool: Optional[_ConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> _ConnectionPool:
+    """Пул создаётся лениво; после fork (uvicorn --workers) у дочернего процесса свой пул."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = _ConnectionPool()
+                _pool_pid = pid
+    return _pool
+
+
+class PooledConnection:
+    """
+    Обёртка над psycopg2-соединением из пула. Всё делегируется настоящему соединению,
+    кроме close(): оно откатывает незавершённую транзакцию, сбрасывает autocommit и возвращает соединение в пул.
+    """
+
+    def __init__(self, pool: _ConnectionPool, conn) -> None:
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_returned", False)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._conn, name, value)
+
+    # `with conn:` у psycopg2 — это транзакция (commit/rollback), а не закрытие; сохраняем поведение
+    def __enter__(self) -> "PooledConnection":
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> Any:
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    @property
+    def closed(self) -> int:
+        return 1 if self._returned else self._conn.closed
+
+    def close(self) -> None:
+        if self._returned:
+            return
+        object.__setattr__(self, "_returned", True)
+        conn = self._conn
+        discard = bool(conn.closed)
+        if not discard:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                discard = True
+        self._pool.put(conn, discard=discard)
+
+    def __del__(self) -> None:
+        # Соединение забыли закрыть — возвращаем в пул при сборке мусора, чтобы пул не "протёк"
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def pg_pool_conn() -> PooledConnection:
+    """Соединение из общего пула. Вернуть — conn.close() (или использовать pg_connection())."""
+    pool = _get_pool()
+    return PooledConnection(pool, pool.get())
+
+
+@contextmanager
+def pg_connection(autocommit: bool = False) -> Iterator[PooledConnection]:
+    """
+    with pg_connection() as conn: ... — соединение из пула, по выходу возвращается в пул
+    (незакоммиченная транзакция откатывается).
+    """
+    conn = pg_pool_conn()
+    try:
+        if autocommit:
+            conn.autocommit = True
+        yield conn
+    finally:
+        conn.close()
+
+
+def pg_pool_warm_up() -> None:
+    """Открывает PG_POOL_MIN соединений заранее (на старте сервиса), чтобы первый запрос не платил за connect."""
+    try:
+        _get_pool().warm_up()
+    except Exception as e:
+        print(f"WARNING: pg_pool: warm up failed: {e}", file=sys.stderr, flush=True)
+
+
+def pg_pool_stats() -> Dict[str, Any]:
+    """Состояние пула текущего процесса (для диагностики)."""
+    if _pool is None or _pool_pid != os.getpid():
+        return {"initialized": False, "min": PG_POOL_MIN, "max": PG_POOL_MAX}
+    return {"initialized": True, **_pool.stats()}
@@ -8,6 +8,7 @@ import psycopg2.extras
 
 # Импортируем функции из api_data.py (избегаем циклического импорта)
 from api_data import pg_conn
+from entity_counts import count_total, resolve_total_mode
 
 router = APIRouter(prefix="/api/processes-deals", tags=["processes-deals"])
 
@@ -77,11 +78,14 @@ def table_name_for_entity(entity_key: str) -> str:
 
 
 @router.get("/")
-def get_processes_and_deals() -> Dict[str, Any]:
+def get_processes_and_deals(
+    total_mode: Optional[str] = Query(None, description="Как считать total: exact, estimated или cached (см. entity_counts)"),
+) -> Dict[str, Any]:
     """
     Возвращает список всех доступных типов сущностей (смарт-процессы, сделки, контакты и лиды).
     Используется фронтендом для отображения списка сущностей для выбора.
     """
+    total_mode = resolve_total_mode(total_mode)
     conn = pg_conn()
     try:
         entities: List[Dict[str, Any]] = []
@@ -118,16 +122,11 @@ def get_processes_and_deals() -> Dict[str, Any]:
                 # Подсчитываем количество записей в таблице
                 total = 0
                 try:
-                    cur.execute(f"""
-                        SELECT COUNT(*) as cnt
-                        FROM {table_name}
-                    """)
-                    count_row = cur.fetchone()
-                    if count_row:
-                        total = int(count_row.get("cnt", 0) or 0)
+                    total, mode_used = count_total(conn, table_name, mode=total_mode)
                 except Exception as e:
                     # Если таблица не существует или ошибка - пропускаем
                     print(f"WARNING: Could not count records in {table_name}: {e}", file=sys.stderr, flush=True)
+                    conn.rollback()
                     continue
                 
                 entities.append({
@@ -135,7 +134,8 @@ def get_processes_and_deals() -> Dict[str, Any]:
                     "entity_key": entity_key or f"sp:{entity_type_id}",
                     "entity_type_id": entity_type_id,
                     "title": title,
-                    "total": total
+                    "total": total,
+                    "total_mode": mode_used
                 })
             
             # Добавляем сделки, контакты, лиды (только type, title, total)
@@ -145,20 +145,19 @@ def get_processes_and_deals() -> Dict[str, Any]:
                 ("lead", "lead", "CRM Lead"),
             ]:
                 total = 0
+                mode_used = None
                 try:
                     tbl = table_name_for_entity(ekey)
-                    cur.execute(f"SELECT COUNT(*) as cnt FROM {tbl}")
-                    row = cur.fetchone()
-                    if row:
-                        total = int(row.get("cnt", 0) or 0)
+                    total, mode_used = count_total(conn, tbl, mode=total_mode)
                 except Exception:
-                    pass
+                    conn.rollback()
                 entities.append({
                     "type": etype,
                     "entity_key": ekey,
                     "entity_type_id": None,
                     "title": etitle,
-                    "total": total
+                    "total": total,
+                    "total_mode": mode_used
                 })
         
         return {